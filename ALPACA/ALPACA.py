@@ -16,6 +16,9 @@ import sys
 import os
 import platform
 import math
+import warnings
+
+from ALPACALib.pipeline import ALPACAPipeline
 
 #
 # ALPACA
@@ -277,6 +280,10 @@ class ALPACAWidget(ScriptedLoadableModuleWidget):
         self.ui.applyLandmarkMultiButton.connect(
             "clicked(bool)", self.onApplyLandmarkMulti
         )
+        self.ui.workerNumberSpinBox.value = max(1, os.cpu_count() // 2)
+        self.ui.clearFeatureCacheButton.connect(
+            "clicked(bool)", self.onClearFeatureCacheButton
+        )
 
         # Template Selection connections
         self.ui.modelsMultiSelector.connect(
@@ -940,6 +947,8 @@ class ALPACAWidget(ScriptedLoadableModuleWidget):
                 projectionFactor,
                 self.ui.JSONFileFormatSelector.checked,
                 self.parameterDictionary,
+                self.ui.workerNumberSpinBox.value,
+                self.featureCacheDirectory(),
             )
         else:
             for i in range(0, self.ui.replicationNumberSpinBox.value):
@@ -959,6 +968,8 @@ class ALPACAWidget(ScriptedLoadableModuleWidget):
                         projectionFactor,
                         self.ui.JSONFileFormatSelector.checked,
                         self.parameterDictionary,
+                        self.ui.workerNumberSpinBox.value,
+                        self.featureCacheDirectory(),
                     )
                 except:
                     logging.debug(
@@ -966,6 +977,19 @@ class ALPACAWidget(ScriptedLoadableModuleWidget):
                     )
                     print("Error creating result directory")
 
+    def featureCachePath(self):
+        return os.path.join(slicer.app.cachePath, "ALPACA", "FeatureCache")
+
+    def featureCacheDirectory(self):
+        if self.ui.featureCacheCheckBox.checked:
+            return self.featureCachePath()
+        return None
+
+    def onClearFeatureCacheButton(self):
+        from ALPACALib import pipeline
+
+        pipeline.clearFeatureCache(self.featureCachePath())
+
     ###Connecting function for kmeans templates selection
     def onSelectKmeans(self):
         self.ui.downReferenceButton.enabled = bool(
@@ -1443,7 +1467,7 @@ class ALPACAWidget(ScriptedLoadableModuleWidget):
 #
 
 
-class ALPACALogic(ScriptedLoadableModuleLogic):
+class ALPACALogic(ScriptedLoadableModuleLogic, ALPACAPipeline):
     """This class should implement all the actual
     computation done by your module.  The interface
     should be such that other python code can import
@@ -1463,7 +1487,16 @@ class ALPACALogic(ScriptedLoadableModuleLogic):
         projectionFactor,
         useJSONFormat,
         parameters,
+        maxWorkers=0,
+        featureCacheDirectory=None,
     ):
+        """
+        Transfers the landmarks of the source model, or of each template in the source model directory,
+        to every model in the target directory. With maxWorkers=0 the alignments run one after another
+        in the Slicer process, otherwise in a pool of maxWorkers worker processes (all cores if None).
+        The subsampled points and features of each mesh are computed once per run, and are kept in
+        featureCacheDirectory across runs if it is given.
+        """
         # extensionModel = ".ply"
         if useJSONFormat:
             extensionLM = ".mrk.json"
@@ -1472,6 +1505,8 @@ class ALPACALogic(ScriptedLoadableModuleLogic):
         sourceModelList = []
         sourceLMList = []
         TargetModelList = []
+        # (source model, source landmarks, target model, output file, median file) of each alignment
+        alignments = []
         if os.path.isdir(sourceModelPath):
             specimenOutput = os.path.join(outputDirectory, "individualEstimates")
             medianOutput = os.path.join(outputDirectory, "medianEstimates")
@@ -1496,7 +1531,6 @@ class ALPACALogic(ScriptedLoadableModuleLogic):
                 targetFilePath = os.path.join(targetModelDirectory, targetFileName)
                 TargetModelList.append(targetFilePath)
                 rootName = os.path.splitext(targetFileName)[0]
-                landmarkList = []
                 if os.path.isdir(sourceModelPath):
                     outputMedianPath = os.path.join(
                         medianOutput, f"{rootName}_median" + extensionLM
@@ -1516,42 +1550,43 @@ class ALPACALogic(ScriptedLoadableModuleLogic):
                                     "::::Could not find the file corresponding to ",
                                     file,
                                 )
-                                next
+                                continue
                             outputFilePath = os.path.join(
                                 specimenOutput, f"{rootName}_{baseName}" + extensionLM
                             )
-                            array = self.pairwiseAlignment(
-                                sourceFilePath,
-                                sourceLandmarkFile,
-                                targetFilePath,
-                                outputFilePath,
-                                skipScaling,
-                                projectionFactor,
-                                parameters,
+                            alignments.append(
+                                (
+                                    sourceFilePath,
+                                    sourceLandmarkFile,
+                                    targetFilePath,
+                                    outputFilePath,
+                                    outputMedianPath,
+                                )
                             )
-                            landmarkList.append(array)
-                        medianLandmark = np.median(landmarkList, axis=0)
-                        outputMedianNode = self.exportPointCloud(
-                            medianLandmark, "Median Predicted Landmarks"
-                        )
-                        slicer.util.saveNode(outputMedianNode, outputMedianPath)
-                        slicer.mrmlScene.RemoveNode(outputMedianNode)
                 elif os.path.isfile(sourceModelPath):
                     rootName = os.path.splitext(targetFileName)[0]
                     outputFilePath = os.path.join(
                         outputDirectory, rootName + extensionLM
                     )
-                    array = self.pairwiseAlignment(
-                        sourceModelPath,
-                        sourceLandmarkPath,
-                        targetFilePath,
-                        outputFilePath,
-                        skipScaling,
-                        projectionFactor,
-                        parameters,
+                    alignments.append(
+                        (
+                            sourceModelPath,
+                            sourceLandmarkPath,
+                            targetFilePath,
+                            outputFilePath,
+                            None,
+                        )
                     )
                 else:
                     print("::::Could not find the file or directory in question")
+        self.runAlignments(
+            alignments,
+            skipScaling,
+            projectionFactor,
+            parameters,
+            maxWorkers,
+            featureCacheDirectory,
+        )
         extras = {
             "Source": sourceModelList,
             "SourceLandmarks": sourceLMList,
@@ -1563,6 +1598,137 @@ class ALPACALogic(ScriptedLoadableModuleLogic):
         parameterFile = os.path.join(outputDirectory, "advancedParameters.txt")
         json.dump(extras, open(parameterFile, "w"), indent=2)
 
+    def runAlignments(
+        self,
+        alignments,
+        skipScaling,
+        projectionFactor,
+        parameters,
+        maxWorkers=0,
+        featureCacheDirectory=None,
+    ):
+        """
+        Runs the alignments listed by runLandmarkMultiprocess and writes the predicted landmarks of each.
+        Once all alignments with a median file are done for a target, the median of their predictions
+        is written to the median file.
+        """
+        if maxWorkers != 0 and self.workerExecutable() is None:
+            logging.warning("PythonSlicer was not found, running the alignments in the Slicer process")
+            maxWorkers = 0
+        if maxWorkers == 0:
+            results = (
+                self.pairwiseAlignment(
+                    sourceFilePath,
+                    sourceLandmarkFile,
+                    targetFilePath,
+                    outputFilePath,
+                    skipScaling,
+                    projectionFactor,
+                    parameters,
+                    featureCacheDirectory=featureCacheDirectory,
+                )
+                for sourceFilePath, sourceLandmarkFile, targetFilePath, outputFilePath, _ in alignments
+            )
+        else:
+            results = self.runAlignmentPool(
+                alignments,
+                skipScaling,
+                projectionFactor,
+                parameters,
+                maxWorkers,
+                featureCacheDirectory,
+            )
+        landmarkList = []
+        for index, array in enumerate(results):
+            outputMedianPath = alignments[index][4]
+            if outputMedianPath is None:
+                continue
+            if array is not None:
+                landmarkList.append(array)
+            lastOfTarget = (
+                index + 1 == len(alignments)
+                or alignments[index + 1][4] != outputMedianPath
+            )
+            if lastOfTarget:
+                if len(landmarkList) > 0:
+                    medianLandmark = np.median(landmarkList, axis=0)
+                    outputMedianNode = self.exportPointCloud(
+                        medianLandmark, "Median Predicted Landmarks"
+                    )
+                    slicer.util.saveNode(outputMedianNode, outputMedianPath)
+                    slicer.mrmlScene.RemoveNode(outputMedianNode)
+                landmarkList = []
+
+    def runAlignmentPool(
+        self,
+        alignments,
+        skipScaling,
+        projectionFactor,
+        parameters,
+        maxWorkers=None,
+        featureCacheDirectory=None,
+    ):
+        """
+        Runs the alignments in worker processes and writes the predicted landmarks of each as its result
+        arrives. Yields the predicted landmarks in the order of the alignments, None for failed ones.
+        """
+        from ALPACALib import batch
+
+        jobs = [
+            {
+                "sourceModelPath": sourceFilePath,
+                "sourceLandmarkPath": sourceLandmarkFile,
+                "targetModelPath": targetFilePath,
+                "skipScaling": skipScaling,
+                "projectionFactor": projectionFactor,
+                "parameters": parameters,
+                "featureCacheDirectory": featureCacheDirectory,
+            }
+            for sourceFilePath, sourceLandmarkFile, targetFilePath, _, _ in alignments
+        ]
+        # the alignments of one target are consecutive, send them to the same worker
+        from collections import Counter
+
+        chunkSize = max(Counter(alignment[2] for alignment in alignments).values(), default=1)
+        # the landmark labels and descriptions are copied from the source landmark nodes
+        sourceLMNodes = {}
+        results = batch.runJobs(jobs, maxWorkers, self.workerExecutable(), chunkSize)
+        for alignment, (predictedLandmarks, error) in zip(alignments, results):
+            sourceFilePath, sourceLandmarkFile, targetFilePath, outputFilePath, _ = alignment
+            if error is not None:
+                print(
+                    "::::Alignment of ", targetFilePath, " with ", sourceFilePath, " failed: ", error
+                )
+                yield None
+                continue
+            if sourceLandmarkFile not in sourceLMNodes:
+                sourceLMNodes[sourceLandmarkFile] = slicer.util.loadMarkups(
+                    sourceLandmarkFile
+                )
+                sourceLMNodes[sourceLandmarkFile].GetDisplayNode().SetVisibility(False)
+            self.saveLandmarks(
+                predictedLandmarks,
+                sourceLMNodes[sourceLandmarkFile],
+                outputFilePath,
+                projectionFactor,
+            )
+            slicer.app.processEvents()
+            yield predictedLandmarks
+        for sourceLMNode in sourceLMNodes.values():
+            slicer.mrmlScene.RemoveNode(sourceLMNode)
+
+    def workerExecutable(self):
+        """
+        Returns the PythonSlicer interpreter that runs the worker processes, the Slicer application
+        itself cannot be started as a Python interpreter. Shared with the GPA resampling pool.
+        """
+        import Support.resampling as resampling
+
+        return resampling.workerExecutable()
+
+    def cacheDirectory(self):
+        return slicer.app.cachePath
+
     def pairwiseAlignment(
         self,
         sourceFilePath,
@@ -1573,101 +1739,57 @@ class ALPACALogic(ScriptedLoadableModuleLogic):
         projectionFactor,
         parameters,
         usePoisson=False,
+        featureCacheDirectory=None,
     ):
         targetModelNode = slicer.util.loadModel(targetFilePath)
         targetModelNode.GetDisplayNode().SetVisibility(False)
         sourceModelNode = slicer.util.loadModel(sourceFilePath)
         sourceModelNode.GetDisplayNode().SetVisibility(False)
-        (
-            sourcePoints,
-            targetPoints,
-            sourceFeatures,
-            targetFeatures,
-            voxelSize,
-            scaling,
-        ) = self.runSubsample(
-            sourceModelNode, targetModelNode, skipScaling, parameters, usePoisson
-        )
-        SimilarityTransform, similarityFlag = self.estimateTransform(
-            sourcePoints,
-            targetPoints,
-            sourceFeatures,
-            targetFeatures,
-            voxelSize,
-            skipScaling,
-            parameters,
-        )
-        # Rigid
         sourceLandmarks, sourceLMNode = self.loadAndScaleFiducials(
-            sourceLandmarkFile, scaling
+            sourceLandmarkFile, 1
         )
-        sourceLandmarks = self.transform_numpy_points(
-            sourceLandmarks, SimilarityTransform
+        predictedLandmarks = self.predictLandmarks(
+            sourceModelNode.GetMesh(),
+            targetModelNode.GetMesh(),
+            sourceLandmarks,
+            skipScaling,
+            projectionFactor,
+            parameters,
+            usePoisson,
+            featureCacheDirectory,
         )
-        sourcePoints = self.transform_numpy_points(sourcePoints, SimilarityTransform)
-        vtkSimilarityTransform = self.itkToVTKTransform(
-            SimilarityTransform, similarityFlag
+        self.saveLandmarks(
+            predictedLandmarks, sourceLMNode, outputFilePath, projectionFactor
         )
+        slicer.mrmlScene.RemoveNode(sourceModelNode)
+        slicer.mrmlScene.RemoveNode(targetModelNode)
+        slicer.mrmlScene.RemoveNode(sourceLMNode)
+        return predictedLandmarks
 
-        # Deformable
-        registeredSourceLM = self.runCPDRegistration(
-            sourceLandmarks, sourcePoints, targetPoints, parameters
-        )
-        outputPoints = self.exportPointCloud(
-            registeredSourceLM, "Initial Predicted Landmarks"
-        )
+    def saveLandmarks(self, landmarks, sourceLMNode, outputFilePath, projectionFactor):
         if projectionFactor == 0:
-            self.propagateLandmarkTypes(sourceLMNode, outputPoints)
-            slicer.util.saveNode(outputPoints, outputFilePath)
-            slicer.mrmlScene.RemoveNode(outputPoints)
-            slicer.mrmlScene.RemoveNode(sourceModelNode)
-            slicer.mrmlScene.RemoveNode(targetModelNode)
-            slicer.mrmlScene.RemoveNode(sourceLMNode)
-            return registeredSourceLM
+            outputPoints = self.exportPointCloud(landmarks, "Initial Predicted Landmarks")
         else:
-            inputPoints = self.exportPointCloud(sourceLandmarks, "Original Landmarks")
-            inputPoints_vtk = self.getFiducialPoints(inputPoints)
-            outputPoints_vtk = self.getFiducialPoints(outputPoints)
+            outputPoints = self.exportPointCloud(landmarks, "Refined Predicted Landmarks")
+        self.propagateLandmarkTypes(sourceLMNode, outputPoints)
+        slicer.util.saveNode(outputPoints, outputFilePath)
+        slicer.mrmlScene.RemoveNode(outputPoints)
 
-            ICPTransformNode = self.convertMatrixToTransformNode(
-                vtkSimilarityTransform, "Rigid Transformation Matrix"
-            )
-            sourceModelNode.SetAndObserveTransformNodeID(ICPTransformNode.GetID())
-
-            deformedModelNode = self.applyTPSTransform(
-                inputPoints_vtk, outputPoints_vtk, sourceModelNode, "Warped Source Mesh"
-            )
-            deformedModelNode.GetDisplayNode().SetVisibility(False)
-
-            maxProjection = (
-                targetModelNode.GetPolyData().GetLength()
-            ) * projectionFactor
-            projectedPoints = self.projectPointsPolydata(
-                deformedModelNode.GetPolyData(),
-                targetModelNode.GetPolyData(),
-                outputPoints_vtk,
-                maxProjection,
-            )
-            projectedLMNode = slicer.mrmlScene.AddNewNodeByClass(
-                "vtkMRMLMarkupsFiducialNode", "Refined Predicted Landmarks"
-            )
-            for i in range(projectedPoints.GetNumberOfPoints()):
-                point = projectedPoints.GetPoint(i)
-                projectedLMNode.AddControlPoint(point)
-            self.propagateLandmarkTypes(sourceLMNode, projectedLMNode)
-            projectedLMNode.SetLocked(True)
-            projectedLMNode.SetFixedNumberOfControlPoints(True)
-            slicer.util.saveNode(projectedLMNode, outputFilePath)
-            slicer.mrmlScene.RemoveNode(projectedLMNode)
-            slicer.mrmlScene.RemoveNode(outputPoints)
-            slicer.mrmlScene.RemoveNode(sourceModelNode)
-            slicer.mrmlScene.RemoveNode(targetModelNode)
-            slicer.mrmlScene.RemoveNode(deformedModelNode)
-            slicer.mrmlScene.RemoveNode(sourceLMNode)
-            slicer.mrmlScene.RemoveNode(ICPTransformNode)
-            slicer.mrmlScene.RemoveNode(inputPoints)
-            np_array = vtk_np.vtk_to_numpy(projectedPoints.GetPoints().GetData())
-            return np_array
+    def runSubsample(
+        self,
+        sourceModel,
+        targetModel,
+        skipScaling,
+        parameters,
+        usePoissonSubsample=False,
+    ):
+        return self.subsampleMeshes(
+            sourceModel.GetMesh(),
+            targetModel.GetMesh(),
+            skipScaling,
+            parameters,
+            usePoissonSubsample,
+        )
 
     def exportPointCloud(self, pointCloud, nodeName):
         fiducialNode = slicer.mrmlScene.AddNewNodeByClass(
@@ -1699,47 +1821,6 @@ class ALPACALogic(ScriptedLoadableModuleLogic):
         # self.RAS2LPSTransform(warpedModelNode)
         return warpedModelNode
 
-    def runCPDRegistration(self, sourceLM, sourceSLM, targetSLM, parameters):
-        sourceArrayCombined = np.append(sourceSLM, sourceLM, axis=0)
-        targetArray = np.asarray(targetSLM)
-
-        cloudSize = np.max(targetArray, 0) - np.min(targetArray, 0)
-
-        targetArray = targetArray * 25 / cloudSize
-        sourceArrayCombined = sourceArrayCombined * 25 / cloudSize
-
-        if parameters["Acceleration"] == 0:
-            registrationOutput = self.cpd_registration(
-                targetArray,
-                sourceArrayCombined,
-                parameters["CPDIterations"],
-                parameters["CPDTolerance"],
-                parameters["alpha"],
-                parameters["beta"],
-            )
-            deformed_array, _ = registrationOutput.register()
-        else:
-            targetPath = os.path.join(slicer.app.cachePath, "target.txt")
-            sourcePath = os.path.join(slicer.app.cachePath, "source.txt")
-            np.savetxt(targetPath, targetArray, delimiter=",")
-            np.savetxt(sourcePath, sourceArrayCombined, delimiter=",")
-            path = os.path.join(parameters["BCPDFolder"], "bcpd")
-            cmd = f'"{path}" -x "{targetPath}" -y "{sourcePath}" -l{parameters["alpha"]} -b{parameters["beta"]} -g0.1 -K140 -J500 -c1e-6 -p -d7 -e0.3 -f0.3 -ux -N1'
-            cp = subprocess.run(
-                cmd, shell=True, check=True, text=True, capture_output=True
-            )
-            deformed_array = np.loadtxt("output_y.txt")
-            for fl in glob.glob("output*.txt"):
-                os.remove(fl)
-            os.remove(targetPath)
-            os.remove(sourcePath)
-        # Capture output landmarks from source pointcloud
-        fiducial_prediction = deformed_array[-len(sourceLM) :]
-
-        fiducialCloud = fiducial_prediction
-        fiducialCloud = fiducialCloud * cloudSize / 25
-        return fiducialCloud
-
     def RAS2LPSTransform(self, modelNode):
         matrix = vtk.vtkMatrix4x4()
         matrix.Identity()
@@ -1762,21 +1843,6 @@ class ALPACALogic(ScriptedLoadableModuleLogic):
                 matrix_vtk.SetElement(i, j, matrix[i][j])
         return matrix_vtk
 
-    def itkToVTKTransform(self, itkTransform, similarityFlag=False):
-        matrix = itkTransform.GetMatrix()
-        offset = itkTransform.GetOffset()
-
-        matrix_vtk = vtk.vtkMatrix4x4()
-        for i in range(3):
-            for j in range(3):
-                matrix_vtk.SetElement(i, j, matrix(i, j))
-        for i in range(3):
-            matrix_vtk.SetElement(i, 3, offset[i])
-
-        transform = vtk.vtkTransform()
-        transform.SetMatrix(matrix_vtk)
-        return transform
-
     def convertMatrixToTransformNode(self, vtkTransform, transformName):
         transformNode = slicer.mrmlScene.AddNewNodeByClass(
             "vtkMRMLTransformNode", transformName
@@ -1834,1014 +1900,6 @@ class ALPACALogic(ScriptedLoadableModuleLogic):
         modelNode.GetDisplayNode().SetColor(nodeColor)
         return modelNode
 
-    def find_knn_cpu(self, feat0, feat1, knn=1, return_distance=False):
-        from scipy.spatial import cKDTree
-
-        feat1tree = cKDTree(feat1)
-        dists, nn_inds = feat1tree.query(feat0, k=knn)
-        if return_distance:
-            return nn_inds, dists
-        else:
-            return nn_inds
-
-    def find_correspondences(self, feats0, feats1, mutual_filter=True):
-        """
-        Using the FPFH features find noisy corresspondes.
-        These corresspondes will be used inside the RANSAC.
-        """
-        nns01, dists1 = self.find_knn_cpu(feats0, feats1, knn=1, return_distance=True)
-        corres01_idx0 = np.arange(len(nns01))
-        corres01_idx1 = nns01
-
-        if not mutual_filter:
-            return corres01_idx0, corres01_idx1
-
-        nns10, dists2 = self.find_knn_cpu(feats1, feats0, knn=1, return_distance=True)
-        corres10_idx1 = np.arange(len(nns10))
-        corres10_idx0 = nns10
-
-        mutual_filter = corres10_idx0[corres01_idx1] == corres01_idx0
-        corres_idx0 = corres01_idx0[mutual_filter]
-        corres_idx1 = corres01_idx1[mutual_filter]
-
-        return corres_idx0, corres_idx1
-
-    # Returns the fitness of alignment of two pointSets
-    def get_fitness(
-        self, movingMeshPoints, fixedMeshPoints, distanceThrehold, transform=None
-    ):
-        import itk
-
-        movingPointSet = itk.Mesh.F3.New()
-        movingPointSet.SetPoints(
-            itk.vector_container_from_array(
-                movingMeshPoints.flatten().astype("float32")
-            )
-        )
-
-        fixedPointSet = itk.Mesh.F3.New()
-        fixedPointSet.SetPoints(
-            itk.vector_container_from_array(fixedMeshPoints.flatten().astype("float32"))
-        )
-
-        if transform is not None:
-            movingPointSet = itk.transform_mesh_filter(
-                movingPointSet, transform=transform
-            )
-
-        PointType = itk.Point[itk.F, 3]
-        PointsContainerType = itk.VectorContainer[itk.IT, PointType]
-        pointsLocator = itk.PointsLocator[PointsContainerType].New()
-        pointsLocator.SetPoints(fixedPointSet.GetPoints())
-        pointsLocator.Initialize()
-
-        fitness = 0
-        inlier_rmse = 0
-        for i in range(movingPointSet.GetNumberOfPoints()):
-            closestPoint = pointsLocator.FindClosestPoint(movingPointSet.GetPoint(i))
-            distance = (
-                fixedPointSet.GetPoint(closestPoint) - movingPointSet.GetPoint(i)
-            ).GetNorm()
-            if distance < distanceThrehold:
-                fitness = fitness + 1
-                inlier_rmse = inlier_rmse + distance
-
-        return fitness / movingPointSet.GetNumberOfPoints(), inlier_rmse / fitness
-
-    # RANSAC using package
-    def ransac_using_package(
-        self,
-        movingMeshPoints,
-        fixedMeshPoints,
-        movingMeshFeaturePoints,
-        fixedMeshFeaturePoints,
-        number_of_iterations,
-        number_of_ransac_points,
-        inlier_value,
-        skip_scaling,
-        check_edge_length,
-        correspondence_distance,
-    ):
-        import itk
-
-        def GenerateData(data, agreeData):
-            """
-            In current implementation the agreedata contains two corresponding
-            points from moving and fixed mesh. However, after the subsampling step the
-            number of points need not be equal in those meshes. So we randomly sample
-            the points from larger mesh.
-            """
-            data.reserve(movingMeshFeaturePoints.shape[0])
-            for i in range(movingMeshFeaturePoints.shape[0]):
-                point1 = movingMeshFeaturePoints[i]
-                point2 = fixedMeshFeaturePoints[i]
-                input_data = [
-                    point1[0],
-                    point1[1],
-                    point1[2],
-                    point2[0],
-                    point2[1],
-                    point2[2],
-                ]
-                input_data = [float(x) for x in input_data]
-                data.push_back(input_data)
-
-            count_min = int(
-                np.min([movingMeshPoints.shape[0], fixedMeshPoints.shape[0]])
-            )
-
-            mesh1_points = copy.deepcopy(movingMeshPoints)
-            mesh2_points = copy.deepcopy(fixedMeshPoints)
-
-            np.random.seed(0)
-            np.random.shuffle(mesh1_points)
-            np.random.seed(0)
-            np.random.shuffle(mesh2_points)
-
-            agreeData.reserve(count_min)
-            for i in range(count_min):
-                point1 = mesh1_points[i]
-                point2 = mesh2_points[i]
-                input_data = [
-                    point1[0],
-                    point1[1],
-                    point1[2],
-                    point2[0],
-                    point2[1],
-                    point2[2],
-                ]
-                input_data = [float(x) for x in input_data]
-                agreeData.push_back(input_data)
-            return
-
-        data = itk.vector[itk.Point[itk.D, 6]]()
-        agreeData = itk.vector[itk.Point[itk.D, 6]]()
-        GenerateData(data, agreeData)
-
-        transformParameters = itk.vector.D()
-        bestTransformParameters = itk.vector.D()
-
-        itk.MultiThreaderBase.SetGlobalDefaultThreader(
-            itk.MultiThreaderBase.ThreaderTypeFromString("POOL")
-        )
-        maximumDistance = inlier_value
-        if skip_scaling:
-            TransformType = itk.VersorRigid3DTransform[itk.D]
-            RegistrationEstimatorType = itk.Ransac.LandmarkRegistrationEstimator[
-                6, TransformType
-            ]
-        else:
-            TransformType = itk.Similarity3DTransform[itk.D]
-            RegistrationEstimatorType = itk.Ransac.LandmarkRegistrationEstimator[
-                6, TransformType
-            ]
-        registrationEstimator = RegistrationEstimatorType.New()
-        registrationEstimator.SetMinimalForEstimate(number_of_ransac_points)
-        registrationEstimator.SetAgreeData(agreeData)
-        registrationEstimator.SetDelta(maximumDistance)
-        registrationEstimator.LeastSquaresEstimate(data, transformParameters)
-
-        maxThreadCount = int(
-            itk.MultiThreaderBase.New().GetMaximumNumberOfThreads() / 2
-        )
-
-        desiredProbabilityForNoOutliers = 0.99
-        RANSACType = itk.RANSAC[itk.Point[itk.D, 6], itk.D, TransformType]
-        ransacEstimator = RANSACType.New()
-        ransacEstimator.SetData(data)
-        ransacEstimator.SetAgreeData(agreeData)
-        ransacEstimator.SetCheckCorresspondenceDistance(check_edge_length)
-        if correspondence_distance > 0:
-            ransacEstimator.SetCheckCorrespondenceEdgeLength(correspondence_distance)
-        ransacEstimator.SetMaxIteration(int(number_of_iterations / maxThreadCount))
-        ransacEstimator.SetNumberOfThreads(maxThreadCount)
-        ransacEstimator.SetParametersEstimator(registrationEstimator)
-
-        percentageOfDataUsed = ransacEstimator.Compute(
-            transformParameters, desiredProbabilityForNoOutliers
-        )
-
-        transform = TransformType.New()
-        p = transform.GetParameters()
-        f = transform.GetFixedParameters()
-        for i in range(p.GetSize()):
-            p.SetElement(i, transformParameters[i])
-        counter = 0
-        totalParameters = p.GetSize() + f.GetSize()
-        for i in range(p.GetSize(), totalParameters):
-            f.SetElement(counter, transformParameters[i])
-            counter = counter + 1
-        transform.SetParameters(p)
-        transform.SetFixedParameters(f)
-        return (
-            itk.dict_from_transform(transform),
-            percentageOfDataUsed[0],
-            percentageOfDataUsed[1],
-        )
-
-    def get_euclidean_distance(
-        self, input_fixedPoints, input_movingPoints, distance_threshold
-    ):
-        import itk
-
-        mesh_fixed = itk.Mesh[itk.D, 3].New()
-        mesh_moving = itk.Mesh[itk.D, 3].New()
-
-        mesh_fixed.SetPoints(
-            itk.vector_container_from_array(input_fixedPoints.flatten())
-        )
-        mesh_moving.SetPoints(
-            itk.vector_container_from_array(input_movingPoints.flatten())
-        )
-
-        MetricType = itk.EuclideanDistancePointSetToPointSetMetricv4.PSD3
-        metric = MetricType.New()
-        metric.SetMovingPointSet(mesh_moving)
-        metric.SetDistanceThreshold(distance_threshold)
-        metric.SetFixedPointSet(mesh_fixed)
-        metric.Initialize()
-
-        return metric.GetValue()
-
-    def get_correspondence_and_fitness(
-        self, fixedPoints, movingPoints, distanceThreshold, transform=None
-    ):
-        import itk
-
-        movingPointSet = itk.Mesh.F3.New()
-        movingPointSet.SetPoints(
-            itk.vector_container_from_array(movingPoints.flatten().astype("float32"))
-        )
-
-        fixedPointSet = itk.Mesh.F3.New()
-        fixedPointSet.SetPoints(
-            itk.vector_container_from_array(fixedPoints.flatten().astype("float32"))
-        )
-
-        if transform is not None:
-            movingPointSet = itk.transform_mesh_filter(
-                movingPointSet, transform=transform
-            )
-
-        PointType = itk.Point[itk.F, 3]
-        PointsContainerType = itk.VectorContainer[itk.IT, PointType]
-        pointsLocator = itk.PointsLocator[PointsContainerType].New()
-        pointsLocator.SetPoints(fixedPointSet.GetPoints())
-        pointsLocator.Initialize()
-
-        fixed_array = itk.VectorContainer[itk.IT, itk.Point[itk.D, 3]].New()
-        moving_array = itk.VectorContainer[itk.IT, itk.Point[itk.D, 3]].New()
-        index_array = []
-
-        fitness = 0
-        inlier_rmse = 0
-        count = 0
-        for i in range(movingPointSet.GetNumberOfPoints()):
-            closestPoint = pointsLocator.FindClosestPoint(movingPointSet.GetPoint(i))
-            distance = (
-                fixedPointSet.GetPoint(closestPoint) - movingPointSet.GetPoint(i)
-            ).GetNorm()
-            if distance < distanceThreshold:
-                fitness = fitness + 1
-                inlier_rmse = inlier_rmse + distance
-                fixed_point = fixedPointSet.GetPoint(closestPoint)
-                moving_point = movingPointSet.GetPoint(i)
-                index_array.append([closestPoint, i])
-                fixed_array.InsertElement(count, fixed_point)
-                moving_array.InsertElement(count, moving_point)
-                count = count + 1
-
-        return (
-            fixed_array,
-            moving_array,
-            fitness,
-            inlier_rmse / fitness,
-            np.array(index_array),
-        )
-
-    def final_iteration_icp(
-        self, fixedPoints, movingPoints, distanceThreshold, normalSearchRadius
-    ):
-        import itk
-        fixedPointsNormal = self.extract_pca_normal_scikit(
-            fixedPoints, normalSearchRadius
-        )
-        movingPointsNormal = self.extract_pca_normal_scikit(
-            movingPoints, normalSearchRadius
-        )
-
-        _, (T, R, t) = self.point_to_plane_icp(
-            movingPoints,
-            fixedPoints,
-            movingPointsNormal,
-            fixedPointsNormal,
-            distanceThreshold,
-        )
-
-        transform = itk.Rigid3DTransform.D.New()
-        transform.SetMatrix(itk.matrix_from_array(R), 0.000001)
-        transform.SetTranslation([t[0], t[1], t[2]])
-        return movingPoints, transform
-
-    def euler_matrix(self, ai, aj, ak):
-        """Return homogeneous rotation matrix from Euler angles and axis sequence.
-        ai, aj, ak : Euler's roll, pitch and yaw angles
-        axes : One of 24 axis sequences as string or encoded tuple
-        >>> R = euler_matrix(1, 2, 3, 'syxz')
-        >>> numpy.allclose(numpy.sum(R[0]), -1.34786452)
-        True
-        >>> R = euler_matrix(1, 2, 3, (0, 1, 0, 1))
-        """
-
-        firstaxis, parity, repetition, frame = (0, 0, 0, 0)
-        _NEXT_AXIS = [1, 2, 0, 1]
-
-        i = firstaxis
-        j = _NEXT_AXIS[i + parity]
-        k = _NEXT_AXIS[i - parity + 1]
-
-        if frame:
-            ai, ak = ak, ai
-        if parity:
-            ai, aj, ak = -ai, -aj, -ak
-
-        si, sj, sk = math.sin(ai), math.sin(aj), math.sin(ak)
-        ci, cj, ck = math.cos(ai), math.cos(aj), math.cos(ak)
-        cc, cs = ci * ck, ci * sk
-        sc, ss = si * ck, si * sk
-
-        M = np.identity(4)
-        if repetition:
-            M[i, i] = cj
-            M[i, j] = sj * si
-            M[i, k] = sj * ci
-            M[j, i] = sj * sk
-            M[j, j] = -cj * ss + cc
-            M[j, k] = -cj * cs - sc
-            M[k, i] = -sj * ck
-            M[k, j] = cj * sc + cs
-            M[k, k] = cj * cc - ss
-        else:
-            M[i, i] = cj * ck
-            M[i, j] = sj * sc - cs
-            M[i, k] = sj * cc + ss
-            M[j, i] = cj * sk
-            M[j, j] = sj * ss + cc
-            M[j, k] = sj * cs - sc
-            M[k, i] = -sj
-            M[k, j] = cj * si
-            M[k, k] = cj * ci
-        return M
-
-    def best_fit_transform_point2plane(self, A, B, normals):
-        """
-            reference: https://www.comp.nus.edu.sg/~lowkl/publications/lowk_point-to-plane_icp_techrep.pdf
-            Input:
-            A: Nx3 numpy array of corresponding points
-            B: Nx3 numpy array of corresponding points
-            normals: Nx3 numpy array of B's normal vectors
-            Returns:
-            T: (m+1)x(m+1) homogeneous transformation matrix that maps A on to B
-            R: mxm rotation matrix
-            t: mx1 translation vector
-        """
-        assert A.shape == B.shape
-        assert A.shape == normals.shape
-
-        H = []
-        b = []
-        for i in range(A.shape[0]):
-            dx = B[i, 0]
-            dy = B[i, 1]
-            dz = B[i, 2]
-            nx = normals[i, 0]
-            ny = normals[i, 1]
-            nz = normals[i, 2]
-            sx = A[i, 0]
-            sy = A[i, 1]
-            sz = A[i, 2]
-
-            _a1 = (nz * sy) - (ny * sz)
-            _a2 = (nx * sz) - (nz * sx)
-            _a3 = (ny * sx) - (nx * sy)
-
-            _a = np.array([_a1, _a2, _a3, nx, ny, nz])
-            _b = (nx * dx) + (ny * dy) + (nz * dz) - (nx * sx) - (ny * sy) - (nz * sz)
-
-            H.append(_a)
-            b.append(_b)
-
-        H = np.array(H)
-        b = np.array(b)
-
-        tr = np.dot(np.linalg.pinv(H), b)
-        T = self.euler_matrix(tr[0], tr[1], tr[2])
-        T[0, 3] = tr[3]
-        T[1, 3] = tr[4]
-        T[2, 3] = tr[5]
-
-        R = T[:3, :3]
-        t = T[:3, 3]
-
-        return T, R, t
-
-    def best_fit_transform_point2point(self, A, B):
-        """
-        Calculates the least-squares best-fit transform that maps corresponding points A to B in m spatial dimensions
-        Input:
-        A: Nxm numpy array of corresponding points
-        B: Nxm numpy array of corresponding points
-        Returns:
-        T: (m+1)x(m+1) homogeneous transformation matrix that maps A on to B
-        R: mxm rotation matrix
-        t: mx1 translation vector
-        """
-
-        assert A.shape == B.shape
-
-        # get number of dimensions
-        m = A.shape[1]
-
-        # translate points to their centroids
-        centroid_A = np.mean(A, axis=0)
-        centroid_B = np.mean(B, axis=0)
-        AA = A - centroid_A
-        BB = B - centroid_B
-
-        # rotation matrix
-        H = np.dot(AA.T, BB)
-        U, S, Vt = np.linalg.svd(H)
-        R = np.dot(Vt.T, U.T)
-
-        # special reflection case
-        if np.linalg.det(R) < 0:
-            Vt[m - 1, :] *= -1
-        R = np.dot(Vt.T, U.T)
-
-        # translation
-        t = centroid_B.T - np.dot(R, centroid_A.T)
-
-        # homogeneous transformation
-        T = np.identity(m + 1)
-        T[:m, :m] = R
-        T[:m, m] = t
-
-        return T, R, t
-
-    def nearest_neighbor(self, src, dst):
-        """
-        Find the nearest (Euclidean) neighbor in dst for each point in src
-        Input:
-            src: Nxm array of points
-            dst: Nxm array of points
-        Output:
-            distances: Euclidean distances of the nearest neighbor
-            indices: dst indices of the nearest neighbor
-        """
-            # assert src.shape == dst.shape
-        from sklearn.neighbors import NearestNeighbors
-        neigh = NearestNeighbors(n_neighbors=1, algorithm="kd_tree")
-        neigh.fit(dst)
-        distances, indices = neigh.kneighbors(src, return_distance=True)
-        return distances.ravel(), indices.ravel()
-
-    def point_to_plane_icp(
-        self,
-        src_pts,
-        dst_pts,
-        src_pt_normals,
-        dst_pt_normals,
-        dist_threshold=np.inf,
-        max_iterations=30,
-        tolerance=0.000001,
-    ):
-        """
-            The Iterative Closest Point method: finds best-fit transform that
-                maps points A on to points B
-            Input:
-                A: Nxm numpy array of source mD points
-                B: Nxm numpy array of destination mD point
-                max_iterations: exit algorithm after max_iterations
-                tolerance: convergence criteria
-            Output:
-                T: final homogeneous transformation that maps A on to B
-                MeanError: list, report each iteration's distance mean error
-        """
-        A = src_pts
-        A_normals = src_pt_normals
-        B = dst_pts
-        B_normals = dst_pt_normals
-
-        # get number of dimensions
-        m = A.shape[1]
-
-        # make points homogeneous, copy them to maintain the originals
-        src = np.ones((m + 1, A.shape[0]))
-        dst = np.ones((m + 1, B.shape[0]))
-        src[:m, :] = np.copy(A.T)
-        dst[:m, :] = np.copy(B.T)
-
-        prev_error = 0
-        MeanError = []
-
-        finalT = np.identity(4)
-
-        for i in range(max_iterations):
-            # find the nearest neighbors between the current source and destination points
-            distances, indices = self.nearest_neighbor(src[:m, :].T, dst[:m, :].T)
-
-            # match each point of source-set to closest point of destination-set,
-            matched_src_pts = src[:m, :].T.copy()
-            matched_dst_pts = dst[:m, indices].T
-
-            # compute angle between 2 matched vertexs' normals
-            matched_src_pt_normals = A_normals.copy()
-            matched_dst_pt_normals = B_normals[indices, :]
-            angles = np.zeros(matched_src_pt_normals.shape[0])
-            for k in range(matched_src_pt_normals.shape[0]):
-                v1 = matched_src_pt_normals[k, :]
-                v2 = matched_dst_pt_normals[k, :]
-                cos_angle = v1.dot(v2) / (np.linalg.norm(v1) * np.linalg.norm(v2))
-                angles[k] = np.arccos(cos_angle) / np.pi * 180
-
-            # and reject the bad corresponding
-            # dist_threshold = np.inf
-            dist_bool_flag = distances < dist_threshold
-            angle_threshold = 20
-            angle_bool_flag = angles < angle_threshold
-            reject_part_flag = dist_bool_flag  # * angle_bool_flag
-
-            # get matched vertices and dst_vertexes' normals
-            matched_src_pts = matched_src_pts[reject_part_flag, :]
-            matched_dst_pts = matched_dst_pts[reject_part_flag, :]
-            matched_dst_pt_normals = matched_dst_pt_normals[reject_part_flag, :]
-
-            # compute the transformation between the current source and nearest destination points
-            T, _, _ = self.best_fit_transform_point2plane(
-                matched_src_pts, matched_dst_pts, matched_dst_pt_normals
-            )
-
-            finalT = np.dot(T, finalT)
-
-            # update the current source
-            src = np.dot(T, src)
-
-            # print iteration
-            # print('\ricp iteration: %d/%d ...' % (i+1, max_iterations), end='', flush=True)
-
-            # check error
-            mean_error = np.mean(distances[reject_part_flag])
-            MeanError.append(mean_error)
-            if tolerance is not None:
-                if np.abs(prev_error - mean_error) < tolerance:
-                    break
-            prev_error = mean_error
-        print("Refinement took ", i, " iterations")
-        # calculate final transformation
-        # T, R, t = self.best_fit_transform_point2point(A, src[:m, :].T)
-        # return MeanError, (T, R, t)
-        return MeanError, (finalT, finalT[:3, :3], finalT[:, 3])
-
-    def get_numpy_points_from_vtk(self, vtk_polydata):
-        """
-        Returns the points as numpy from a vtk_polydata
-        """
-        import vtk
-        from vtk.util import numpy_support
-
-        points = vtk_polydata.GetPoints()
-        pointdata = points.GetData()
-        points_as_numpy = numpy_support.vtk_to_numpy(pointdata)
-        return points_as_numpy
-
-    def transform_points_in_vtk(self, vtk_polydata, itk_transform):
-        points_as_numpy = self.get_numpy_points_from_vtk(vtk_polydata)
-        transformed_points = self.transform_numpy_points(points_as_numpy, itk_transform)
-        self.set_numpy_points_in_vtk(vtk_polydata, transformed_points)
-        return vtk_polydata
-
-    def transform_numpy_points(self, points_np, transform):
-        import itk
-
-        mesh = itk.Mesh[itk.F, 3].New()
-        mesh.SetPoints(
-            itk.vector_container_from_array(points_np.flatten().astype("float32"))
-        )
-        transformed_mesh = itk.transform_mesh_filter(mesh, transform=transform)
-        points_tranformed = itk.array_from_vector_container(
-            transformed_mesh.GetPoints()
-        )
-        points_tranformed = np.reshape(points_tranformed, [-1, 3])
-        return points_tranformed
-
-    def estimateTransform(
-        self,
-        sourcePoints,
-        targetPoints,
-        sourceFeatures,
-        targetFeatures,
-        voxelSize,
-        skipScaling,
-        parameters,
-    ):
-        import itk
-
-        similarityFlag = False
-        # Establish correspondences by nearest neighbour search in feature space
-        corrs_A, corrs_B = self.find_correspondences(
-            targetFeatures, sourceFeatures, mutual_filter=True
-        )
-
-        targetPoints = targetPoints.T
-        sourcePoints = sourcePoints.T
-
-        fixed_corr = targetPoints[:, corrs_A]  # np array of size 3 by num_corrs
-        moving_corr = sourcePoints[:, corrs_B]  # np array of size 3 by num_corrs
-
-        num_corrs = fixed_corr.shape[1]
-        print(f"FPFH generates {num_corrs} putative correspondences.")
-
-        targetPoints = targetPoints.T
-        sourcePoints = sourcePoints.T
-
-        # Check corner case when both meshes are same
-        if np.allclose(fixed_corr, moving_corr):
-            print("Same meshes therefore returning Identity Transform")
-            transform = itk.VersorRigid3DTransform[itk.D].New()
-            transform.SetIdentity()
-            return [transform, transform]
-
-        import time
-
-        bransac = time.time()
-
-        maxAttempts = 1
-        attempt = 0
-        best_fitness = -1
-        best_rmse = np.Inf
-        while attempt < maxAttempts:
-            # Perform Initial alignment using Ransac parallel iterations with no scaling
-            transform_matrix, fitness, rmse = self.ransac_using_package(
-                movingMeshPoints=sourcePoints,
-                fixedMeshPoints=targetPoints,
-                movingMeshFeaturePoints=moving_corr.T,
-                fixedMeshFeaturePoints=fixed_corr.T,
-                number_of_iterations=parameters["maxRANSAC"],
-                number_of_ransac_points=3,
-                inlier_value=float(parameters["distanceThreshold"]) * voxelSize,
-                skip_scaling=True,
-                check_edge_length=True,
-                correspondence_distance=0.9,
-            )
-
-            transform = itk.transform_from_dict(transform_matrix)
-            fitness_forward, rmse_forward = self.get_fitness(
-                sourcePoints,
-                targetPoints,
-                float(parameters["distanceThreshold"]) * voxelSize,
-                transform,
-            )
-
-            mean_fitness = fitness_forward
-            mean_rmse = rmse_forward
-            print(
-                "Non-Scaling Attempt = ",
-                attempt,
-                " Fitness = ",
-                mean_fitness,
-                " RMSE is ",
-                mean_rmse,
-            )
-
-            if mean_fitness > 0.99:
-                # Only compare RMSE if mean_fitness is greater than 0.99
-                if mean_rmse < best_rmse:
-                    best_fitness = mean_fitness
-                    best_rmse = mean_rmse
-                    best_transform = transform_matrix
-            else:
-                if mean_fitness > best_fitness:
-                    best_fitness = mean_fitness
-                    best_rmse = mean_rmse
-                    best_transform = transform_matrix
-
-            # Rigid Transform is un-fit for this use-case so perform scaling based RANSAC
-            # if mean_fitness < 0.9:
-            #  break
-            attempt = attempt + 1
-
-        print("Best Fitness without Scaling ", best_fitness, " RMSE is ", best_rmse)
-
-        if not skipScaling:
-            maxAttempts = 10
-            attempt = 0
-
-            correspondence_distance = 0.9
-            ransac_points = 3
-            ransac_iterations = int(parameters["maxRANSAC"])
-
-            while mean_fitness < 0.99 and attempt < maxAttempts:
-                transform_matrix, fitness, rmse = self.ransac_using_package(
-                    movingMeshPoints=sourcePoints,
-                    fixedMeshPoints=targetPoints,
-                    movingMeshFeaturePoints=moving_corr.T,
-                    fixedMeshFeaturePoints=fixed_corr.T,
-                    number_of_iterations=ransac_iterations,
-                    number_of_ransac_points=ransac_points,
-                    inlier_value=float(parameters["distanceThreshold"]) * voxelSize,
-                    skip_scaling=False,
-                    check_edge_length=False,
-                    correspondence_distance=correspondence_distance,
-                )
-
-                transform = itk.transform_from_dict(transform_matrix)
-                fitness_forward, rmse_forward = self.get_fitness(
-                    sourcePoints,
-                    targetPoints,
-                    float(parameters["distanceThreshold"]) * voxelSize,
-                    transform,
-                )
-
-                mean_fitness = fitness_forward
-                mean_rmse = rmse_forward
-                print(
-                    "Scaling Attempt = ",
-                    attempt,
-                    " Fitness = ",
-                    mean_fitness,
-                    " RMSE = ",
-                    mean_rmse,
-                )
-
-                if (mean_fitness > best_fitness) or (
-                    mean_fitness == best_fitness and mean_rmse < best_rmse
-                ):
-                    best_fitness = mean_fitness
-                    best_rmse = mean_rmse
-                    best_transform = transform_matrix
-                    similarityFlag = True
-                attempt = attempt + 1
-
-        aransac = time.time()
-        print("RANSAC Duraction ", aransac - bransac)
-        print("Best Fitness after scaling ", best_fitness)
-
-        first_transform = itk.transform_from_dict(best_transform)
-        sourcePoints = self.transform_numpy_points(sourcePoints, first_transform)
-
-        print("-----------------------------------------------------------")
-        print(parameters)
-        print("Starting Rigid Refinement")
-        distanceThreshold = parameters["ICPDistanceThreshold"] * voxelSize
-        inlier, rmse = self.get_fitness(sourcePoints, targetPoints, distanceThreshold)
-        print("Before Inlier = ", inlier, " RMSE = ", rmse)
-        _, second_transform = self.final_iteration_icp(
-            targetPoints,
-            sourcePoints,
-            distanceThreshold,
-            float(parameters["normalSearchRadius"] * voxelSize),
-        )
-
-        final_mesh_points = self.transform_numpy_points(sourcePoints, second_transform)
-        inlier, rmse = self.get_fitness(
-            final_mesh_points, targetPoints, distanceThreshold
-        )
-        print("After Inlier = ", inlier, " RMSE = ", rmse)
-        first_transform.Compose(second_transform)
-        return first_transform, similarityFlag
-
-    def set_numpy_points_in_vtk(self, vtk_polydata, points_as_numpy):
-        """
-        Sets the numpy points to a vtk_polydata
-        """
-        import vtk
-        from vtk.util import numpy_support
-
-        vtk_data_array = numpy_support.numpy_to_vtk(
-            num_array=points_as_numpy, deep=True, array_type=vtk.VTK_FLOAT
-        )
-        points2 = vtk.vtkPoints()
-        points2.SetData(vtk_data_array)
-        vtk_polydata.SetPoints(points2)
-        return
-
-    def get_numpy_points_from_vtk(self, vtk_polydata):
-        import vtk
-        from vtk.util import numpy_support
-
-        """
-    Returns the points as numpy from a vtk_polydata
-    """
-        points = vtk_polydata.GetPoints()
-        pointdata = points.GetData()
-        points_as_numpy = numpy_support.vtk_to_numpy(pointdata)
-        return points_as_numpy
-
-    def subsample_points_poisson(self, inputMesh, radius):
-        """
-        Return sub-sampled points as numpy array.
-        The radius might need to be tuned as per the requirements.
-        """
-        import vtk
-        from vtk.util import numpy_support
-
-        f = vtk.vtkPoissonDiskSampler()
-        f.SetInputData(inputMesh)
-        f.SetRadius(radius)
-        f.Update()
-
-        sampled_points = f.GetOutput()
-        return sampled_points
-
-    def subsample_points_voxelgrid_polydata(
-        self, inputMesh, boxLength, radius, divisions=None
-    ):
-        subsample = vtk.vtkVoxelGrid()
-        subsample.SetInputData(inputMesh)
-        subsample.SetConfigurationStyleToLeafSize()
-
-        subsample.SetLeafSize(radius, radius, radius)
-        subsample.Update()
-        points = subsample.GetOutput()
-        return points
-
-    def extract_pca_normal_scikit(self, inputPoints, searchRadius):
-        from sklearn.neighbors import KDTree
-        from sklearn.decomposition import PCA
-
-        data = inputPoints
-        tree = KDTree(data, metric="minkowski")  # minkowki is p2 (euclidean)
-
-        # Get indices and distances:
-        ind, dist = tree.query_radius(data, r=searchRadius, return_distance=True)
-
-        def PCA_unit_vector(array, pca=PCA(n_components=3)):
-            pca.fit(array)
-            eigenvalues = pca.explained_variance_
-            return pca.components_[np.argmin(eigenvalues)]
-
-        def calc_angle_with_xy(vectors):
-            l = np.sum(vectors[:, :2] ** 2, axis=1) ** 0.5
-            return np.arctan2(vectors[:, 2], l)
-
-        normals2 = []
-        for i in range(data.shape[0]):
-            if len(ind[i]) < 3:
-                normal_vector = np.identity(3)
-            else:
-                normal_vector = data[ind[i]]
-            normals2.append(PCA_unit_vector(normal_vector))
-
-        n = np.array(normals2)
-        n[calc_angle_with_xy(n) < 0] *= -1
-        return n
-
-    def extract_pca_normal(self, mesh, normalNeighbourCount):
-        import vtk
-        from vtk.util import numpy_support
-
-        normals = vtk.vtkPCANormalEstimation()
-        normals.SetSampleSize(normalNeighbourCount)
-        # normals.SetFlipNormals(True)
-        normals.SetNormalOrientationToPoint()
-        # normals.SetNormalOrientationToGraphTraversal()
-        normals.SetInputData(mesh)
-        normals.Update()
-        out1 = normals.GetOutput()
-        normal_array = numpy_support.vtk_to_numpy(out1.GetPoints().GetData())
-        point_array = numpy_support.vtk_to_numpy(mesh.GetPoints().GetData())
-        return point_array, normal_array
-
-    def get_fpfh_feature(self, points_np, normals_np, radius, neighbors):
-        import itk
-
-        pointset = itk.PointSet[itk.F, 3].New()
-        pointset.SetPoints(
-            itk.vector_container_from_array(points_np.flatten().astype("float32"))
-        )
-
-        normalset = itk.PointSet[itk.F, 3].New()
-        normalset.SetPoints(
-            itk.vector_container_from_array(normals_np.flatten().astype("float32"))
-        )
-        fpfh = itk.Fpfh.PointFeature.MF3MF3.New()
-        fpfh.ComputeFPFHFeature(pointset, normalset, float(radius), int(neighbors))
-        result = fpfh.GetFpfhFeature()
-
-        fpfh_feats = itk.array_from_vector_container(result)
-        fpfh_feats = np.reshape(fpfh_feats, [33, pointset.GetNumberOfPoints()]).T
-        return fpfh_feats
-
-    def getBoxLengths(self, inputMesh):
-        import vtk
-
-        box_filter = vtk.vtkBoundingBox()
-        box_filter.SetBounds(inputMesh.GetBounds())
-        diagonalLength = box_filter.GetDiagonalLength()
-        fixedLengths = [0.0, 0.0, 0.0]
-        box_filter.GetLengths(fixedLengths)
-        return fixedLengths, diagonalLength
-
-    def runSubsample(
-        self,
-        sourceModel,
-        targetModel,
-        skipScaling,
-        parameters,
-        usePoissonSubsample=False,
-    ):
-        import vtk
-        from vtk.util import numpy_support
-
-        print("parameters are ", parameters)
-        print(":: Loading point clouds and downsampling")
-
-        sourceModelMesh = sourceModel.GetMesh()
-        targetModelMesh = targetModel.GetMesh()
-
-        vtk_meshes = []
-        vtk_meshes.append(targetModelMesh)
-        vtk_meshes.append(sourceModelMesh)
-
-        # Scale the mesh and the landmark points
-        fixedBoxLengths, fixedlength = self.getBoxLengths(vtk_meshes[0])
-        movingBoxLengths, movinglength = self.getBoxLengths(vtk_meshes[1])
-
-        # Sub-Sample the points for rigid refinement and deformable registration
-        point_density = parameters["pointDensity"]
-
-        # Voxel size is the diagonal length of cuboid in the voxelGrid
-        voxel_size = np.sqrt(np.sum(np.square(np.array(fixedBoxLengths)))) / (
-            55 * point_density
-        )
-
-        print("Scale length are  ", fixedlength, movinglength)
-        print("Voxel Size is ", voxel_size)
-
-        scaling = fixedlength / movinglength
-
-        points = vtk_meshes[1].GetPoints()
-        pointdata = points.GetData()
-        points_as_numpy = numpy_support.vtk_to_numpy(pointdata)
-
-        if skipScaling != 0:
-            scaling = 1
-            print("Scaling factor is ", scaling)
-        points_as_numpy = points_as_numpy * scaling
-        self.set_numpy_points_in_vtk(vtk_meshes[1], points_as_numpy)
-
-        sourceFullMesh_vtk = vtk_meshes[1]
-        targetFullMesh_vtk = vtk_meshes[0]
-
-        if usePoissonSubsample:
-            print("Using Poisson Point Subsampling Method")
-            sourceMesh_vtk = self.subsample_points_poisson(
-                sourceFullMesh_vtk, radius=voxel_size
-            )
-            targetMesh_vtk = self.subsample_points_poisson(
-                targetFullMesh_vtk, radius=voxel_size
-            )
-        else:
-            sourceMesh_vtk = self.subsample_points_voxelgrid_polydata(
-                sourceFullMesh_vtk, boxLength=movingBoxLengths, radius=voxel_size
-            )
-            targetMesh_vtk = self.subsample_points_voxelgrid_polydata(
-                targetFullMesh_vtk, boxLength=fixedBoxLengths, radius=voxel_size
-            )
-
-        movingMeshPoints, movingMeshPointNormals = self.extract_pca_normal(
-            sourceMesh_vtk, 30
-        )
-        fixedMeshPoints, fixedMeshPointNormals = self.extract_pca_normal(
-            targetMesh_vtk, 30
-        )
-
-        print("------------------------------------------------------------")
-        print("movingMeshPoints.shape ", movingMeshPoints.shape)
-        print("movingMeshPointNormals.shape ", movingMeshPointNormals.shape)
-        print("fixedMeshPoints.shape ", fixedMeshPoints.shape)
-        print("fixedMeshPointNormals.shape ", fixedMeshPointNormals.shape)
-        print("------------------------------------------------------------")
-
-        fpfh_radius = parameters["FPFHSearchRadius"] * voxel_size
-        fpfh_neighbors = parameters["FPFHNeighbors"]
-        # New FPFH Code
-        pcS = np.expand_dims(fixedMeshPoints, -1)
-        normal_np_pcl = fixedMeshPointNormals
-        target_fpfh = self.get_fpfh_feature(
-            pcS, normal_np_pcl, fpfh_radius, fpfh_neighbors
-        )
-
-        pcS = np.expand_dims(movingMeshPoints, -1)
-        normal_np_pcl = movingMeshPointNormals
-        source_fpfh = self.get_fpfh_feature(
-            pcS, normal_np_pcl, fpfh_radius, fpfh_neighbors
-        )
-
-        target_down = fixedMeshPoints
-        source_down = movingMeshPoints
-        return source_down, target_down, source_fpfh, target_fpfh, voxel_size, scaling
-
     def loadAndScaleFiducials(self, fiducial, scaling, scene=False):
         if not scene:
             sourceLandmarkNode = slicer.util.loadMarkups(fiducial)
@@ -2887,30 +1945,6 @@ class ALPACALogic(ScriptedLoadableModuleLogic):
         dz = fnx(a[:, 2])
         return (dx ** 2.0 + dy ** 2.0 + dz ** 2.0) ** 0.5
 
-    def cpd_registration(
-        self,
-        targetArray,
-        sourceArray,
-        CPDIterations,
-        CPDTolerance,
-        alpha_parameter,
-        beta_parameter,
-    ):
-        from cpdalp import DeformableRegistration
-
-        output = DeformableRegistration(
-            **{
-                "X": targetArray,
-                "Y": sourceArray,
-                "max_iterations": CPDIterations,
-                "tolerance": CPDTolerance,
-                "low_rank": True,
-            },
-            alpha=alpha_parameter,
-            beta=beta_parameter,
-        )
-        return output
-
     def getFiducialPoints(self, fiducialNode):
         points = vtk.vtkPoints()
         for i in range(fiducialNode.GetNumberOfControlPoints()):
@@ -2940,82 +1974,6 @@ class ALPACALogic(ScriptedLoadableModuleLogic):
         projectedLMNode.SetFixedNumberOfControlPoints(True)
         return projectedLMNode
 
-    def projectPointsPolydata(
-        self, sourcePolydata, targetPolydata, originalPoints, rayLength
-    ):
-        import vtk
-
-        print("original points: ", originalPoints.GetNumberOfPoints())
-        # set up polydata for projected points to return
-        projectedPointData = vtk.vtkPolyData()
-        projectedPoints = vtk.vtkPoints()
-        projectedPointData.SetPoints(projectedPoints)
-
-        # set up locater for intersection with normal vector rays
-        obbTree = vtk.vtkOBBTree()
-        obbTree.SetDataSet(targetPolydata)
-        obbTree.BuildLocator()
-
-        # set up point locator for finding surface normals and closest point
-        pointLocator = vtk.vtkPointLocator()
-        pointLocator.SetDataSet(sourcePolydata)
-        pointLocator.BuildLocator()
-
-        targetPointLocator = vtk.vtkPointLocator()
-        targetPointLocator.SetDataSet(targetPolydata)
-        targetPointLocator.BuildLocator()
-
-        # get surface normal from each landmark point
-        rayDirection = [0, 0, 0]
-        normalArray = sourcePolydata.GetPointData().GetArray("Normals")
-        if not normalArray:
-            print("no normal array, calculating....")
-            normalFilter = vtk.vtkPolyDataNormals()
-            normalFilter.ComputePointNormalsOn()
-            normalFilter.SetInputData(sourcePolydata)
-            normalFilter.Update()
-            normalArray = normalFilter.GetOutput().GetPointData().GetArray("Normals")
-            if not normalArray:
-                print("Error: no normal array")
-                return projectedPointData
-        for index in range(originalPoints.GetNumberOfPoints()):
-            originalPoint = originalPoints.GetPoint(index)
-            # get ray direction from closest normal
-            closestPointId = pointLocator.FindClosestPoint(originalPoint)
-            rayDirection = normalArray.GetTuple(closestPointId)
-            rayEndPoint = [0, 0, 0]
-            for dim in range(len(rayEndPoint)):
-                rayEndPoint[dim] = originalPoint[dim] + rayDirection[dim] * rayLength
-            intersectionIds = vtk.vtkIdList()
-            intersectionPoints = vtk.vtkPoints()
-            obbTree.IntersectWithLine(
-                originalPoint, rayEndPoint, intersectionPoints, intersectionIds
-            )
-            # if there are intersections, update the point to most external one.
-            if intersectionPoints.GetNumberOfPoints() > 0:
-                exteriorPoint = intersectionPoints.GetPoint(
-                    intersectionPoints.GetNumberOfPoints() - 1
-                )
-                projectedPoints.InsertNextPoint(exteriorPoint)
-            # if there are no intersections, reverse the normal vector
-            else:
-                for dim in range(len(rayEndPoint)):
-                    rayEndPoint[dim] = (
-                        originalPoint[dim] + rayDirection[dim] * -rayLength
-                    )
-                obbTree.IntersectWithLine(
-                    originalPoint, rayEndPoint, intersectionPoints, intersectionIds
-                )
-                if intersectionPoints.GetNumberOfPoints() > 0:
-                    exteriorPoint = intersectionPoints.GetPoint(0)
-                    projectedPoints.InsertNextPoint(exteriorPoint)
-                # if none in reverse direction, use closest mesh point
-                else:
-                    closestPointId = targetPointLocator.FindClosestPoint(originalPoint)
-                    rayOrigin = targetPolydata.GetPoint(closestPointId)
-                    projectedPoints.InsertNextPoint(rayOrigin)
-        return projectedPointData
-
     def takeScreenshot(self, name, description, type=-1):
         # show the message even if not taking a screen shot
         slicer.util.delayDisplay(
@@ -3234,7 +2192,7 @@ class ALPACALogic(ScriptedLoadableModuleLogic):
         LM.calcEigen()
         import Support.gpa_lib as gpa_lib
 
-        twoDcoors = gpa_lib.makeTwoDim(LM.lmOrig)
+        twoDcoors = gpa_lib.makeTwoDim(LM.lm)
         scores = np.dot(np.transpose(twoDcoors), LM.vec)
         scores = np.real(scores)
         size = scores.shape[0] - 1
@@ -3628,6 +2586,18 @@ class ALPACATest(ScriptedLoadableModuleTest):
         """Run as few or as many tests as needed here."""
         self.setUp()
         self.test_ALPACA1()
+        self.setUp()
+        self.test_ALPACABatchReaders()
+        self.setUp()
+        self.test_ALPACAFeatureCache()
+        self.setUp()
+        self.test_ALPACAFitness()
+        self.test_ALPACAFitnessBenchmark()
+        self.setUp()
+        self.test_ALPACAPointToPlaneICP()
+        self.setUp()
+        self.test_ALPACANormals()
+        self.test_ALPACANormalsBenchmark()
 
     def test_ALPACA1(self):
         """Ideally you should have several levels of tests.  At the lowest level
@@ -3659,3 +2629,303 @@ class ALPACATest(ScriptedLoadableModuleTest):
         self.assertEqual(outputScalarRange[1], inputScalarRange[1])
 
         self.delayDisplay("Test passed")
+
+    def test_ALPACABatchReaders(self):
+        """The worker processes must read models and landmarks in the same coordinates as Slicer."""
+        import tempfile
+        from ALPACALib import batch
+
+        self.delayDisplay("Starting the batch reader test")
+        sphere = vtk.vtkSphereSource()
+        sphere.SetCenter(10, 20, 30)
+        sphere.Update()
+        modelNode = slicer.modules.models.logic().AddModel(sphere.GetOutput())
+        landmarkNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode")
+        landmarkNode.AddControlPoint([10, 20, 31])
+        landmarkNode.AddControlPoint([9, 20, 30])
+        with tempfile.TemporaryDirectory() as directory:
+            for modelExtension in [".ply", ".vtk", ".obj"]:
+                modelPath = os.path.join(directory, "sphere" + modelExtension)
+                slicer.util.saveNode(modelNode, modelPath)
+                loadedNode = slicer.util.loadModel(modelPath)
+                self.assertTrue(
+                    np.allclose(
+                        vtk_np.vtk_to_numpy(batch.readModel(modelPath).GetPoints().GetData()),
+                        slicer.util.arrayFromModelPoints(loadedNode),
+                        atol=1e-4,
+                    )
+                )
+                slicer.mrmlScene.RemoveNode(loadedNode)
+            for landmarkExtension in [".mrk.json", ".fcsv"]:
+                landmarkPath = os.path.join(directory, "landmarks" + landmarkExtension)
+                slicer.util.saveNode(landmarkNode, landmarkPath)
+                loadedNode = slicer.util.loadMarkups(landmarkPath)
+                self.assertTrue(
+                    np.allclose(
+                        batch.readLandmarks(landmarkPath),
+                        slicer.util.arrayFromMarkupsControlPoints(loadedNode),
+                    )
+                )
+                slicer.mrmlScene.RemoveNode(loadedNode)
+        self.delayDisplay("Test passed")
+
+    def test_ALPACAFeatureCache(self):
+        """Repeated subsampling of the same meshes must come from the feature cache and give the same results."""
+        import tempfile
+        from ALPACALib import pipeline
+
+        self.delayDisplay("Starting the feature cache test")
+        logic = ALPACALogic()
+        parameters = {"pointDensity": 1, "FPFHSearchRadius": 5, "FPFHNeighbors": 100}
+        source = vtk.vtkSphereSource()
+        source.SetThetaResolution(60)
+        source.SetPhiResolution(60)
+        source.Update()
+        target = vtk.vtkSphereSource()
+        target.SetRadius(2)
+        target.Update()
+
+        def subsample(cacheDirectory):
+            sourceMesh = vtk.vtkPolyData()
+            sourceMesh.DeepCopy(source.GetOutput())
+            return logic.subsampleMeshes(
+                sourceMesh, target.GetOutput(), 0, parameters, featureCacheDirectory=cacheDirectory
+            )
+
+        with tempfile.TemporaryDirectory() as cacheDirectory:
+            pipeline._featureCache.clear()
+            first = subsample(cacheDirectory)
+            self.assertEqual(len(pipeline._featureCache), 2)
+            self.assertEqual(len(os.listdir(cacheDirectory)), 2)
+            second = subsample(cacheDirectory)
+            self.assertTrue(all(a is b for a, b in zip(first[:4], second[:4])))
+            # a new process only has the entries on disk
+            pipeline._featureCache.clear()
+            third = subsample(cacheDirectory)
+            for a, b in zip(first[:4], third[:4]):
+                self.assertTrue(np.array_equal(a, b))
+            # pruning removes the least recently used entries, clearing removes all
+            entryPaths = sorted(os.path.join(cacheDirectory, name) for name in os.listdir(cacheDirectory))
+            for age, entryPath in enumerate(entryPaths):
+                os.utime(entryPath, ns=(age, age))
+            pipeline.pruneFeatureCache(cacheDirectory, os.path.getsize(entryPaths[1]))
+            self.assertEqual(os.listdir(cacheDirectory), [os.path.basename(entryPaths[1])])
+            pipeline.clearFeatureCache(cacheDirectory)
+            self.assertEqual(os.listdir(cacheDirectory), [])
+            self.assertEqual(len(pipeline._featureCache), 0)
+        pipeline._featureCache.clear()
+        self.delayDisplay("Test passed")
+
+    def test_ALPACAFitness(self):
+        """The KD-tree fitness and correspondences must match a brute force nearest neighbour search."""
+        self.delayDisplay("Starting the fitness test")
+        logic = ALPACALogic()
+        rng = np.random.default_rng(0)
+        movingPoints = rng.random((2000, 3))
+        fixedPoints = rng.random((1500, 3))
+        distances = np.linalg.norm(
+            movingPoints.astype(np.float32)[:, np.newaxis] - fixedPoints.astype(np.float32)[np.newaxis],
+            axis=2,
+        )
+        closest = distances.argmin(axis=1)
+        closestDistances = distances.min(axis=1)
+        inliers = closestDistances < 0.03
+        fitness, rmse = logic.get_fitness(movingPoints, fixedPoints, 0.03)
+        self.assertAlmostEqual(fitness, inliers.mean())
+        self.assertAlmostEqual(rmse, closestDistances[inliers].mean(), places=6)
+        fixedInliers, movingInliers, inlierNumber, rmse, indices = logic.get_correspondence_and_fitness(
+            fixedPoints, movingPoints, 0.03
+        )
+        self.assertEqual(inlierNumber, inliers.sum())
+        self.assertTrue(np.array_equal(indices[:, 0], closest[inliers]))
+        self.assertTrue(np.array_equal(indices[:, 1], np.flatnonzero(inliers)))
+        self.assertTrue(np.allclose(fixedInliers, fixedPoints[closest[inliers]], atol=1e-6))
+        self.assertTrue(np.allclose(movingInliers, movingPoints[inliers], atol=1e-6))
+        self.assertEqual(logic.get_fitness(movingPoints, fixedPoints + 10, 0.03), (0.0, np.inf))
+        self.delayDisplay("Test passed")
+
+    def test_ALPACAFitnessBenchmark(self):
+        """Time the batched fitness evaluation, and the point by point ITK search it replaced at the smallest size."""
+        import itk
+
+        def pointsLocatorFitness(movingPoints, fixedPoints, distanceThreshold):
+            # the earlier get_fitness: one PointsLocator query per moving point
+            movingPointSet = itk.Mesh.F3.New()
+            movingPointSet.SetPoints(
+                itk.vector_container_from_array(movingPoints.flatten().astype("float32"))
+            )
+            fixedPointSet = itk.Mesh.F3.New()
+            fixedPointSet.SetPoints(
+                itk.vector_container_from_array(fixedPoints.flatten().astype("float32"))
+            )
+            PointType = itk.Point[itk.F, 3]
+            PointsContainerType = itk.VectorContainer[itk.IT, PointType]
+            pointsLocator = itk.PointsLocator[PointsContainerType].New()
+            pointsLocator.SetPoints(fixedPointSet.GetPoints())
+            pointsLocator.Initialize()
+            fitness = 0
+            inlier_rmse = 0
+            for i in range(movingPointSet.GetNumberOfPoints()):
+                closestPoint = pointsLocator.FindClosestPoint(movingPointSet.GetPoint(i))
+                distance = (
+                    fixedPointSet.GetPoint(closestPoint) - movingPointSet.GetPoint(i)
+                ).GetNorm()
+                if distance < distanceThreshold:
+                    fitness = fitness + 1
+                    inlier_rmse = inlier_rmse + distance
+            return fitness / movingPointSet.GetNumberOfPoints(), inlier_rmse / fitness
+
+        self.delayDisplay("Starting the fitness benchmark")
+        logic = ALPACALogic()
+        rng = np.random.default_rng(0)
+        for pointNumber in [10000, 100000, 1000000]:
+            movingPoints = rng.random((pointNumber, 3))
+            fixedPoints = rng.random((pointNumber, 3))
+            startTime = time.time()
+            fitness, inlier_rmse = logic.get_fitness(movingPoints, fixedPoints, 0.01)
+            batchTime = time.time() - startTime
+            message = f"Fitness of {pointNumber} points: batched {batchTime:.3f}s"
+            if pointNumber == 10000:
+                startTime = time.time()
+                locatorFitness, locatorRMSE = pointsLocatorFitness(movingPoints, fixedPoints, 0.01)
+                message += f", ITK PointsLocator loop {time.time() - startTime:.3f}s"
+                self.assertAlmostEqual(fitness, locatorFitness, places=3)
+            logging.info(message)
+        self.delayDisplay("Benchmark complete")
+
+    def test_ALPACAPointToPlaneICP(self):
+        """Point to plane ICP must recover a small rigid motion between samples of an ellipsoid."""
+        self.delayDisplay("Starting the point to plane ICP test")
+        logic = ALPACALogic()
+        rng = np.random.default_rng(0)
+        axes = np.array([1, 1.5, 2])
+
+        def ellipsoid(pointNumber):
+            directions = rng.normal(size=(pointNumber, 3))
+            points = directions / np.linalg.norm(directions, axis=1, keepdims=True) * axes
+            normals = points / axes ** 2
+            return points, normals / np.linalg.norm(normals, axis=1, keepdims=True)
+
+        targetPoints, targetNormals = ellipsoid(20000)
+        sourcePoints, sourceNormals = ellipsoid(15000)
+        angle = 0.1
+        rotation = np.array(
+            [[np.cos(angle), -np.sin(angle), 0], [np.sin(angle), np.cos(angle), 0], [0, 0, 1]]
+        )
+        translation = np.array([0.05, 0.02, -0.03])
+        movedPoints = sourcePoints @ rotation.T + translation
+        movedNormals = sourceNormals @ rotation.T
+        # a threshold below the initial rotation only keeps the aligned matches if
+        # the source normals are rotated along with the points
+        for angleThreshold in [None, 20, 4]:
+            telemetry = []
+            meanError, (T, R, t) = logic.point_to_plane_icp(
+                movedPoints,
+                targetPoints,
+                movedNormals,
+                targetNormals,
+                0.5,
+                angle_threshold=angleThreshold,
+                plateau_tolerance=1e-3,
+                telemetry=telemetry,
+            )
+            self.assertEqual(len(telemetry), len(meanError))
+            self.assertTrue(telemetry[-1]["meanError"] < telemetry[0]["meanError"])
+            self.assertTrue(np.allclose(R @ rotation, np.identity(3), atol=0.01))
+            self.assertTrue(np.allclose(R @ translation + t[:3], 0, atol=0.01))
+            self.assertTrue(telemetry[-1]["fitness"] > 0.95)
+        # no correspondence survives, so the identity is returned without fitting
+        with warnings.catch_warnings():
+            warnings.simplefilter("error")
+            meanError, (T, R, t) = logic.point_to_plane_icp(
+                movedPoints, targetPoints, movedNormals, targetNormals, 1e-9
+            )
+        self.assertEqual(meanError, [])
+        self.assertTrue(np.allclose(T, np.identity(4)))
+        self.delayDisplay("Test passed")
+
+    def test_ALPACANormals(self):
+        """Batched normals must match a per point PCA of the radius neighbourhoods and follow the orientation."""
+        self.delayDisplay("Starting the normal estimation test")
+        logic = ALPACALogic()
+        rng = np.random.default_rng(0)
+        axes = np.array([10, 15, 20])
+        directions = rng.normal(size=(3000, 3))
+        points = directions / np.linalg.norm(directions, axis=1, keepdims=True) * axes
+        points = np.vstack([points + [100, -50, 30], [[500, 500, 500]]])
+        trueNormals = (points[:-1] - [100, -50, 30]) / axes ** 2
+        trueNormals /= np.linalg.norm(trueNormals, axis=1, keepdims=True)
+
+        normals = logic.estimate_normals(points, searchRadius=3)
+        self.assertTrue(np.all(normals[:, 2] >= 0))
+        self.assertTrue(np.allclose(normals[-1], 1 / np.sqrt(3)))
+        from scipy.spatial import cKDTree
+
+        tree = cKDTree(points)
+        for index in rng.choice(len(points) - 1, 50, replace=False):
+            neighbors = points[tree.query_ball_point(points[index], 3)]
+            eigenValues, eigenVectors = np.linalg.eigh(np.cov(neighbors.T))
+            normal = eigenVectors[:, 0] * np.sign(eigenVectors[2, 0])
+            self.assertTrue(np.allclose(normals[index], normal, atol=1e-8))
+        try:
+            from sklearn.neighbors import KDTree
+            from sklearn.decomposition import PCA
+        except ImportError:
+            KDTree = None
+        if KDTree is not None:
+            # the per point sklearn PCA that extract_pca_normal_scikit used before
+            neighborIndices = KDTree(points).query_radius(points, r=3)
+            pca = PCA(n_components=3)
+            sklearnNormals = []
+            for indices in neighborIndices:
+                pca.fit(points[indices] if len(indices) >= 3 else np.identity(3))
+                sklearnNormals.append(pca.components_[np.argmin(pca.explained_variance_)])
+            sklearnNormals = np.array(sklearnNormals)
+            sklearnNormals[sklearnNormals[:, 2] < 0] *= -1
+            self.assertTrue(np.allclose(sklearnNormals, normals, atol=1e-8))
+
+        # normals away from the centroid point outwards, normals towards the centre inwards
+        normals = logic.estimate_normals(points[:-1], neighborCount=20, viewpoint="centroid")
+        self.assertTrue(np.median(np.sum(normals * trueNormals, axis=1)) > 0.99)
+        normals = logic.estimate_normals(points[:-1], neighborCount=20, viewpoint=[100, -50, 30])
+        self.assertTrue(np.median(np.sum(normals * trueNormals, axis=1)) < -0.99)
+        self.delayDisplay("Test passed")
+
+    def test_ALPACANormalsBenchmark(self):
+        """Time the batched normals against vtkPCANormalEstimation and the per point sklearn PCA."""
+        self.delayDisplay("Starting the normal estimation benchmark")
+        logic = ALPACALogic()
+        rng = np.random.default_rng(0)
+        try:
+            from sklearn.neighbors import KDTree
+            from sklearn.decomposition import PCA
+        except ImportError:
+            KDTree = None
+        for pointNumber in [10000, 100000]:
+            directions = rng.normal(size=(pointNumber, 3))
+            points = directions / np.linalg.norm(directions, axis=1, keepdims=True)
+            radius = 4 / np.sqrt(pointNumber)
+            startTime = time.time()
+            logic.estimate_normals(points, searchRadius=radius)
+            message = f"Normals of {pointNumber} points: batched radius {time.time() - startTime:.3f}s"
+            startTime = time.time()
+            logic.estimate_normals(points, neighborCount=30)
+            message += f", batched 30 neighbours {time.time() - startTime:.3f}s"
+            polydata = vtk.vtkPolyData()
+            polydata.SetPoints(logic.numpyToVTKPoints(points))
+            startTime = time.time()
+            normalFilter = vtk.vtkPCANormalEstimation()
+            normalFilter.SetSampleSize(30)
+            normalFilter.SetNormalOrientationToPoint()
+            normalFilter.SetInputData(polydata)
+            normalFilter.Update()
+            message += f", vtkPCANormalEstimation {time.time() - startTime:.3f}s"
+            if KDTree is not None and pointNumber == 10000:
+                startTime = time.time()
+                neighborIndices = KDTree(points).query_radius(points, r=radius)
+                pca = PCA(n_components=3)
+                for indices in neighborIndices:
+                    pca.fit(points[indices] if len(indices) >= 3 else np.identity(3))
+                message += f", per point sklearn PCA {time.time() - startTime:.3f}s"
+            logging.info(message)
+        self.delayDisplay("Benchmark complete")
@@ -0,0 +1,120 @@
+import os
+import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import vtk
+
+from ALPACALib.pipeline import ALPACAPipeline
+
+# Worker processes for batch landmarking. Each job aligns one template with one
+# target. The workers read the model and landmark files themselves and return
+# the predicted landmarks as a numpy array, so nothing but file paths, the
+# parameters and the results is passed between processes. The files are read
+# into the RAS coordinate system like Slicer does, so the results match the
+# alignments run in the Slicer process.
+
+_pipeline = ALPACAPipeline()
+
+
+def fileCoordinateSystem(filePath, default="LPS"):
+    """
+    Returns the coordinate system named in the header of a model file ("SPACE=RAS" or "SPACE=LPS"),
+    or the default that Slicer assumes for files without one.
+    """
+    with open(filePath, "rb") as f:
+        header = f.read(65536)
+    if b"SPACE=RAS" in header:
+        return "RAS"
+    if b"SPACE=LPS" in header:
+        return "LPS"
+    return default
+
+
+def readModel(filePath):
+    """
+    Reads a .ply, .obj or .vtk model into a vtkPolyData in RAS coordinates.
+    """
+    coordinateSystem = fileCoordinateSystem(filePath)
+    extension = os.path.splitext(filePath)[1].lower()
+    if extension == ".ply":
+        reader = vtk.vtkPLYReader()
+    elif extension == ".obj":
+        reader = vtk.vtkOBJReader()
+    else:
+        reader = vtk.vtkPolyDataReader()
+    reader.SetFileName(filePath)
+    reader.Update()
+    polydata = reader.GetOutput()
+    if coordinateSystem == "RAS":
+        return polydata
+    # LPS to RAS, the filter also transforms the normals
+    transform = vtk.vtkTransform()
+    transform.Scale(-1, -1, 1)
+    transformFilter = vtk.vtkTransformPolyDataFilter()
+    transformFilter.SetTransform(transform)
+    transformFilter.SetInputData(polydata)
+    transformFilter.Update()
+    return transformFilter.GetOutput()
+
+
+def readLandmarks(filePath):
+    """
+    Reads the control point positions of a .mrk.json or .fcsv file as an (n x 3) array in RAS coordinates.
+    """
+    if filePath.endswith(".json"):
+        with open(filePath) as f:
+            markup = json.load(f)["markups"][0]
+        positions = np.array(
+            [point["position"] for point in markup["controlPoints"]], dtype=float
+        ).reshape(-1, 3)
+        coordinateSystem = markup.get("coordinateSystem", "LPS")
+    else:
+        rows = []
+        coordinateSystem = "RAS"
+        with open(filePath) as f:
+            for row in f:
+                if row.startswith("#"):
+                    if "CoordinateSystem" in row:
+                        value = row.split("=")[-1].strip()
+                        coordinateSystem = "LPS" if value in ["LPS", "1"] else "RAS"
+                else:
+                    rows.append(row.strip().split(",")[1:4])
+        positions = np.array(rows, dtype=float).reshape(-1, 3)
+    if coordinateSystem == "LPS":
+        positions[:, :2] *= -1
+    return positions
+
+
+def alignmentJob(job):
+    """
+    Runs one template to target alignment described by the job dictionary.
+    Returns (predicted landmarks, None) or (None, error message) if the alignment failed.
+    """
+    try:
+        predictedLandmarks = _pipeline.predictLandmarks(
+            readModel(job["sourceModelPath"]),
+            readModel(job["targetModelPath"]),
+            readLandmarks(job["sourceLandmarkPath"]),
+            job["skipScaling"],
+            job["projectionFactor"],
+            job["parameters"],
+            featureCacheDirectory=job.get("featureCacheDirectory"),
+        )
+        return np.asarray(predictedLandmarks), None
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"
+
+
+def runJobs(jobs, maxWorkers=None, executable=None, chunkSize=1):
+    """
+    Runs alignmentJob for each job in a pool of maxWorkers spawned processes (all cores by default)
+    and yields the results in the order of the jobs. executable is the Python interpreter started for
+    the workers, the interpreter running this function is used if it is not given. Consecutive blocks
+    of chunkSize jobs go to the same worker, which then reuses its cached features of shared meshes.
+    """
+    context = multiprocessing.get_context("spawn")
+    if executable is not None:
+        context.set_executable(executable)
+    with ProcessPoolExecutor(max_workers=maxWorkers, mp_context=context) as executor:
+        yield from executor.map(alignmentJob, jobs, chunksize=chunkSize)
@@ -0,0 +1,1417 @@
+import os
+import copy
+import math
+import time
+import hashlib
+import collections
+import tempfile
+import subprocess
+import numpy as np
+import vtk
+from vtk.util import numpy_support as vtk_np
+
+# Scene-free part of the ALPACA pipeline. The methods only use numpy, VTK, ITK
+# and the registration packages, never the MRML scene, so they can run in worker
+# processes that do not have the Slicer application. ALPACALogic inherits them.
+
+# Cache of subsampled mesh points, normals and FPFH features. The same template
+# and target meshes are subsampled again for every alignment they take part in,
+# so the results are kept for the most recently used meshes of this process and,
+# optionally, as one .npz file per entry in a cache directory shared by processes
+# and runs. Entries on disk are touched when they are read, and the least
+# recently used ones are removed when the directory grows beyond
+# featureCacheDiskSize bytes.
+
+featureCacheSize = 32
+featureCacheDiskSize = 2**30
+_featureCache = collections.OrderedDict()
+
+
+def readFeatureCache(key, cacheDirectory=None):
+    if key in _featureCache:
+        _featureCache.move_to_end(key)
+        return _featureCache[key]
+    if cacheDirectory is None:
+        return None
+    entryPath = os.path.join(cacheDirectory, key + ".npz")
+    try:
+        with np.load(entryPath) as entry:
+            features = (entry["points"], entry["normals"], entry["features"])
+    except (OSError, KeyError, ValueError):
+        return None
+    try:
+        # mark the entry as recently used for pruneFeatureCache
+        os.utime(entryPath)
+    except OSError:
+        pass
+    storeFeatures(key, features)
+    return features
+
+
+def writeFeatureCache(key, features, cacheDirectory=None):
+    storeFeatures(key, features)
+    if cacheDirectory is None:
+        return
+    try:
+        os.makedirs(cacheDirectory, exist_ok=True)
+        entryPath = os.path.join(cacheDirectory, key + ".npz")
+        # write to a temporary file first so other processes never read a partial entry
+        temporaryPath = f"{entryPath}.{os.getpid()}.tmp"
+        with open(temporaryPath, "wb") as f:
+            np.savez(f, points=features[0], normals=features[1], features=features[2])
+        os.replace(temporaryPath, entryPath)
+    except OSError:
+        return
+    pruneFeatureCache(cacheDirectory)
+
+
+def cacheEntries(cacheDirectory):
+    """
+    Returns (modification time, size, path) of each .npz entry in the cache directory.
+    """
+    entries = []
+    try:
+        with os.scandir(cacheDirectory) as directoryEntries:
+            for entry in directoryEntries:
+                if entry.name.endswith(".npz"):
+                    try:
+                        entryStat = entry.stat()
+                    except OSError:
+                        continue
+                    entries.append((entryStat.st_mtime_ns, entryStat.st_size, entry.path))
+    except OSError:
+        pass
+    return entries
+
+
+def pruneFeatureCache(cacheDirectory, sizeLimit=None):
+    """
+    Removes the least recently used entries until the cache directory holds at most sizeLimit bytes
+    (featureCacheDiskSize by default).
+    """
+    sizeLimit = featureCacheDiskSize if sizeLimit is None else sizeLimit
+    entries = cacheEntries(cacheDirectory)
+    totalSize = sum(size for _, size, _ in entries)
+    for _, size, entryPath in sorted(entries):
+        if totalSize <= sizeLimit:
+            break
+        try:
+            os.remove(entryPath)
+        except OSError:
+            pass
+        totalSize -= size
+
+
+def clearFeatureCache(cacheDirectory=None):
+    """
+    Empties the in-memory cache of this process and removes the entries in the cache directory.
+    """
+    _featureCache.clear()
+    if cacheDirectory is not None:
+        pruneFeatureCache(cacheDirectory, 0)
+
+
+def storeFeatures(key, features):
+    _featureCache[key] = features
+    _featureCache.move_to_end(key)
+    while len(_featureCache) > featureCacheSize:
+        _featureCache.popitem(last=False)
+
+
+class ALPACAPipeline:
+    def cacheDirectory(self):
+        """
+        Directory for temporary files of external registration tools.
+        """
+        return tempfile.gettempdir()
+
+    def predictLandmarks(
+        self,
+        sourceMesh,
+        targetMesh,
+        sourceLandmarks,
+        skipScaling,
+        projectionFactor,
+        parameters,
+        usePoisson=False,
+        featureCacheDirectory=None,
+    ):
+        """
+        Transfers the (n x 3) sourceLandmarks of sourceMesh to targetMesh: rigid or similarity alignment
+        of the subsampled meshes, deformable registration of the aligned points and, if projectionFactor
+        is not 0, projection of the landmarks onto the target surface. sourceMesh is not modified.
+        The mesh features are cached in featureCacheDirectory if given, see meshFeatures.
+        Returns the (n x 3) predicted landmarks.
+        """
+        sourceMeshCopy = vtk.vtkPolyData()
+        sourceMeshCopy.DeepCopy(sourceMesh)
+        (
+            sourcePoints,
+            targetPoints,
+            sourceFeatures,
+            targetFeatures,
+            voxelSize,
+            scaling,
+        ) = self.subsampleMeshes(
+            sourceMeshCopy,
+            targetMesh,
+            skipScaling,
+            parameters,
+            usePoisson,
+            featureCacheDirectory,
+        )
+        SimilarityTransform, similarityFlag = self.estimateTransform(
+            sourcePoints,
+            targetPoints,
+            sourceFeatures,
+            targetFeatures,
+            voxelSize,
+            skipScaling,
+            parameters,
+        )
+        # Rigid
+        sourceLandmarks = self.transform_numpy_points(
+            np.asarray(sourceLandmarks) * scaling, SimilarityTransform
+        )
+        sourcePoints = self.transform_numpy_points(sourcePoints, SimilarityTransform)
+
+        # Deformable
+        registeredSourceLM = self.runCPDRegistration(
+            sourceLandmarks, sourcePoints, targetPoints, parameters
+        )
+        if projectionFactor == 0:
+            return registeredSourceLM
+        # the warp is applied to the scaled source mesh, the similarity transform only to the landmarks
+        deformedMesh = self.applyTPS(sourceLandmarks, registeredSourceLM, sourceMeshCopy)
+        maxProjection = targetMesh.GetLength() * projectionFactor
+        projectedPoints = self.projectPointsPolydata(
+            deformedMesh,
+            targetMesh,
+            self.numpyToVTKPoints(registeredSourceLM),
+            maxProjection,
+        )
+        return vtk_np.vtk_to_numpy(projectedPoints.GetPoints().GetData())
+
+    def numpyToVTKPoints(self, points):
+        pointsVTK = vtk.vtkPoints()
+        pointsVTK.SetData(vtk_np.numpy_to_vtk(np.asarray(points, dtype=float), deep=True))
+        return pointsVTK
+
+    def applyTPS(self, sourcePoints, targetPoints, polydata):
+        transform = vtk.vtkThinPlateSplineTransform()
+        transform.SetSourceLandmarks(self.numpyToVTKPoints(sourcePoints))
+        transform.SetTargetLandmarks(self.numpyToVTKPoints(targetPoints))
+        transform.SetBasisToR()  # for 3D transform
+
+        transformFilter = vtk.vtkTransformPolyDataFilter()
+        transformFilter.SetInputData(polydata)
+        transformFilter.SetTransform(transform)
+        transformFilter.Update()
+        return transformFilter.GetOutput()
+
+    def runCPDRegistration(self, sourceLM, sourceSLM, targetSLM, parameters):
+        sourceArrayCombined = np.append(sourceSLM, sourceLM, axis=0)
+        targetArray = np.asarray(targetSLM)
+
+        cloudSize = np.max(targetArray, 0) - np.min(targetArray, 0)
+
+        targetArray = targetArray * 25 / cloudSize
+        sourceArrayCombined = sourceArrayCombined * 25 / cloudSize
+
+        if parameters["Acceleration"] == 0:
+            registrationOutput = self.cpd_registration(
+                targetArray,
+                sourceArrayCombined,
+                parameters["CPDIterations"],
+                parameters["CPDTolerance"],
+                parameters["alpha"],
+                parameters["beta"],
+            )
+            deformed_array, _ = registrationOutput.register()
+        else:
+            # each call gets its own working directory so concurrent runs do not share the bcpd files
+            with tempfile.TemporaryDirectory(dir=self.cacheDirectory()) as workDirectory:
+                targetPath = os.path.join(workDirectory, "target.txt")
+                sourcePath = os.path.join(workDirectory, "source.txt")
+                np.savetxt(targetPath, targetArray, delimiter=",")
+                np.savetxt(sourcePath, sourceArrayCombined, delimiter=",")
+                path = os.path.join(parameters["BCPDFolder"], "bcpd")
+                cmd = f'"{path}" -x "{targetPath}" -y "{sourcePath}" -l{parameters["alpha"]} -b{parameters["beta"]} -g0.1 -K140 -J500 -c1e-6 -p -d7 -e0.3 -f0.3 -ux -N1'
+                subprocess.run(
+                    cmd,
+                    shell=True,
+                    check=True,
+                    text=True,
+                    capture_output=True,
+                    cwd=workDirectory,
+                )
+                deformed_array = np.loadtxt(os.path.join(workDirectory, "output_y.txt"))
+        # Capture output landmarks from source pointcloud
+        fiducial_prediction = deformed_array[-len(sourceLM) :]
+
+        fiducialCloud = fiducial_prediction
+        fiducialCloud = fiducialCloud * cloudSize / 25
+        return fiducialCloud
+
+    def itkToVTKTransform(self, itkTransform, similarityFlag=False):
+        matrix = itkTransform.GetMatrix()
+        offset = itkTransform.GetOffset()
+
+        matrix_vtk = vtk.vtkMatrix4x4()
+        for i in range(3):
+            for j in range(3):
+                matrix_vtk.SetElement(i, j, matrix(i, j))
+        for i in range(3):
+            matrix_vtk.SetElement(i, 3, offset[i])
+
+        transform = vtk.vtkTransform()
+        transform.SetMatrix(matrix_vtk)
+        return transform
+
+    def find_knn_cpu(self, feat0, feat1, knn=1, return_distance=False):
+        from scipy.spatial import cKDTree
+
+        feat1tree = cKDTree(feat1)
+        dists, nn_inds = feat1tree.query(feat0, k=knn)
+        if return_distance:
+            return nn_inds, dists
+        else:
+            return nn_inds
+
+    def find_correspondences(self, feats0, feats1, mutual_filter=True):
+        """
+        Using the FPFH features find noisy corresspondes.
+        These corresspondes will be used inside the RANSAC.
+        """
+        nns01, dists1 = self.find_knn_cpu(feats0, feats1, knn=1, return_distance=True)
+        corres01_idx0 = np.arange(len(nns01))
+        corres01_idx1 = nns01
+
+        if not mutual_filter:
+            return corres01_idx0, corres01_idx1
+
+        nns10, dists2 = self.find_knn_cpu(feats1, feats0, knn=1, return_distance=True)
+        corres10_idx1 = np.arange(len(nns10))
+        corres10_idx0 = nns10
+
+        mutual_filter = corres10_idx0[corres01_idx1] == corres01_idx0
+        corres_idx0 = corres01_idx0[mutual_filter]
+        corres_idx1 = corres01_idx1[mutual_filter]
+
+        return corres_idx0, corres_idx1
+
+    # Returns the fitness of alignment of two pointSets
+    def closest_points(
+        self, movingMeshPoints, fixedMeshPoints, distanceThreshold, transform=None
+    ):
+        """
+        Finds the closest fixed point of every moving point, after applying the ITK transform to the
+        moving points if one is given, with a single KD-tree query. Returns the float32 moving points, the
+        indices of their closest fixed points, the distances and the mask of distances below the threshold.
+        """
+        from scipy.spatial import cKDTree
+
+        movingPoints = np.asarray(movingMeshPoints, dtype=np.float32).reshape(-1, 3)
+        fixedPoints = np.asarray(fixedMeshPoints, dtype=np.float32).reshape(-1, 3)
+        if transform is not None:
+            movingPoints = self.transform_numpy_points(movingPoints, transform)
+        distances, indices = cKDTree(fixedPoints).query(
+            movingPoints, distance_upper_bound=distanceThreshold, workers=-1
+        )
+        inliers = distances < distanceThreshold
+        return movingPoints, indices, distances, inliers
+
+    # Returns the fitness of alignment of two pointSets
+    def get_fitness(
+        self, movingMeshPoints, fixedMeshPoints, distanceThrehold, transform=None
+    ):
+        """
+        Returns the fraction of moving points that have a fixed point closer than the threshold and the
+        mean distance of those inlier points (infinite if there are none).
+        """
+        movingPoints, _, distances, inliers = self.closest_points(
+            movingMeshPoints, fixedMeshPoints, distanceThrehold, transform
+        )
+        fitness = int(np.count_nonzero(inliers))
+        if fitness == 0:
+            return 0.0, np.inf
+        inlier_rmse = float(distances[inliers].sum())
+        return fitness / movingPoints.shape[0], inlier_rmse / fitness
+
+
+    # RANSAC using package
+    def ransac_using_package(
+        self,
+        movingMeshPoints,
+        fixedMeshPoints,
+        movingMeshFeaturePoints,
+        fixedMeshFeaturePoints,
+        number_of_iterations,
+        number_of_ransac_points,
+        inlier_value,
+        skip_scaling,
+        check_edge_length,
+        correspondence_distance,
+    ):
+        import itk
+
+        def GenerateData(data, agreeData):
+            """
+            In current implementation the agreedata contains two corresponding
+            points from moving and fixed mesh. However, after the subsampling step the
+            number of points need not be equal in those meshes. So we randomly sample
+            the points from larger mesh.
+            """
+            data.reserve(movingMeshFeaturePoints.shape[0])
+            for i in range(movingMeshFeaturePoints.shape[0]):
+                point1 = movingMeshFeaturePoints[i]
+                point2 = fixedMeshFeaturePoints[i]
+                input_data = [
+                    point1[0],
+                    point1[1],
+                    point1[2],
+                    point2[0],
+                    point2[1],
+                    point2[2],
+                ]
+                input_data = [float(x) for x in input_data]
+                data.push_back(input_data)
+
+            count_min = int(
+                np.min([movingMeshPoints.shape[0], fixedMeshPoints.shape[0]])
+            )
+
+            mesh1_points = copy.deepcopy(movingMeshPoints)
+            mesh2_points = copy.deepcopy(fixedMeshPoints)
+
+            np.random.seed(0)
+            np.random.shuffle(mesh1_points)
+            np.random.seed(0)
+            np.random.shuffle(mesh2_points)
+
+            agreeData.reserve(count_min)
+            for i in range(count_min):
+                point1 = mesh1_points[i]
+                point2 = mesh2_points[i]
+                input_data = [
+                    point1[0],
+                    point1[1],
+                    point1[2],
+                    point2[0],
+                    point2[1],
+                    point2[2],
+                ]
+                input_data = [float(x) for x in input_data]
+                agreeData.push_back(input_data)
+            return
+
+        data = itk.vector[itk.Point[itk.D, 6]]()
+        agreeData = itk.vector[itk.Point[itk.D, 6]]()
+        GenerateData(data, agreeData)
+
+        transformParameters = itk.vector.D()
+        bestTransformParameters = itk.vector.D()
+
+        itk.MultiThreaderBase.SetGlobalDefaultThreader(
+            itk.MultiThreaderBase.ThreaderTypeFromString("POOL")
+        )
+        maximumDistance = inlier_value
+        if skip_scaling:
+            TransformType = itk.VersorRigid3DTransform[itk.D]
+            RegistrationEstimatorType = itk.Ransac.LandmarkRegistrationEstimator[
+                6, TransformType
+            ]
+        else:
+            TransformType = itk.Similarity3DTransform[itk.D]
+            RegistrationEstimatorType = itk.Ransac.LandmarkRegistrationEstimator[
+                6, TransformType
+            ]
+        registrationEstimator = RegistrationEstimatorType.New()
+        registrationEstimator.SetMinimalForEstimate(number_of_ransac_points)
+        registrationEstimator.SetAgreeData(agreeData)
+        registrationEstimator.SetDelta(maximumDistance)
+        registrationEstimator.LeastSquaresEstimate(data, transformParameters)
+
+        maxThreadCount = int(
+            itk.MultiThreaderBase.New().GetMaximumNumberOfThreads() / 2
+        )
+
+        desiredProbabilityForNoOutliers = 0.99
+        RANSACType = itk.RANSAC[itk.Point[itk.D, 6], itk.D, TransformType]
+        ransacEstimator = RANSACType.New()
+        ransacEstimator.SetData(data)
+        ransacEstimator.SetAgreeData(agreeData)
+        ransacEstimator.SetCheckCorresspondenceDistance(check_edge_length)
+        if correspondence_distance > 0:
+            ransacEstimator.SetCheckCorrespondenceEdgeLength(correspondence_distance)
+        ransacEstimator.SetMaxIteration(int(number_of_iterations / maxThreadCount))
+        ransacEstimator.SetNumberOfThreads(maxThreadCount)
+        ransacEstimator.SetParametersEstimator(registrationEstimator)
+
+        percentageOfDataUsed = ransacEstimator.Compute(
+            transformParameters, desiredProbabilityForNoOutliers
+        )
+
+        transform = TransformType.New()
+        p = transform.GetParameters()
+        f = transform.GetFixedParameters()
+        for i in range(p.GetSize()):
+            p.SetElement(i, transformParameters[i])
+        counter = 0
+        totalParameters = p.GetSize() + f.GetSize()
+        for i in range(p.GetSize(), totalParameters):
+            f.SetElement(counter, transformParameters[i])
+            counter = counter + 1
+        transform.SetParameters(p)
+        transform.SetFixedParameters(f)
+        return (
+            itk.dict_from_transform(transform),
+            percentageOfDataUsed[0],
+            percentageOfDataUsed[1],
+        )
+
+    def get_euclidean_distance(
+        self, input_fixedPoints, input_movingPoints, distance_threshold
+    ):
+        import itk
+
+        mesh_fixed = itk.Mesh[itk.D, 3].New()
+        mesh_moving = itk.Mesh[itk.D, 3].New()
+
+        mesh_fixed.SetPoints(
+            itk.vector_container_from_array(input_fixedPoints.flatten())
+        )
+        mesh_moving.SetPoints(
+            itk.vector_container_from_array(input_movingPoints.flatten())
+        )
+
+        MetricType = itk.EuclideanDistancePointSetToPointSetMetricv4.PSD3
+        metric = MetricType.New()
+        metric.SetMovingPointSet(mesh_moving)
+        metric.SetDistanceThreshold(distance_threshold)
+        metric.SetFixedPointSet(mesh_fixed)
+        metric.Initialize()
+
+        return metric.GetValue()
+
+    def get_correspondence_and_fitness(
+        self, fixedPoints, movingPoints, distanceThreshold, transform=None
+    ):
+        """
+        Returns the (inliers x 3) fixed and moving points of the correspondences closer than the threshold,
+        the number of inliers, their mean distance and an (inliers x 2) array of [fixed index, moving index].
+        """
+        movingPoints, indices, distances, inliers = self.closest_points(
+            movingPoints, fixedPoints, distanceThreshold, transform
+        )
+        fixedPoints = np.asarray(fixedPoints, dtype=np.float32).reshape(-1, 3)
+        movingIndices = np.flatnonzero(inliers)
+        fixedIndices = indices[inliers]
+        fitness = len(movingIndices)
+        inlier_rmse = float(distances[inliers].sum()) / fitness if fitness > 0 else np.inf
+        return (
+            fixedPoints[fixedIndices].astype(float),
+            movingPoints[movingIndices].astype(float),
+            fitness,
+            inlier_rmse,
+            np.column_stack((fixedIndices, movingIndices)),
+        )
+
+    def final_iteration_icp(
+        self, fixedPoints, movingPoints, distanceThreshold, normalSearchRadius
+    ):
+        import itk
+        fixedPointsNormal = self.estimate_normals(
+            fixedPoints, searchRadius=normalSearchRadius
+        )
+        movingPointsNormal = self.estimate_normals(
+            movingPoints, searchRadius=normalSearchRadius
+        )
+
+        _, (T, R, t) = self.point_to_plane_icp(
+            movingPoints,
+            fixedPoints,
+            movingPointsNormal,
+            fixedPointsNormal,
+            distanceThreshold,
+        )
+
+        transform = itk.Rigid3DTransform.D.New()
+        transform.SetMatrix(itk.matrix_from_array(R), 0.000001)
+        transform.SetTranslation([t[0], t[1], t[2]])
+        return movingPoints, transform
+
+    def euler_matrix(self, ai, aj, ak):
+        """Return homogeneous rotation matrix from Euler angles and axis sequence.
+        ai, aj, ak : Euler's roll, pitch and yaw angles
+        axes : One of 24 axis sequences as string or encoded tuple
+        >>> R = euler_matrix(1, 2, 3, 'syxz')
+        >>> numpy.allclose(numpy.sum(R[0]), -1.34786452)
+        True
+        >>> R = euler_matrix(1, 2, 3, (0, 1, 0, 1))
+        """
+
+        firstaxis, parity, repetition, frame = (0, 0, 0, 0)
+        _NEXT_AXIS = [1, 2, 0, 1]
+
+        i = firstaxis
+        j = _NEXT_AXIS[i + parity]
+        k = _NEXT_AXIS[i - parity + 1]
+
+        if frame:
+            ai, ak = ak, ai
+        if parity:
+            ai, aj, ak = -ai, -aj, -ak
+
+        si, sj, sk = math.sin(ai), math.sin(aj), math.sin(ak)
+        ci, cj, ck = math.cos(ai), math.cos(aj), math.cos(ak)
+        cc, cs = ci * ck, ci * sk
+        sc, ss = si * ck, si * sk
+
+        M = np.identity(4)
+        if repetition:
+            M[i, i] = cj
+            M[i, j] = sj * si
+            M[i, k] = sj * ci
+            M[j, i] = sj * sk
+            M[j, j] = -cj * ss + cc
+            M[j, k] = -cj * cs - sc
+            M[k, i] = -sj * ck
+            M[k, j] = cj * sc + cs
+            M[k, k] = cj * cc - ss
+        else:
+            M[i, i] = cj * ck
+            M[i, j] = sj * sc - cs
+            M[i, k] = sj * cc + ss
+            M[j, i] = cj * sk
+            M[j, j] = sj * ss + cc
+            M[j, k] = sj * cs - sc
+            M[k, i] = -sj
+            M[k, j] = cj * si
+            M[k, k] = cj * ci
+        return M
+
+    def best_fit_transform_point2plane(self, A, B, normals):
+        """
+            reference: https://www.comp.nus.edu.sg/~lowkl/publications/lowk_point-to-plane_icp_techrep.pdf
+            Input:
+            A: Nx3 numpy array of corresponding points
+            B: Nx3 numpy array of corresponding points
+            normals: Nx3 numpy array of B's normal vectors
+            Returns:
+            T: (m+1)x(m+1) homogeneous transformation matrix that maps A on to B
+            R: mxm rotation matrix
+            t: mx1 translation vector
+        """
+        assert A.shape == B.shape
+        assert A.shape == normals.shape
+
+        # one row [A x n, n] per correspondence, the right side is the distance of A from B's plane
+        H = np.hstack((np.cross(A, normals), normals))
+        b = np.einsum("ij,ij->i", normals, B - A)
+
+        tr = np.linalg.lstsq(H, b, rcond=None)[0]
+        T = self.euler_matrix(tr[0], tr[1], tr[2])
+        T[0, 3] = tr[3]
+        T[1, 3] = tr[4]
+        T[2, 3] = tr[5]
+
+        R = T[:3, :3]
+        t = T[:3, 3]
+
+        return T, R, t
+
+    def best_fit_transform_point2point(self, A, B):
+        """
+        Calculates the least-squares best-fit transform that maps corresponding points A to B in m spatial dimensions
+        Input:
+        A: Nxm numpy array of corresponding points
+        B: Nxm numpy array of corresponding points
+        Returns:
+        T: (m+1)x(m+1) homogeneous transformation matrix that maps A on to B
+        R: mxm rotation matrix
+        t: mx1 translation vector
+        """
+
+        assert A.shape == B.shape
+
+        # get number of dimensions
+        m = A.shape[1]
+
+        # translate points to their centroids
+        centroid_A = np.mean(A, axis=0)
+        centroid_B = np.mean(B, axis=0)
+        AA = A - centroid_A
+        BB = B - centroid_B
+
+        # rotation matrix
+        H = np.dot(AA.T, BB)
+        U, S, Vt = np.linalg.svd(H)
+        R = np.dot(Vt.T, U.T)
+
+        # special reflection case
+        if np.linalg.det(R) < 0:
+            Vt[m - 1, :] *= -1
+        R = np.dot(Vt.T, U.T)
+
+        # translation
+        t = centroid_B.T - np.dot(R, centroid_A.T)
+
+        # homogeneous transformation
+        T = np.identity(m + 1)
+        T[:m, :m] = R
+        T[:m, m] = t
+
+        return T, R, t
+
+    def nearest_neighbor(self, src, dst):
+        """
+        Find the nearest (Euclidean) neighbor in dst for each point in src
+        Input:
+            src: Nxm array of points
+            dst: Nxm array of points
+        Output:
+            distances: Euclidean distances of the nearest neighbor
+            indices: dst indices of the nearest neighbor
+        """
+            # assert src.shape == dst.shape
+        from sklearn.neighbors import NearestNeighbors
+        neigh = NearestNeighbors(n_neighbors=1, algorithm="kd_tree")
+        neigh.fit(dst)
+        distances, indices = neigh.kneighbors(src, return_distance=True)
+        return distances.ravel(), indices.ravel()
+
+    def point_to_plane_icp(
+        self,
+        src_pts,
+        dst_pts,
+        src_pt_normals,
+        dst_pt_normals,
+        dist_threshold=np.inf,
+        max_iterations=30,
+        tolerance=0.000001,
+        angle_threshold=None,
+        plateau_tolerance=None,
+        telemetry=None,
+    ):
+        """
+            The Iterative Closest Point method: finds best-fit transform that
+                maps points A on to points B
+            Input:
+                A: Nxm numpy array of source mD points
+                B: Nxm numpy array of destination mD point
+                max_iterations: exit algorithm after max_iterations
+                tolerance: convergence criteria
+                angle_threshold: if given, correspondences whose normals differ by
+                    more than this many degrees are rejected, comparing the source
+                    normals rotated by the current transform
+                plateau_tolerance: if given, also stop when the relative changes of
+                    the fitness and the inlier RMSE are both below it
+                telemetry: if a list is given, one dictionary with the iteration,
+                    fitness, inlier RMSE, mean error and time is appended per iteration
+            Output:
+                T: final homogeneous transformation that maps A on to B
+                MeanError: list, report each iteration's distance mean error
+        """
+        from scipy.spatial import cKDTree
+
+        A = src_pts
+        A_normals = src_pt_normals
+        B = dst_pts
+        B_normals = dst_pt_normals
+
+        # get number of dimensions
+        m = A.shape[1]
+
+        # make points homogeneous, copy them to maintain the originals
+        src = np.ones((m + 1, A.shape[0]))
+        src[:m, :] = np.copy(A.T)
+        dst_pts = np.asarray(B, dtype=float)
+
+        # the destination does not move, so its index is built once
+        dst_tree = cKDTree(dst_pts)
+        if angle_threshold is not None:
+            A_unit_normals = A_normals / np.linalg.norm(A_normals, axis=1, keepdims=True)
+            B_unit_normals = B_normals / np.linalg.norm(B_normals, axis=1, keepdims=True)
+
+        prev_error = 0
+        prev_fitness = None
+        prev_rmse = None
+        MeanError = []
+
+        finalT = np.identity(4)
+
+        for i in range(max_iterations):
+            start_time = time.time()
+            # find the nearest neighbors between the current source and destination points
+            matched_src_pts = src[:m, :].T.copy()
+            distances, indices = dst_tree.query(matched_src_pts, workers=-1)
+
+            # match each point of source-set to closest point of destination-set,
+            # and reject the bad corresponding
+            matched_dst_pts = dst_pts[indices]
+            reject_part_flag = distances < dist_threshold
+            if angle_threshold is not None:
+                # the source normals turn with the source points
+                current_normals = np.dot(A_unit_normals, finalT[:3, :3].T)
+                cos_angles = np.einsum("ij,ij->i", current_normals, B_unit_normals[indices])
+                reject_part_flag &= cos_angles > np.cos(np.radians(angle_threshold))
+            if not np.any(reject_part_flag):
+                print("No correspondences within the thresholds, stopping the refinement")
+                break
+
+            # get matched vertices and dst_vertexes' normals
+            matched_src_pts = matched_src_pts[reject_part_flag, :]
+            matched_dst_pts = matched_dst_pts[reject_part_flag, :]
+            matched_dst_pt_normals = B_normals[indices[reject_part_flag], :]
+
+            # compute the transformation between the current source and nearest destination points
+            T, _, _ = self.best_fit_transform_point2plane(
+                matched_src_pts, matched_dst_pts, matched_dst_pt_normals
+            )
+
+            finalT = np.dot(T, finalT)
+
+            # update the current source
+            src = np.dot(T, src)
+
+            # check error
+            inlier_distances = distances[reject_part_flag]
+            mean_error = np.mean(inlier_distances)
+            fitness = inlier_distances.shape[0] / distances.shape[0]
+            rmse = np.sqrt(np.mean(inlier_distances ** 2))
+            MeanError.append(mean_error)
+            if telemetry is not None:
+                telemetry.append(
+                    {
+                        "iteration": i,
+                        "fitness": float(fitness),
+                        "rmse": float(rmse),
+                        "meanError": float(mean_error),
+                        "time": time.time() - start_time,
+                    }
+                )
+            if tolerance is not None:
+                if np.abs(prev_error - mean_error) < tolerance:
+                    break
+            if plateau_tolerance is not None and prev_fitness is not None:
+                if (
+                    np.abs(fitness - prev_fitness) <= plateau_tolerance * prev_fitness
+                    and np.abs(rmse - prev_rmse) <= plateau_tolerance * prev_rmse
+                ):
+                    break
+            prev_error = mean_error
+            prev_fitness = fitness
+            prev_rmse = rmse
+        print("Refinement took ", i, " iterations")
+        # calculate final transformation
+        # T, R, t = self.best_fit_transform_point2point(A, src[:m, :].T)
+        # return MeanError, (T, R, t)
+        return MeanError, (finalT, finalT[:3, :3], finalT[:, 3])
+
+    def get_numpy_points_from_vtk(self, vtk_polydata):
+        """
+        Returns the points as numpy from a vtk_polydata
+        """
+        import vtk
+        from vtk.util import numpy_support
+
+        points = vtk_polydata.GetPoints()
+        pointdata = points.GetData()
+        points_as_numpy = numpy_support.vtk_to_numpy(pointdata)
+        return points_as_numpy
+
+    def transform_points_in_vtk(self, vtk_polydata, itk_transform):
+        points_as_numpy = self.get_numpy_points_from_vtk(vtk_polydata)
+        transformed_points = self.transform_numpy_points(points_as_numpy, itk_transform)
+        self.set_numpy_points_in_vtk(vtk_polydata, transformed_points)
+        return vtk_polydata
+
+    def transform_numpy_points(self, points_np, transform):
+        import itk
+
+        mesh = itk.Mesh[itk.F, 3].New()
+        mesh.SetPoints(
+            itk.vector_container_from_array(points_np.flatten().astype("float32"))
+        )
+        transformed_mesh = itk.transform_mesh_filter(mesh, transform=transform)
+        points_tranformed = itk.array_from_vector_container(
+            transformed_mesh.GetPoints()
+        )
+        points_tranformed = np.reshape(points_tranformed, [-1, 3])
+        return points_tranformed
+
+    def estimateTransform(
+        self,
+        sourcePoints,
+        targetPoints,
+        sourceFeatures,
+        targetFeatures,
+        voxelSize,
+        skipScaling,
+        parameters,
+    ):
+        import itk
+
+        similarityFlag = False
+        # Establish correspondences by nearest neighbour search in feature space
+        corrs_A, corrs_B = self.find_correspondences(
+            targetFeatures, sourceFeatures, mutual_filter=True
+        )
+
+        targetPoints = targetPoints.T
+        sourcePoints = sourcePoints.T
+
+        fixed_corr = targetPoints[:, corrs_A]  # np array of size 3 by num_corrs
+        moving_corr = sourcePoints[:, corrs_B]  # np array of size 3 by num_corrs
+
+        num_corrs = fixed_corr.shape[1]
+        print(f"FPFH generates {num_corrs} putative correspondences.")
+
+        targetPoints = targetPoints.T
+        sourcePoints = sourcePoints.T
+
+        # Check corner case when both meshes are same
+        if np.allclose(fixed_corr, moving_corr):
+            print("Same meshes therefore returning Identity Transform")
+            transform = itk.VersorRigid3DTransform[itk.D].New()
+            transform.SetIdentity()
+            return [transform, transform]
+
+        import time
+
+        bransac = time.time()
+
+        maxAttempts = 1
+        attempt = 0
+        best_fitness = -1
+        best_rmse = np.Inf
+        while attempt < maxAttempts:
+            # Perform Initial alignment using Ransac parallel iterations with no scaling
+            transform_matrix, fitness, rmse = self.ransac_using_package(
+                movingMeshPoints=sourcePoints,
+                fixedMeshPoints=targetPoints,
+                movingMeshFeaturePoints=moving_corr.T,
+                fixedMeshFeaturePoints=fixed_corr.T,
+                number_of_iterations=parameters["maxRANSAC"],
+                number_of_ransac_points=3,
+                inlier_value=float(parameters["distanceThreshold"]) * voxelSize,
+                skip_scaling=True,
+                check_edge_length=True,
+                correspondence_distance=0.9,
+            )
+
+            transform = itk.transform_from_dict(transform_matrix)
+            fitness_forward, rmse_forward = self.get_fitness(
+                sourcePoints,
+                targetPoints,
+                float(parameters["distanceThreshold"]) * voxelSize,
+                transform,
+            )
+
+            mean_fitness = fitness_forward
+            mean_rmse = rmse_forward
+            print(
+                "Non-Scaling Attempt = ",
+                attempt,
+                " Fitness = ",
+                mean_fitness,
+                " RMSE is ",
+                mean_rmse,
+            )
+
+            if mean_fitness > 0.99:
+                # Only compare RMSE if mean_fitness is greater than 0.99
+                if mean_rmse < best_rmse:
+                    best_fitness = mean_fitness
+                    best_rmse = mean_rmse
+                    best_transform = transform_matrix
+            else:
+                if mean_fitness > best_fitness:
+                    best_fitness = mean_fitness
+                    best_rmse = mean_rmse
+                    best_transform = transform_matrix
+
+            # Rigid Transform is un-fit for this use-case so perform scaling based RANSAC
+            # if mean_fitness < 0.9:
+            #  break
+            attempt = attempt + 1
+
+        print("Best Fitness without Scaling ", best_fitness, " RMSE is ", best_rmse)
+
+        if not skipScaling:
+            maxAttempts = 10
+            attempt = 0
+
+            correspondence_distance = 0.9
+            ransac_points = 3
+            ransac_iterations = int(parameters["maxRANSAC"])
+
+            while mean_fitness < 0.99 and attempt < maxAttempts:
+                transform_matrix, fitness, rmse = self.ransac_using_package(
+                    movingMeshPoints=sourcePoints,
+                    fixedMeshPoints=targetPoints,
+                    movingMeshFeaturePoints=moving_corr.T,
+                    fixedMeshFeaturePoints=fixed_corr.T,
+                    number_of_iterations=ransac_iterations,
+                    number_of_ransac_points=ransac_points,
+                    inlier_value=float(parameters["distanceThreshold"]) * voxelSize,
+                    skip_scaling=False,
+                    check_edge_length=False,
+                    correspondence_distance=correspondence_distance,
+                )
+
+                transform = itk.transform_from_dict(transform_matrix)
+                fitness_forward, rmse_forward = self.get_fitness(
+                    sourcePoints,
+                    targetPoints,
+                    float(parameters["distanceThreshold"]) * voxelSize,
+                    transform,
+                )
+
+                mean_fitness = fitness_forward
+                mean_rmse = rmse_forward
+                print(
+                    "Scaling Attempt = ",
+                    attempt,
+                    " Fitness = ",
+                    mean_fitness,
+                    " RMSE = ",
+                    mean_rmse,
+                )
+
+                if (mean_fitness > best_fitness) or (
+                    mean_fitness == best_fitness and mean_rmse < best_rmse
+                ):
+                    best_fitness = mean_fitness
+                    best_rmse = mean_rmse
+                    best_transform = transform_matrix
+                    similarityFlag = True
+                attempt = attempt + 1
+
+        aransac = time.time()
+        print("RANSAC Duraction ", aransac - bransac)
+        print("Best Fitness after scaling ", best_fitness)
+
+        first_transform = itk.transform_from_dict(best_transform)
+        sourcePoints = self.transform_numpy_points(sourcePoints, first_transform)
+
+        print("-----------------------------------------------------------")
+        print(parameters)
+        print("Starting Rigid Refinement")
+        distanceThreshold = parameters["ICPDistanceThreshold"] * voxelSize
+        inlier, rmse = self.get_fitness(sourcePoints, targetPoints, distanceThreshold)
+        print("Before Inlier = ", inlier, " RMSE = ", rmse)
+        _, second_transform = self.final_iteration_icp(
+            targetPoints,
+            sourcePoints,
+            distanceThreshold,
+            float(parameters["normalSearchRadius"] * voxelSize),
+        )
+
+        final_mesh_points = self.transform_numpy_points(sourcePoints, second_transform)
+        inlier, rmse = self.get_fitness(
+            final_mesh_points, targetPoints, distanceThreshold
+        )
+        print("After Inlier = ", inlier, " RMSE = ", rmse)
+        first_transform.Compose(second_transform)
+        return first_transform, similarityFlag
+
+    def set_numpy_points_in_vtk(self, vtk_polydata, points_as_numpy):
+        """
+        Sets the numpy points to a vtk_polydata
+        """
+        import vtk
+        from vtk.util import numpy_support
+
+        vtk_data_array = numpy_support.numpy_to_vtk(
+            num_array=points_as_numpy, deep=True, array_type=vtk.VTK_FLOAT
+        )
+        points2 = vtk.vtkPoints()
+        points2.SetData(vtk_data_array)
+        vtk_polydata.SetPoints(points2)
+        return
+
+    def get_numpy_points_from_vtk(self, vtk_polydata):
+        import vtk
+        from vtk.util import numpy_support
+
+        """
+    Returns the points as numpy from a vtk_polydata
+    """
+        points = vtk_polydata.GetPoints()
+        pointdata = points.GetData()
+        points_as_numpy = numpy_support.vtk_to_numpy(pointdata)
+        return points_as_numpy
+
+    def subsample_points_poisson(self, inputMesh, radius):
+        """
+        Return sub-sampled points as numpy array.
+        The radius might need to be tuned as per the requirements.
+        """
+        import vtk
+        from vtk.util import numpy_support
+
+        f = vtk.vtkPoissonDiskSampler()
+        f.SetInputData(inputMesh)
+        f.SetRadius(radius)
+        f.Update()
+
+        sampled_points = f.GetOutput()
+        return sampled_points
+
+    def subsample_points_voxelgrid_polydata(
+        self, inputMesh, boxLength, radius, divisions=None
+    ):
+        subsample = vtk.vtkVoxelGrid()
+        subsample.SetInputData(inputMesh)
+        subsample.SetConfigurationStyleToLeafSize()
+
+        subsample.SetLeafSize(radius, radius, radius)
+        subsample.Update()
+        points = subsample.GetOutput()
+        return points
+
+    def estimate_normals(
+        self, inputPoints, searchRadius=None, neighborCount=30, viewpoint=None
+    ):
+        """
+        Returns the PCA normal of each point, the direction of least variance of its neighbourhood.
+        The neighbourhood is all points within searchRadius, or the neighborCount nearest points if
+        no radius is given. The neighbourhoods are gathered with one KD-tree query and the 3x3
+        covariances of all points are diagonalized together.
+        Normals point towards the viewpoint if one is given, away from the centroid of the points for
+        viewpoint="centroid", and otherwise have a non-negative z component. Points with fewer than 3
+        neighbours get the normal (1, 1, 1)/sqrt(3), like the per-point PCA of an identity matrix.
+        """
+        from scipy.spatial import cKDTree
+
+        points = np.asarray(inputPoints, dtype=float)
+        pointNumber = len(points)
+        tree = cKDTree(points)
+        if searchRadius is not None:
+            neighborLists = tree.query_ball_point(points, searchRadius, workers=-1)
+            counts = np.fromiter(map(len, neighborLists), dtype=np.intp, count=pointNumber)
+            owners = np.repeat(np.arange(pointNumber), counts)
+            neighbors = points[np.concatenate(neighborLists).astype(np.intp)]
+            starts = np.cumsum(counts) - counts
+            means = np.add.reduceat(neighbors, starts, axis=0) / counts[:, np.newaxis]
+            centered = neighbors - means[owners]
+            covariances = np.add.reduceat(
+                np.einsum("ni,nj->nij", centered, centered), starts, axis=0
+            )
+        else:
+            counts = np.full(pointNumber, min(neighborCount, pointNumber))
+            _, indices = tree.query(points, k=counts[0], workers=-1)
+            neighbors = points[indices.reshape(pointNumber, -1)]
+            centered = neighbors - neighbors.mean(axis=1, keepdims=True)
+            covariances = np.einsum("nki,nkj->nij", centered, centered)
+        # eigenvalues are in ascending order, the first eigenvector is the normal
+        _, eigenVectors = np.linalg.eigh(covariances)
+        normals = eigenVectors[:, :, 0]
+        normals[counts < 3] = 1 / np.sqrt(3)
+
+        if viewpoint is None:
+            flip = normals[:, 2] < 0
+        elif isinstance(viewpoint, str) and viewpoint == "centroid":
+            flip = np.einsum("ni,ni->n", normals, points - points.mean(axis=0)) < 0
+        else:
+            flip = np.einsum("ni,ni->n", normals, np.asarray(viewpoint) - points) < 0
+        normals[flip] *= -1
+        return normals
+
+    def extract_pca_normal_scikit(self, inputPoints, searchRadius):
+        """
+        Returns the PCA normals of the points within searchRadius, with a non-negative z component.
+        """
+        return self.estimate_normals(inputPoints, searchRadius=searchRadius)
+
+    def extract_pca_normal(self, mesh, normalNeighbourCount):
+        import vtk
+        from vtk.util import numpy_support
+
+        normals = vtk.vtkPCANormalEstimation()
+        normals.SetSampleSize(normalNeighbourCount)
+        # normals.SetFlipNormals(True)
+        normals.SetNormalOrientationToPoint()
+        # normals.SetNormalOrientationToGraphTraversal()
+        normals.SetInputData(mesh)
+        normals.Update()
+        out1 = normals.GetOutput()
+        normal_array = numpy_support.vtk_to_numpy(out1.GetPoints().GetData())
+        point_array = numpy_support.vtk_to_numpy(mesh.GetPoints().GetData())
+        return point_array, normal_array
+
+    def get_fpfh_feature(self, points_np, normals_np, radius, neighbors):
+        import itk
+
+        pointset = itk.PointSet[itk.F, 3].New()
+        pointset.SetPoints(
+            itk.vector_container_from_array(points_np.flatten().astype("float32"))
+        )
+
+        normalset = itk.PointSet[itk.F, 3].New()
+        normalset.SetPoints(
+            itk.vector_container_from_array(normals_np.flatten().astype("float32"))
+        )
+        fpfh = itk.Fpfh.PointFeature.MF3MF3.New()
+        fpfh.ComputeFPFHFeature(pointset, normalset, float(radius), int(neighbors))
+        result = fpfh.GetFpfhFeature()
+
+        fpfh_feats = itk.array_from_vector_container(result)
+        fpfh_feats = np.reshape(fpfh_feats, [33, pointset.GetNumberOfPoints()]).T
+        return fpfh_feats
+
+    def getBoxLengths(self, inputMesh):
+        import vtk
+
+        box_filter = vtk.vtkBoundingBox()
+        box_filter.SetBounds(inputMesh.GetBounds())
+        diagonalLength = box_filter.GetDiagonalLength()
+        fixedLengths = [0.0, 0.0, 0.0]
+        box_filter.GetLengths(fixedLengths)
+        return fixedLengths, diagonalLength
+
+    def subsampleMeshes(
+        self,
+        sourceMesh,
+        targetMesh,
+        skipScaling,
+        parameters,
+        usePoissonSubsample=False,
+        featureCacheDirectory=None,
+    ):
+        """
+        Scales the points of sourceMesh in place to the size of targetMesh (unless skipScaling is set),
+        subsamples both meshes and computes the point normals and FPFH features of the subsampled points.
+        Returns the subsampled source and target points, their features, the voxel size and the scaling.
+        The features of each mesh are cached, see meshFeatures.
+        """
+        from vtk.util import numpy_support
+
+        print("parameters are ", parameters)
+        print(":: Loading point clouds and downsampling")
+
+        vtk_meshes = []
+        vtk_meshes.append(targetMesh)
+        vtk_meshes.append(sourceMesh)
+
+        # Scale the mesh and the landmark points
+        fixedBoxLengths, fixedlength = self.getBoxLengths(vtk_meshes[0])
+        movingBoxLengths, movinglength = self.getBoxLengths(vtk_meshes[1])
+
+        # Sub-Sample the points for rigid refinement and deformable registration
+        point_density = parameters["pointDensity"]
+
+        # Voxel size is the diagonal length of cuboid in the voxelGrid
+        voxel_size = np.sqrt(np.sum(np.square(np.array(fixedBoxLengths)))) / (
+            55 * point_density
+        )
+
+        print("Scale length are  ", fixedlength, movinglength)
+        print("Voxel Size is ", voxel_size)
+
+        scaling = fixedlength / movinglength
+
+        # the features only depend on the mesh and these settings, so they are cached by them
+        sourceMeshHash = self.meshHash(vtk_meshes[1])
+        targetMeshHash = self.meshHash(vtk_meshes[0])
+
+        points = vtk_meshes[1].GetPoints()
+        pointdata = points.GetData()
+        points_as_numpy = numpy_support.vtk_to_numpy(pointdata)
+
+        if skipScaling != 0:
+            scaling = 1
+            print("Scaling factor is ", scaling)
+        points_as_numpy = points_as_numpy * scaling
+        self.set_numpy_points_in_vtk(vtk_meshes[1], points_as_numpy)
+
+        sourceFullMesh_vtk = vtk_meshes[1]
+        targetFullMesh_vtk = vtk_meshes[0]
+
+        movingMeshPoints, movingMeshPointNormals, source_fpfh = self.meshFeatures(
+            sourceFullMesh_vtk,
+            [sourceMeshHash, scaling],
+            voxel_size,
+            parameters,
+            usePoissonSubsample,
+            featureCacheDirectory,
+        )
+        fixedMeshPoints, fixedMeshPointNormals, target_fpfh = self.meshFeatures(
+            targetFullMesh_vtk,
+            [targetMeshHash, 1],
+            voxel_size,
+            parameters,
+            usePoissonSubsample,
+            featureCacheDirectory,
+        )
+
+        print("------------------------------------------------------------")
+        print("movingMeshPoints.shape ", movingMeshPoints.shape)
+        print("movingMeshPointNormals.shape ", movingMeshPointNormals.shape)
+        print("fixedMeshPoints.shape ", fixedMeshPoints.shape)
+        print("fixedMeshPointNormals.shape ", fixedMeshPointNormals.shape)
+        print("------------------------------------------------------------")
+
+        target_down = fixedMeshPoints
+        source_down = movingMeshPoints
+        return source_down, target_down, source_fpfh, target_fpfh, voxel_size, scaling
+
+    def meshHash(self, mesh):
+        """
+        Hash of the point coordinates and polygons of a vtkPolyData.
+        """
+        from vtk.util import numpy_support
+
+        digest = hashlib.sha1()
+        digest.update(numpy_support.vtk_to_numpy(mesh.GetPoints().GetData()).tobytes())
+        polys = mesh.GetPolys()
+        if polys is not None and polys.GetNumberOfCells() > 0:
+            digest.update(numpy_support.vtk_to_numpy(polys.GetOffsetsArray()).tobytes())
+            digest.update(numpy_support.vtk_to_numpy(polys.GetConnectivityArray()).tobytes())
+        return digest.hexdigest()
+
+    def meshFeatures(
+        self,
+        mesh,
+        meshKey,
+        voxelSize,
+        parameters,
+        usePoissonSubsample=False,
+        featureCacheDirectory=None,
+    ):
+        """
+        Returns the subsampled points of the mesh, their normals and FPFH features. Results are cached
+        in memory, and in featureCacheDirectory if given, under a key made of meshKey (the hash of the
+        mesh before scaling and the scaling) and the subsampling and feature settings.
+        """
+        fpfh_radius = parameters["FPFHSearchRadius"] * voxelSize
+        fpfh_neighbors = parameters["FPFHNeighbors"]
+        key = hashlib.sha1(
+            repr(
+                meshKey
+                + [float(voxelSize), bool(usePoissonSubsample), 30]
+                + [float(fpfh_radius), int(fpfh_neighbors)]
+            ).encode("utf-8")
+        ).hexdigest()
+        features = readFeatureCache(key, featureCacheDirectory)
+        if features is not None:
+            print("Using cached mesh features")
+            return features
+
+        if usePoissonSubsample:
+            print("Using Poisson Point Subsampling Method")
+            subsampledMesh = self.subsample_points_poisson(mesh, radius=voxelSize)
+        else:
+            subsampledMesh = self.subsample_points_voxelgrid_polydata(
+                mesh, boxLength=self.getBoxLengths(mesh)[0], radius=voxelSize
+            )
+        meshPoints, meshPointNormals = self.extract_pca_normal(subsampledMesh, 30)
+        # New FPFH Code
+        fpfh = self.get_fpfh_feature(
+            np.expand_dims(meshPoints, -1), meshPointNormals, fpfh_radius, fpfh_neighbors
+        )
+        features = (np.array(meshPoints), np.array(meshPointNormals), fpfh)
+        writeFeatureCache(key, features, featureCacheDirectory)
+        return features
+
+    def cpd_registration(
+        self,
+        targetArray,
+        sourceArray,
+        CPDIterations,
+        CPDTolerance,
+        alpha_parameter,
+        beta_parameter,
+    ):
+        from cpdalp import DeformableRegistration
+
+        output = DeformableRegistration(
+            **{
+                "X": targetArray,
+                "Y": sourceArray,
+                "max_iterations": CPDIterations,
+                "tolerance": CPDTolerance,
+                "low_rank": True,
+            },
+            alpha=alpha_parameter,
+            beta=beta_parameter,
+        )
+        return output
+
+    def projectPointsPolydata(
+        self, sourcePolydata, targetPolydata, originalPoints, rayLength
+    ):
+        import vtk
+
+        print("original points: ", originalPoints.GetNumberOfPoints())
+        # set up polydata for projected points to return
+        projectedPointData = vtk.vtkPolyData()
+        projectedPoints = vtk.vtkPoints()
+        projectedPointData.SetPoints(projectedPoints)
+
+        # set up locater for intersection with normal vector rays
+        obbTree = vtk.vtkOBBTree()
+        obbTree.SetDataSet(targetPolydata)
+        obbTree.BuildLocator()
+
+        # set up point locator for finding surface normals and closest point
+        pointLocator = vtk.vtkPointLocator()
+        pointLocator.SetDataSet(sourcePolydata)
+        pointLocator.BuildLocator()
+
+        targetPointLocator = vtk.vtkPointLocator()
+        targetPointLocator.SetDataSet(targetPolydata)
+        targetPointLocator.BuildLocator()
+
+        # get surface normal from each landmark point
+        rayDirection = [0, 0, 0]
+        normalArray = sourcePolydata.GetPointData().GetArray("Normals")
+        if not normalArray:
+            print("no normal array, calculating....")
+            normalFilter = vtk.vtkPolyDataNormals()
+            normalFilter.ComputePointNormalsOn()
+            normalFilter.SetInputData(sourcePolydata)
+            normalFilter.Update()
+            normalArray = normalFilter.GetOutput().GetPointData().GetArray("Normals")
+            if not normalArray:
+                print("Error: no normal array")
+                return projectedPointData
+        for index in range(originalPoints.GetNumberOfPoints()):
+            originalPoint = originalPoints.GetPoint(index)
+            # get ray direction from closest normal
+            closestPointId = pointLocator.FindClosestPoint(originalPoint)
+            rayDirection = normalArray.GetTuple(closestPointId)
+            rayEndPoint = [0, 0, 0]
+            for dim in range(len(rayEndPoint)):
+                rayEndPoint[dim] = originalPoint[dim] + rayDirection[dim] * rayLength
+            intersectionIds = vtk.vtkIdList()
+            intersectionPoints = vtk.vtkPoints()
+            obbTree.IntersectWithLine(
+                originalPoint, rayEndPoint, intersectionPoints, intersectionIds
+            )
+            # if there are intersections, update the point to most external one.
+            if intersectionPoints.GetNumberOfPoints() > 0:
+                exteriorPoint = intersectionPoints.GetPoint(
+                    intersectionPoints.GetNumberOfPoints() - 1
+                )
+                projectedPoints.InsertNextPoint(exteriorPoint)
+            # if there are no intersections, reverse the normal vector
+            else:
+                for dim in range(len(rayEndPoint)):
+                    rayEndPoint[dim] = (
+                        originalPoint[dim] + rayDirection[dim] * -rayLength
+                    )
+                obbTree.IntersectWithLine(
+                    originalPoint, rayEndPoint, intersectionPoints, intersectionIds
+                )
+                if intersectionPoints.GetNumberOfPoints() > 0:
+                    exteriorPoint = intersectionPoints.GetPoint(0)
+                    projectedPoints.InsertNextPoint(exteriorPoint)
+                # if none in reverse direction, use closest mesh point
+                else:
+                    closestPointId = targetPointLocator.FindClosestPoint(originalPoint)
+                    rayOrigin = targetPolydata.GetPoint(closestPointId)
+                    projectedPoints.InsertNextPoint(rayOrigin)
+        return projectedPointData
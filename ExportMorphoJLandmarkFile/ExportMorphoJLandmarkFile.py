@@ -124,30 +124,44 @@ class ExportMorphoJLandmarkFileLogic(ScriptedLoadableModuleLogic):
     if(fileList == []):
       logging.info("No landmark files found in: ", inputDirectory)
       return False
-    success, currentLMNode = slicer.util.loadMarkupsFiducialList(fileList[0])
+    # parse the files directly, using the GPA landmark cache for unchanged files
+    import GPA
+    import Support.lm_io as lm_io
+    cacheDirectory = GPA.GPALogic().landmarkCacheDirectory()
     subjectNumber = len(fileList)
-    landmarkNumber = currentLMNode.GetNumberOfFiducials()
-    LMArray=np.zeros(shape=(subjectNumber,landmarkNumber,3))
-    fileIndex=0
+    landmarkNumber = None
     fileStems=[];
+    skippedFiles=[]
     headerLM = ["Subject"]
-    for pointIndex in range(currentLMNode.GetNumberOfMarkups()):
-      headerLM.append(currentLMNode.GetNthControlPointLabel(pointIndex)+'_X')
-      headerLM.append(currentLMNode.GetNthControlPointLabel(pointIndex)+'_Y')
-      headerLM.append(currentLMNode.GetNthControlPointLabel(pointIndex)+'_Z')
-
-    LPS = [-1,-1,1]
-    point = [0,0,0]
-    for file in fileList:
-      if fileIndex>0:
-        success, currentLMNode = slicer.util.loadMarkupsFiducialList(file)
-      fileStems.append(os.path.basename(file.split(extensionInput)[0]))
-      for pointIndex in range(currentLMNode.GetNumberOfMarkups()):
-        point=currentLMNode.GetNthControlPointPositionVector(pointIndex)
-        point.Set(point[0]*LPS[0],point[1]*LPS[1],point[2]*LPS[2])
-        LMArray[fileIndex, pointIndex,:]=point
-      slicer.mrmlScene.RemoveNode(currentLMNode)
-      fileIndex+=1
+
+    LPS = np.array([-1,-1,1])
+    for fileIndex, (result, error) in enumerate(lm_io.readLandmarkFiles(fileList, cacheDirectory=cacheDirectory)):
+      if result is None:
+        logging.info(f"Could not read landmark file {fileList[fileIndex]}: {error}")
+        return False
+      positions, defined, labels, descriptions, coordinateSystem = result
+      if landmarkNumber is None:
+        landmarkNumber = len(positions)
+        LMArray=np.zeros(shape=(subjectNumber,landmarkNumber,3))
+        for label in labels:
+          headerLM.append(label+'_X')
+          headerLM.append(label+'_Y')
+          headerLM.append(label+'_Z')
+      if len(positions) != landmarkNumber:
+        warning = f"{os.path.basename(fileList[fileIndex])}: {len(positions)} landmarks instead of {landmarkNumber}"
+        logging.warning("Skipped landmark file " + warning)
+        skippedFiles.append(warning)
+        continue
+      # export in LPS coordinates
+      if coordinateSystem == 'RAS':
+        positions = positions*LPS
+      LMArray[len(fileStems)]=positions
+      fileStems.append(os.path.basename(fileList[fileIndex].split(extensionInput)[0]))
+    subjectNumber = len(fileStems)
+    LMArray = LMArray[:subjectNumber]
+    if skippedFiles:
+      slicer.util.warningDisplay("The following files have a different number of landmarks than the first file "
+        "and were not exported:\n" + "\n".join(skippedFiles))
 
     temp = np.column_stack((np.array(fileStems), LMArray.reshape(subjectNumber, int(3 * landmarkNumber))))
     temp = np.vstack((np.array(headerLM), temp))
@@ -12,6 +12,8 @@ import fnmatch
 
 import Support.vtk_lib as vtk_lib
 import Support.gpa_lib as gpa_lib
+import Support.lm_io as lm_io
+import Support.resampling as resampling
 import  numpy as np
 from datetime import datetime
 import scipy.linalg as sp
@@ -222,7 +224,25 @@ class sliderGroup(qt.QGroupBox):
     self.setLayout(slidersLayout)
 
 class LMData:
-  def __init__(self):
+  """
+  Landmark coordinates (landmarks x 3 x subjects) and the GPA and PCA results.
+  lmOrig holds the input coordinates and is never modified, lm the aligned coordinates.
+
+  If storageDirectory is given, lmOrig and lm are memory-mapped .npy files in that directory and GPA and
+  PCA are computed over blocks of chunkSize subjects (1000 by default). Besides the memory-mapped files,
+  peak memory is then bounded by
+    - GPA: a few temporary copies of one block, about 6*p*3*chunkSize*8 bytes for p landmarks,
+    - PCA with fewer subjects n than coordinates 3p: the n x n Gram matrix and the 3p x n eigenvectors,
+    - PCA otherwise: the 3p x 3p covariance matrix and its eigenvectors.
+  """
+  # results written by writeOutData that onLoadFromFile parses when the binary results are not current
+  csvResultFiles=['OutputData.csv', 'MeanShape.csv', 'eigenvector.csv', 'eigenvalues.csv', 'pcScores.csv']
+
+  def __init__(self, storageDirectory=None, chunkSize=None):
+    self.storageDirectory=storageDirectory
+    self.chunkSize=chunkSize
+    if storageDirectory is not None and chunkSize is None:
+      self.chunkSize=1000
     self.lm=0
     self.lmOrig=0
     self.val=0
@@ -232,8 +252,14 @@ class LMData:
     self.tangentCoord=0
     self.shift=0
     self.centriodSize=0
-
-  def initializeFromDataFrame(self, outputData, meanShape, eigenVectors, eigenValues):
+    self.gpaTrace=[]
+    self.totalVariance=0
+    self.pcaError=None
+    self.scores=None
+    self.pairwiseDistances=None
+    self.consensus=None
+
+  def initializeFromDataFrame(self, outputData, meanShape, eigenVectors, eigenValues, pcScores=None):
     try:
       self.centriodSize = outputData.centeroid.to_numpy()
       self.centriodSize=self.centriodSize.reshape(-1,1)
@@ -245,19 +271,169 @@ class LMData:
       self.val = eigenValues.Scores.to_numpy()
       vectors = [name for name in eigenVectors.columns if 'PC ' in name]
       self.vec = eigenVectors[vectors].to_numpy()
+      self.totalVariance = self.val.sum()
       self.sortedEig = gpa_lib.pairEig(self.val, self.vec)
       self.procdist = outputData.proc_dist.to_numpy()
       self.procdist=self.procdist.reshape(-1,1)
+      if pcScores is not None:
+        self.scores = pcScores[[name for name in pcScores.columns if 'PC ' in name]].to_numpy()
       return 1
     except:
       print("Error loading results")
       return 0
 
+  def initializeFromBinary(self, resultsDirectory):
+    """
+    Loads results written by writeOutData from the BinaryResults folder. The arrays are memory-mapped,
+    so no csv file is parsed and the coordinates and eigenvectors are only read from disk when they are used.
+    The sample names are stored in self.files. Returns 0 if any of the csv result files changed since the
+    binary results were written, so they are parsed instead.
+    """
+    try:
+      binaryDirectory=os.path.join(resultsDirectory, 'BinaryResults')
+      stamps=lm_io.readBinaryResults(binaryDirectory, ['sourceStamps'])['sourceStamps']
+      if not np.array_equal(stamps, lm_io.fileStamps(resultsDirectory, self.csvResultFiles)):
+        logging.debug("Binary results are older than the csv results")
+        return 0
+      arrays = lm_io.readBinaryResults(binaryDirectory,
+        ['files', 'lm', 'mShape', 'val', 'vec', 'totalVariance', 'procdist', 'centriodSize', 'scores'])
+      self.files = arrays['files'].tolist()
+      self.lm = arrays['lm']
+      self.lmOrig = self.lm
+      self.mShape = np.array(arrays['mShape'])
+      self.val = np.array(arrays['val'])
+      self.vec = arrays['vec']
+      self.totalVariance = float(arrays['totalVariance'])
+      self.sortedEig = gpa_lib.pairEig(self.val, self.vec)
+      self.procdist = np.array(arrays['procdist']).reshape(-1,1)
+      self.centriodSize = np.array(arrays['centriodSize']).reshape(-1,1)
+      self.scores = arrays['scores']
+      return 1
+    except Exception as e:
+      logging.debug(f"Binary result import failed: {e}")
+      return 0
+
+  def cloudPoints(self, maxSpecimens=0, seed=0):
+    """
+    Returns the (n x 3) landmark points of all subjects, ordered by subject, and the landmark number of each point.
+    If maxSpecimens is smaller than the number of subjects, an independent random subset of maxSpecimens
+    subjects is used for each landmark and the points are ordered by landmark.
+    """
+    i,j,k=self.lm.shape
+    if maxSpecimens <= 0 or maxSpecimens >= k:
+      return np.transpose(self.lm,(2,0,1)).reshape(-1,3), np.tile(np.arange(1,i+1,dtype=float),k)
+    rng=np.random.default_rng(seed)
+    subjects=np.argsort(rng.random((i,k)),axis=1)[:,:maxSpecimens]
+    points=np.transpose(self.lm,(0,2,1))[np.arange(i)[:,np.newaxis],subjects]
+    return points.reshape(-1,3), np.repeat(np.arange(1,i+1,dtype=float),maxSpecimens)
+
+  def sharedLandmarkPath(self):
+    """
+    Returns a .npy file holding the aligned coordinates for worker processes to memory-map, and whether the
+    file was created for them. Memory-mapped coordinates are used in place, otherwise they are saved to a
+    new temporary file that the caller removes.
+    """
+    if isinstance(self.lm, np.memmap) and self.lm.filename is not None:
+      self.lm.flush()
+      return self.lm.filename, False
+    import tempfile
+    fileDescriptor, landmarkPath = tempfile.mkstemp(suffix='.npy', dir=self.storageDirectory)
+    with os.fdopen(fileDescriptor, 'wb') as f:
+      np.save(f, self.lm)
+    return landmarkPath, True
+
+  def bootstrap(self, replicateNumber, outputFolder, componentNumber=10, scale=True, alpha=0.05, seed=0, maxWorkers=None):
+    """
+    Runs replicateNumber bootstrap replicates of GPA and PCA in a process pool, each warm-started from the
+    mean shape, and writes percentile confidence intervals of the mean shape, the eigenvalues and the
+    eigenvector SDs of the first componentNumber PCs to outputFolder. Set scale to False for Boas coordinates.
+    """
+    os.makedirs(outputFolder, exist_ok=True)
+    componentNumber = min(componentNumber, self.vec.shape[1])
+    landmarkPath, temporary = self.sharedLandmarkPath()
+    try:
+      results = resampling.bootstrap(landmarkPath, self.mShape, np.real(self.vec[:,:componentNumber]), replicateNumber, scale,
+        alpha=alpha, seed=seed, maxWorkers=maxWorkers)
+    finally:
+      if temporary:
+        os.remove(landmarkPath)
+
+    i = self.mShape.shape[0]
+    headerLM = ["LM " + str(x + 1) for x in range(i)]
+    headerPC = ["PC " + str(x + 1) for x in range(componentNumber)]
+    headerCoordinates = ["LM " + str(x + 1) + "_" + axis for axis in "XYZ" for x in range(i)]
+    meanShapeInterval = results['meanShapeInterval']
+    lm_io.writeCsvTable(os.path.join(outputFolder, "bootstrapMeanShape.csv"),
+      ["", "X_lower", "Y_lower", "Z_lower", "X_upper", "Y_upper", "Z_upper"], headerLM, [np.hstack(meanShapeInterval)])
+    lm_io.writeCsvTable(os.path.join(outputFolder, "bootstrapEigenvalues.csv"), ["", "lower", "upper"], headerPC,
+      [np.transpose(results['eigenValueInterval'])])
+    lm_io.writeCsvTable(os.path.join(outputFolder, "bootstrapEigenvectorSD.csv"), [""] + headerPC, headerCoordinates,
+      [results['eigenVectorSD']])
+    return results
+
+  def permutationTest(self, groups, replicateNumber, outputFolder, seed=0, maxWorkers=None):
+    """
+    Permutation test of the between-group Procrustes sum of squares for the group label of each subject,
+    run in a process pool. Writes the observed statistic and p-value to outputFolder and returns them.
+    """
+    os.makedirs(outputFolder, exist_ok=True)
+    landmarkPath, temporary = self.sharedLandmarkPath()
+    try:
+      observed, pValue, statistics = resampling.permutationTest(landmarkPath, groups, replicateNumber, seed, maxWorkers)
+    finally:
+      if temporary:
+        os.remove(landmarkPath)
+    lm_io.writeCsvTable(os.path.join(outputFolder, "permutationTest.csv"), ["", "Observed", "PValue", "Replicates"],
+      ["BetweenGroupSS"], [[observed, pValue, replicateNumber]])
+    return observed, pValue
+
+  def calcPairwiseDistances(self, storageDirectory=None, blockSize=1000, maxWorkers=None):
+    """
+    Computes the (subjects x subjects) Procrustes distance matrix of the aligned subjects in tiles of blockSize
+    subjects with a thread pool. The matrix is memory-mapped from procrustesDistances.npy in storageDirectory
+    or in the landmark storage directory. Without either, it is mapped from a temporary file that is deleted
+    when the matrix is released.
+    """
+    k=self.lm.shape[2]
+    storageDirectory=storageDirectory or self.storageDirectory
+    if storageDirectory is None:
+      self.pairwiseDistances=lm_io.allocateTemporaryArray((k,k))
+    else:
+      self.pairwiseDistances=lm_io.allocateLandmarkArray((k,k), storageDirectory, 'procrustesDistances')
+    gpa_lib.pairwiseProcrustesDistances(self.lm, self.pairwiseDistances, blockSize, maxWorkers)
+    return self.pairwiseDistances
+
+  def releasePairwiseDistances(self):
+    """
+    Releases the pairwise distance matrix, which no longer matches the subjects after doGpa or addSpecimens,
+    and removes its procrustesDistances.npy file so a stale matrix is not reused.
+    """
+    filePaths=set()
+    if self.storageDirectory is not None:
+      filePaths.add(os.path.join(self.storageDirectory, 'procrustesDistances.npy'))
+    filePath=getattr(self.pairwiseDistances, 'filename', None)
+    if filePath is not None and os.path.basename(filePath)=='procrustesDistances.npy':
+      filePaths.add(filePath)
+    # the file is unmapped once the last reference is gone
+    self.pairwiseDistances=None
+    for filePath in filePaths:
+      if os.path.isfile(filePath):
+        os.remove(filePath)
+
+  def nearestSpecimens(self, specimenIndex, neighborNumber=5):
+    """
+    Returns the indices and Procrustes distances of the nearest subjects to each subject in specimenIndex,
+    computing the pairwise distance matrix first if needed.
+    """
+    if self.pairwiseDistances is None:
+      self.calcPairwiseDistances()
+    return gpa_lib.nearestNeighbors(self.pairwiseDistances, specimenIndex, neighborNumber)
+
   def calcLMVariation(self, SampleScaleFactor, BoasOption):
-    i,j,k=self.lmOrig.shape
+    i,j,k=self.lm.shape
     varianceMat=np.zeros((i,j))
     for subject in range(k):
-      tmp=pow((self.lmOrig[:,:,subject]-self.mShape),2)
+      tmp=pow((self.lm[:,:,subject]-self.mShape),2)
       varianceMat=varianceMat+tmp
     # if GPA scaling has been skipped, don't apply image size scaling factor
     if(BoasOption):
@@ -266,32 +442,161 @@ class LMData:
       varianceMat = SampleScaleFactor*np.sqrt(varianceMat/(k-1))
     return varianceMat
 
-  def doGpa(self,BoasOption):
+  def allocateArray(self, name, shape):
+    return lm_io.allocateLandmarkArray(shape, self.storageDirectory, name)
+
+  def doGpa(self, BoasOption, tolerance=0.0001, maxIterations=5, reflection=True, semiLandmarks=None, slidingCriterion='procD'):
+    self.releasePairwiseDistances()
     i,j,k=self.lmOrig.shape
-    self.centriodSize=np.zeros(k)
-    for subjectNum in range(k):
-      self.centriodSize[subjectNum]=np.linalg.norm(self.lmOrig[:,:,subjectNum]-self.lmOrig[:,:,subjectNum].mean(axis=0))
-    self.lm, self.mShape=gpa_lib.runGPA(self.lmOrig)
+    chunks=gpa_lib.specimenChunks(k, self.chunkSize)
+    self.centriodSize=np.concatenate([gpa_lib.centroidSizes(self.lmOrig[:,:,chunk]) for chunk in chunks])
+    self.lm=self.allocateArray('lm', self.lmOrig.shape)
+    self.lm, self.mShape, self.gpaTrace=gpa_lib.runGPAConvergence(self.lmOrig, True, tolerance, maxIterations, reflection, self.lm, self.chunkSize,
+      semiLandmarks=semiLandmarks, slidingCriterion=slidingCriterion)
+    print(f"GPA stopped after {len(self.gpaTrace)} iterations")
     self.procdist = gpa_lib.procDist(self.lm, self.mShape)
+    # consensus of the unit-size shapes, kept for addSpecimens
+    self.consensus = self.mShape
     if BoasOption:
       print("Calculating Boas coordinates")
-      for lmNum in range(i):
-        for dimNum in range(j):
-          for subjectNum in range(k):
-            self.lm[lmNum, dimNum, subjectNum] = self.centriodSize[subjectNum]*self.lm[lmNum, dimNum, subjectNum]
+      for chunk in chunks:
+        self.lm[:,:,chunk]*=self.centriodSize[np.newaxis, np.newaxis, chunk]
       self.mShape=self.lm.mean(axis=2)
 
-  def calcEigen(self):
-    i, j, k = self.lmOrig.shape
+  def calcConsensus(self, BoasOption):
+    """
+    Returns the consensus of the aligned unit-size shapes. Boas coordinates are divided by the centroid sizes
+    one block of subjects at a time, otherwise the consensus is the mean shape.
+    """
+    if not BoasOption:
+      return self.mShape
+    k=self.lm.shape[2]
+    centroidSize=np.ravel(self.centriodSize)
+    return sum((self.lm[:,:,chunk]/centroidSize[chunk]).sum(axis=2) for chunk in gpa_lib.specimenChunks(k, self.chunkSize))/k
+
+  def appendSubjects(self, name, newData):
+    """
+    Returns the array in the attribute name ('lm' or 'lmOrig') with the subjects of newData appended.
+    A writable memory-mapped file is released and grows in place with lm_io.growLandmarkFile, so only the new
+    subjects are written. Other arrays are copied once, into name.npy in the storage directory or into an
+    in-memory buffer with room for more subjects, and grow in place on later calls.
+    """
+    array=getattr(self, name)
+    i,j,k=array.shape
+    filePath=getattr(array, 'filename', None)
+    if filePath is not None and array.mode in ('r+', 'w+'):
+      array.flush()
+      # the file is unmapped once the last reference is gone
+      setattr(self, name, None)
+      del array
+      if lm_io.growLandmarkFile(filePath, newData):
+        return np.load(filePath, mmap_mode='r+')
+      array=np.load(filePath, mmap_mode='r')
+    if self.storageDirectory is None:
+      return lm_io.appendSubjects(array, newData)
+    # write a new file next to the one it replaces
+    temporaryName=name + '.' + str(os.getpid())
+    grown=lm_io.allocateLandmarkArray((i,j,k+newData.shape[2]), self.storageDirectory, temporaryName)
+    for chunk in gpa_lib.specimenChunks(k, self.chunkSize):
+      grown[:,:,chunk]=array[:,:,chunk]
+    grown[:,:,k:]=newData
+    grown.flush()
+    setattr(self, name, None)
+    del array, grown
+    filePath=os.path.join(self.storageDirectory, name + '.npy')
+    os.replace(os.path.join(self.storageDirectory, temporaryName + '.npy'), filePath)
+    return np.load(filePath, mmap_mode='r+')
+
+  def addSpecimens(self, newLandmarks, BoasOption=False, refineIterations=0, reflection=True, componentNumber=None):
+    """
+    Adds the (landmarks x 3 x m) newLandmarks to an existing analysis, computed with doGpa or loaded with
+    initializeFromBinary, without realigning the existing subjects. It is only available from Python.
+    The new shapes are aligned to the current consensus. With refineIterations=0 the PCA is kept and the new
+    subjects are projected onto its eigenvectors. Otherwise the new shapes are realigned refineIterations times
+    to the consensus updated with them and the PCA is updated with gpa_lib.incrementalPCA.
+    The coordinate arrays grow in place (see appendSubjects) and the consensus is kept between calls, so the
+    cost grows with m, not with the number of existing subjects. Only the first call after loading Boas
+    coordinates reads all subjects, to compute the consensus. The Procrustes distances of the existing
+    subjects are kept. The pairwise distance matrix is released and computed again when it is needed.
+    """
+    self.releasePairwiseDistances()
+    i,j,k=self.lm.shape
+    m=newLandmarks.shape[2]
+    newCentroidSize=gpa_lib.centroidSizes(newLandmarks)
+    if self.consensus is None:
+      self.consensus=self.calcConsensus(BoasOption)
+    consensus=self.consensus
+    newAligned=gpa_lib.scaleShapes(gpa_lib.centerShapes(newLandmarks))
+    newAligned=gpa_lib.procrustesAlignBatch(consensus, newAligned, reflection)
+    for iteration in range(refineIterations):
+      newAligned=gpa_lib.procrustesAlignBatch((k*consensus+newAligned.sum(axis=2))/(k+m), newAligned, reflection)
+    self.consensus=(k*consensus+newAligned.sum(axis=2))/(k+m)
+    newProcdist=gpa_lib.procDist(newAligned, self.consensus)
+    if BoasOption:
+      newAligned=newAligned*newCentroidSize[np.newaxis, np.newaxis, :]
+
+    newTwoDim=gpa_lib.makeTwoDim(newAligned)
+    if refineIterations > 0:
+      # update the PCA, its mean is the mean shape of the stored coordinates
+      previousMean=gpa_lib.makeTwoDim(self.mShape[:,:,np.newaxis])[:,0]
+      newCentered=newTwoDim-newTwoDim.mean(axis=1, keepdims=True)
+      self.totalVariance=(k*self.totalVariance+(newCentered**2).sum()
+        +k*m/float(k+m)*((newTwoDim.mean(axis=1)-previousMean)**2).sum())/(k+m)
+      self.val, self.vec, mean, previousScores=gpa_lib.incrementalPCA(np.real(self.val), np.real(self.vec), previousMean, k,
+        newTwoDim, componentNumber, self.scores)
+      self.sortedEig=gpa_lib.pairEig(self.val, self.vec)
+      self.pcaError=None
+      self.mShape=mean.reshape(i,j,order='F')
+    else:
+      previousScores=self.scores
+      self.mShape=(k*self.mShape+newAligned.sum(axis=2))/(k+m)
+    # scores that are not cached are computed by calcScores when they are needed
+    self.scores=None
+    if previousScores is not None:
+      self.scores=lm_io.appendSubjects(previousScores, np.dot(newTwoDim.T, np.real(self.vec)), axis=0)
+
+    # append the new subjects
+    if self.lmOrig is self.lm or not isinstance(self.lmOrig, np.ndarray):
+      self.lmOrig=None
+      self.lm=self.appendSubjects('lm', newAligned)
+      self.lmOrig=self.lm
+    else:
+      self.lm=self.appendSubjects('lm', newAligned)
+      self.lmOrig=self.appendSubjects('lmOrig', newLandmarks)
+    self.centriodSize=lm_io.appendSubjects(np.ravel(self.centriodSize), newCentroidSize)
+    self.procdist=lm_io.appendSubjects(np.ravel(self.procdist), newProcdist)
+
+  def calcEigen(self, componentNumber=None):
+    if componentNumber is None and self.storageDirectory is not None:
+      # accumulate the PCA over blocks of the memory-mapped coordinates
+      self.val, self.vec=gpa_lib.calcPCAChunked(self.lm, self.chunkSize)
+      self.totalVariance=self.val.sum()
+      self.pcaError=None
+      self.sortedEig = gpa_lib.pairEig(self.val, self.vec)
+      self.calcScores()
+      return
     twoDim=gpa_lib.makeTwoDim(self.lm)
-    covMatrix=gpa_lib.calcCov(twoDim)
-    if k>i*j: # limit results returned if sample number is less than observations
-      self.val, self.vec = sp.eigh(covMatrix)
+    if componentNumber is None:
+      # thin SVD when there are fewer subjects than coordinates, covariance eigh otherwise
+      self.val, self.vec=gpa_lib.calcPCA(twoDim)
+      self.totalVariance=self.val.sum()
+      self.pcaError=None
     else:
-      self.val, self.vec=sp.eigh(covMatrix, eigvals=(i * j - k, i * j - 1))
-    self.val=self.val[::-1]
-    self.vec=self.vec[:, ::-1]
+      # randomized PCA of the leading components only
+      self.val, self.vec, self.totalVariance, self.pcaError=gpa_lib.calcPCARandomized(twoDim, componentNumber)
+      print(f"Randomized PCA: {len(self.val)} components, maximum relative eigenpair residual {self.pcaError.max():.2e}")
     self.sortedEig = gpa_lib.pairEig(self.val, self.vec)
+    self.scores=np.dot(np.transpose(twoDim), np.real(self.vec))
+
+  def calcScores(self):
+    """
+    Computes the (subjects x PCs) matrix of PC scores, one block of subjects at a time, and caches it in self.scores.
+    """
+    i,j,k=self.lm.shape
+    vec=np.real(self.vec)
+    self.scores=np.concatenate([np.dot(np.transpose(gpa_lib.makeTwoDim(self.lm[:,:,chunk])), vec)
+      for chunk in gpa_lib.specimenChunks(k, self.chunkSize or 1000)])
+    return self.scores
 
   def ExpandAlongPCs(self, numVec,scaleFactor,SampleScaleFactor):
     b=0
@@ -309,78 +614,91 @@ class LMData:
 
     self.shift=tmp
 
-  def writeOutData(self, outputFolder, files):
+  def calcPCDisplacementFields(self, sourceLandmarks, points, pcNumber, SampleScaleFactor):
+    """
+    Returns the (pcNumber x m x 3) displacements of the points for a unit scale factor along each of the
+    first pcNumber PCs. The landmark shifts match ExpandAlongPCs and are interpolated with a TPS warp from
+    the source landmarks, so ExpandAlongPCs followed by a TPS transform is a linear combination of the fields.
+    """
+    i=sourceLandmarks.shape[0]
+    vec=np.real(self.vec[:,:pcNumber])
+    displacements=np.transpose(vec.reshape(i,3,-1,order='F'),(2,0,1))*SampleScaleFactor/3
+    return gpa_lib.tpsDisplacementFields(sourceLandmarks, displacements, points)
+
+  def calcPCScoreDisplacementFields(self, sourceLandmarks, points, pcScaleList):
+    """
+    Returns the (len(pcScaleList) x m x 3) displacements of the points for a list of (PC, SD) pairs,
+    PCs numbered from 1. Each pair moves the landmarks by SD standard deviations along the PC.
+    """
+    i=sourceLandmarks.shape[0]
+    val=np.real(self.val)
+    vec=np.real(self.vec)
+    displacements=np.array([sd*np.sqrt(np.abs(val[pc-1]))*vec[:,pc-1].reshape(i,3,order='F') for pc, sd in pcScaleList])
+    return gpa_lib.tpsDisplacementFields(sourceLandmarks, displacements, points)
+
+  def writeOutData(self, outputFolder, files, binaryResults=True):
     # make headers for eigenvector matrix
     headerPC = []
-    headerLM = [""]
+    headerLM = []
     for i in range(self.vec.shape[1]):
       headerPC.append("PC " + str(i + 1))
     for i in range(int(self.vec.shape[0] / 3)):
       headerLM.append("LM " + str(i + 1) + "_X")
       headerLM.append("LM " + str(i + 1) + "_Y")
       headerLM.append("LM " + str(i + 1) + "_Z")
-    r,c=self.vec.shape
-    temp=np.empty(shape=(r+1,c), dtype = object)
-    temp[0,:] = np.array(headerPC)
-    for currentRow in range(r):
-      temp[currentRow+1,:] = self.vec[currentRow,:]
-    #temp = np.vstack((np.array(headerPC), self.vec))
-    temp = np.column_stack((np.array(headerLM), temp))
-    np.savetxt(outputFolder + os.sep + "eigenvector.csv", temp, delimiter=",", fmt='%s')
-    temp = np.column_stack((np.array(headerPC), self.val))
-    np.savetxt(outputFolder + os.sep + "eigenvalues.csv", temp, delimiter=",", fmt='%s')
+    vec = np.real(self.vec)
+    lm_io.writeCsvTable(outputFolder + os.sep + "eigenvector.csv", [""] + headerPC, headerLM, [vec])
+    lm_io.writeCsvTable(outputFolder + os.sep + "eigenvalues.csv", None, headerPC, [np.real(self.val).reshape(-1,1)])
 
-    headerLM = []
-    headerCoordinate = ["", "X", "Y", "Z"]
+    headerMeanLM = []
     for i in range(len(self.mShape)):
-      headerLM.append("LM " + str(i + 1))
-    temp = np.column_stack((np.array(headerLM), self.mShape))
-    temp = np.vstack((np.array(headerCoordinate), temp))
-    np.savetxt(outputFolder + os.sep + "MeanShape.csv", temp, delimiter=",", fmt='%s')
-
-    percentVar = self.val / self.val.sum()
-    files = np.array(files)
-    i = files.shape
-    files = files.reshape(i[0], 1)
-    k, j, i = self.lmOrig.shape
-
-    coords = self.flattenArray(self.lm)
-    self.procdist = self.procdist.reshape(i, 1)
-    self.centriodSize = self.centriodSize.reshape(i, 1)
-    tmp = np.column_stack((files, self.procdist, self.centriodSize, np.transpose(coords)))
-    header = np.array(['Sample_name', 'proc_dist', 'centeroid'])
-    i1, j = tmp.shape
-    coodrsL = (j - 3) / 3.0
-    l = np.zeros(int(3 * coodrsL))
-
-    l = list(l)
-
-    for x in range(int(coodrsL)):
-      loc = x + 1
-      l[3 * x] = "LM " + str(loc) + "_X"
-      l[3 * x + 1] = "LM " + str(loc) + "_Y"
-      l[3 * x + 2] = "LM " + str(loc) + "_Z"
-    l = np.array(l)
-    header = np.column_stack((header.reshape(1, 3), l.reshape(1, int(3 * coodrsL))))
-    tmp1 = np.vstack((header, tmp))
-    np.savetxt(outputFolder + os.sep + "OutputData.csv", tmp1, fmt="%s", delimiter=",")
-
-    # calc PC scores
-    twoDcoors = gpa_lib.makeTwoDim(self.lm)
-    scores = np.dot(np.transpose(twoDcoors), self.vec)
-    scores = np.real(scores)
-    headerPC.insert(0, "Sample_name")
-    temp = np.column_stack((files.reshape(i, 1), scores))
-    temp = np.vstack((headerPC, temp))
-    np.savetxt(outputFolder + os.sep + "pcScores.csv", temp, fmt="%s", delimiter=",")
+      headerMeanLM.append("LM " + str(i + 1))
+    lm_io.writeCsvTable(outputFolder + os.sep + "MeanShape.csv", ["", "X", "Y", "Z"], headerMeanLM, [self.mShape])
+
+    # stream the coordinates and PC scores in blocks of subjects
+    i, j, k = self.lm.shape
+    files = list(files)
+    self.procdist = self.procdist.reshape(k, 1)
+    self.centriodSize = self.centriodSize.reshape(k, 1)
+    chunks = gpa_lib.specimenChunks(k, self.chunkSize or 1000)
+    outputBlocks = (np.column_stack((self.procdist[chunk], self.centriodSize[chunk], np.transpose(self.flattenArray(self.lm[:,:,chunk]))))
+      for chunk in chunks)
+    lm_io.writeCsvTable(outputFolder + os.sep + "OutputData.csv", ['Sample_name', 'proc_dist', 'centeroid'] + headerLM, files, outputBlocks)
+
+    # PC scores
+    if self.scores is None:
+      self.calcScores()
+    lm_io.writeCsvTable(outputFolder + os.sep + "pcScores.csv", ["Sample_name"] + headerPC, files, [self.scores])
+
+    # binary copy of the results for fast reloading
+    if binaryResults:
+      self.writeBinaryResults(outputFolder, files)
+
+  def writeBinaryResults(self, outputFolder, files):
+    if self.scores is None:
+      self.calcScores()
+    # the csv files are written first, their size and modification time mark the binary results as current
+    lm_io.writeBinaryResults(outputFolder + os.sep + "BinaryResults", {
+      'sourceStamps': lm_io.fileStamps(outputFolder, self.csvResultFiles),
+      'files': np.array(files, dtype=np.str_), 'lm': self.lm, 'mShape': self.mShape, 'val': np.real(self.val), 'vec': np.real(self.vec),
+      'totalVariance': np.array(self.totalVariance), 'procdist': self.procdist.reshape(-1,1),
+      'centriodSize': self.centriodSize.reshape(-1,1), 'scores': self.scores})
+
+    # GPA convergence trace
+    if len(self.gpaTrace) > 0:
+      self.writeGpaTrace(outputFolder + os.sep + "gpaTrace.csv")
+
+  def writeGpaTrace(self, filePath):
+    with open(filePath, 'w', newline='') as f:
+      writer = csv.writer(f)
+      writer.writerow(['Iteration', 'MeanShapeDelta', 'ProcrustesSS', 'Time'])
+      for step in self.gpaTrace:
+        writer.writerow([step['iteration'], step['meanShapeDelta'], step['procrustesSS'], step['time']])
 
   def flattenArray(self, dataArray):
+    # one column per subject holding x1,y1,z1,x2,...
     i,j,k=dataArray.shape
-    tmp=np.zeros((i*j,k))
-    for x in range(k):
-        vec=np.reshape(dataArray[:,:,x],(i*j),order='A')
-        tmp[:,x]=vec
-    return tmp
+    return np.reshape(dataArray,(i*j,k)).astype(float)
 
   def closestSample(self,files):
     import operator
@@ -468,10 +786,59 @@ class GPAWidget(ScriptedLoadableModuleWidget):
     self.BoasOptionCheckBox.setToolTip("If checked, GPA will skip scaling.")
     inputLayout.addWidget(self.BoasOptionCheckBox, 5,2)
 
+    self.gpaToleranceLabel=qt.QLabel('GPA tolerance')
+    inputLayout.addWidget(self.gpaToleranceLabel,6,1)
+
+    self.gpaToleranceText=qt.QLineEdit()
+    self.gpaToleranceText.setText("0.0001")
+    self.gpaToleranceText.setToolTip("GPA stops when the change in mean shape between iterations is below this value")
+    inputLayout.addWidget(self.gpaToleranceText,6,2,1,2)
+
+    self.gpaIterationsLabel=qt.QLabel('GPA maximum iterations')
+    inputLayout.addWidget(self.gpaIterationsLabel,7,1)
+
+    self.gpaIterationsSpinBox=qt.QSpinBox()
+    self.gpaIterationsSpinBox.setMinimum(1)
+    self.gpaIterationsSpinBox.setMaximum(1000)
+    self.gpaIterationsSpinBox.setValue(5)
+    self.gpaIterationsSpinBox.setToolTip("Maximum number of GPA iterations")
+    inputLayout.addWidget(self.gpaIterationsSpinBox,7,2,1,2)
+
+    self.randomizedPCACheckBox = qt.QCheckBox()
+    self.randomizedPCACheckBox.setText("Randomized PCA, number of components:")
+    self.randomizedPCACheckBox.checked = 0
+    self.randomizedPCACheckBox.setToolTip("If checked, only the leading principal components are computed with a randomized SVD. Use for very large landmark sets.")
+    inputLayout.addWidget(self.randomizedPCACheckBox,8,2)
+
+    self.randomizedPCASpinBox=qt.QSpinBox()
+    self.randomizedPCASpinBox.setMinimum(1)
+    self.randomizedPCASpinBox.setMaximum(1000)
+    self.randomizedPCASpinBox.setValue(20)
+    self.randomizedPCASpinBox.setToolTip("Number of principal components computed by the randomized PCA")
+    inputLayout.addWidget(self.randomizedPCASpinBox,8,3)
+
+    self.memoryMapCheckBox = qt.QCheckBox()
+    self.memoryMapCheckBox.setText("Store landmark data on disk")
+    self.memoryMapCheckBox.checked = 0
+    self.memoryMapCheckBox.setToolTip("If checked, landmark coordinates are memory-mapped from the output folder and GPA + PCA are computed in blocks of subjects. Use for datasets that do not fit in memory.")
+    inputLayout.addWidget(self.memoryMapCheckBox,9,2)
+
+    self.slideSemiCheckBox = qt.QCheckBox()
+    self.slideSemiCheckBox.setText("Slide semi-landmarks, minimizing:")
+    self.slideSemiCheckBox.checked = 0
+    self.slideSemiCheckBox.setToolTip("If checked, landmarks with the description 'Semi' slide along their tangent planes before each GPA iteration. Tangent planes are estimated from the neighboring landmarks.")
+    inputLayout.addWidget(self.slideSemiCheckBox,10,2)
+
+    self.slidingCriterionComboBox=qt.QComboBox()
+    self.slidingCriterionComboBox.addItem("Procrustes distance")
+    self.slidingCriterionComboBox.addItem("Bending energy")
+    self.slidingCriterionComboBox.setToolTip("Quantity minimized by sliding the semi-landmarks against the mean shape")
+    inputLayout.addWidget(self.slidingCriterionComboBox,10,3)
+
     #Load Button
     self.loadButton = qt.QPushButton("Execute GPA + PCA")
     self.loadButton.checkable = True
-    inputLayout.addWidget(self.loadButton,6,1,1,3)
+    inputLayout.addWidget(self.loadButton,11,1,1,3)
     self.loadButton.toolTip = "Push to start the program. Make sure you have filled in all the data."
     self.loadButton.enabled = False
     self.loadButton.connect('clicked(bool)', self.onLoad)
@@ -479,7 +846,7 @@ class GPAWidget(ScriptedLoadableModuleWidget):
     #Open Results
     self.openResultsButton = qt.QPushButton("View output files")
     self.openResultsButton.checkable = True
-    inputLayout.addWidget(self.openResultsButton,7,1,1,3)
+    inputLayout.addWidget(self.openResultsButton,12,1,1,3)
     self.openResultsButton.toolTip = "Push to open the folder where the GPA + PCA results are stored"
     self.openResultsButton.enabled = False
     self.openResultsButton.connect('clicked(bool)', self.onOpenResults)
@@ -576,6 +943,16 @@ class GPAWidget(ScriptedLoadableModuleWidget):
     distributionLayout.addWidget(noneTypeLabel,5,1)
     distributionLayout.addWidget(self.NoneType,5,2,1,2)
 
+    self.cloudSubsampleSpinBox=qt.QSpinBox()
+    self.cloudSubsampleSpinBox.minimum=0
+    self.cloudSubsampleSpinBox.maximum=1000000
+    self.cloudSubsampleSpinBox.value=0
+    self.cloudSubsampleSpinBox.specialValueText="All"
+    self.cloudSubsampleSpinBox.setToolTip("Maximum number of randomly selected specimens plotted per landmark in the point cloud")
+    cloudSubsampleLabel=qt.QLabel("Point cloud specimens per LM")
+    distributionLayout.addWidget(cloudSubsampleLabel,6,1)
+    distributionLayout.addWidget(self.cloudSubsampleSpinBox,6,2,1,2)
+
     self.scaleSlider = ctk.ctkSliderWidget()
     self.scaleSlider.singleStep = .1
     self.scaleSlider.minimum = 0
@@ -763,6 +1140,11 @@ class GPAWidget(ScriptedLoadableModuleWidget):
     self.stopRecordButton.enabled = False
     animateLayout.addWidget(self.stopRecordButton,1,5,1,2)
     self.stopRecordButton.connect('clicked(bool)', self.onStopRecording)
+    self.exportExtremesButton = qt.QPushButton("Export PC extremes")
+    self.exportExtremesButton.toolTip = "Save the PC warped model at -2 and +2 standard deviations of each listed PC, with snapshots."
+    self.exportExtremesButton.enabled = False
+    animateLayout.addWidget(self.exportExtremesButton,2,1,1,6)
+    self.exportExtremesButton.connect('clicked(bool)', self.onExportExtremes)
 
     # Reset button
     resetButton = qt.QPushButton("Reset Scene")
@@ -856,7 +1238,7 @@ class GPAWidget(ScriptedLoadableModuleWidget):
     self.slider2.populateComboBox(self.PCList)
     self.PCList.append('None')
     self.LM.val=np.real(self.LM.val)
-    percentVar=self.LM.val/self.LM.val.sum()
+    percentVar=self.LM.val/self.LM.totalVariance
     self.vectorOne.clear()
     self.vectorTwo.clear()
     self.vectorThree.clear()
@@ -984,9 +1366,16 @@ class GPAWidget(ScriptedLoadableModuleWidget):
     self.selectFactor.clear()
     self.factorName.setText("")
     self.scaleSlider.value=3
+    self.cloudSubsampleSpinBox.value=0
 
     self.scaleMeanShapeSlider.value=3
     self.meanShapeColor.color=qt.QColor(250,128,114)
+    self.gpaToleranceText.setText("0.0001")
+    self.gpaIterationsSpinBox.setValue(5)
+    self.randomizedPCACheckBox.checked = 0
+    self.memoryMapCheckBox.checked = 0
+    self.slideSemiCheckBox.checked = 0
+    self.slidingCriterionComboBox.currentIndex = 0
 
     self.scaleSlider.enabled = False
 
@@ -1003,6 +1392,7 @@ class GPAWidget(ScriptedLoadableModuleWidget):
     self.selectorButton.enabled = False
     self.stopRecordButton.enabled = False
     self.startRecordButton.enabled = False
+    self.exportExtremesButton.enabled = False
 
     #delete data from previous runs
     self.nodeCleanUp()
@@ -1082,26 +1472,34 @@ class GPAWidget(ScriptedLoadableModuleWidget):
   def onLoadFromFile(self):
     self.initializeOnLoad() #clean up module from previous runs
     logic = GPALogic()
-    import pandas
-
-    # Load data
-    outputDataPath = os.path.join(self.resultsDirectory, 'OutputData.csv')
-    meanShapePath = os.path.join(self.resultsDirectory, 'MeanShape.csv')
-    eigenVectorPath = os.path.join(self.resultsDirectory, 'eigenvector.csv')
-    eigenValuePath = os.path.join(self.resultsDirectory, 'eigenvalues.csv')
-    eigenValueNames = ['Index', 'Scores']
-    try:
-      eigenValues = pandas.read_csv(eigenValuePath, names=eigenValueNames)
-      eigenVector = pandas.read_csv(eigenVectorPath)
-      meanShape = pandas.read_csv(meanShapePath)
-      outputData = pandas.read_csv(outputDataPath)
-    except:
-      logging.debug('Result import failed: Missing file')
-      return
+
+    # Load data, the binary results are used if they match the csv files, otherwise the csv files are parsed
+    self.LM=LMData()
+    binaryLoaded = self.LM.initializeFromBinary(self.resultsDirectory)
+    if not binaryLoaded:
+      import pandas
+      outputDataPath = os.path.join(self.resultsDirectory, 'OutputData.csv')
+      meanShapePath = os.path.join(self.resultsDirectory, 'MeanShape.csv')
+      eigenVectorPath = os.path.join(self.resultsDirectory, 'eigenvector.csv')
+      eigenValuePath = os.path.join(self.resultsDirectory, 'eigenvalues.csv')
+      pcScoresPath = os.path.join(self.resultsDirectory, 'pcScores.csv')
+      eigenValueNames = ['Index', 'Scores']
+      try:
+        eigenValues = pandas.read_csv(eigenValuePath, names=eigenValueNames)
+        eigenVector = pandas.read_csv(eigenVectorPath)
+        meanShape = pandas.read_csv(meanShapePath)
+        outputData = pandas.read_csv(outputDataPath)
+      except:
+        logging.debug('Result import failed: Missing file')
+        return
+      pcScores = None
+      if os.path.isfile(pcScoresPath):
+        pcScores = pandas.read_csv(pcScoresPath)
 
     # Try to load skip scaling and skip LM options from log file, if present
     self.BoasOption = False
     self.LMExclusionList=[]
+    totalVariance = None
     logFilePath = os.path.join(self.resultsDirectory, 'analysis.log')
     try:
       with open(logFilePath) as f:
@@ -1113,6 +1511,8 @@ class GPAWidget(ScriptedLoadableModuleWidget):
             header, skippedText = line.split('=')
             if skippedText != '':
               self.LMExclusionList = [int(i) for i in skippedText.split(',')]
+          if 'TotalVariance' in search:
+            totalVariance = float(search.rstrip().split('=')[1])
     except:
       logging.debug('Log import failed: Cannot read scaling option from log file')
       logging.debug('Log import failed: Cannot read skipped landmarks from log file')
@@ -1120,12 +1520,21 @@ class GPAWidget(ScriptedLoadableModuleWidget):
     print("Skipped Landmarks: ", self.LMExclusionList)
 
     # Initialize variables
-    self.LM=LMData()
-    success = self.LM.initializeFromDataFrame(outputData, meanShape, eigenVector, eigenValues)
-    if not success:
-      return
-
-    self.files = outputData.Sample_name.tolist()
+    if binaryLoaded:
+      self.files = self.LM.files
+    else:
+      success = self.LM.initializeFromDataFrame(outputData, meanShape, eigenVector, eigenValues, pcScores)
+      if not success:
+        return
+      # a randomized PCA only stores the leading eigenvalues, restore the total variance from the log
+      if totalVariance is not None:
+        self.LM.totalVariance = totalVariance
+      self.files = outputData.Sample_name.tolist()
+      # save the binary results so the csv files do not need to be parsed again next time
+      try:
+        self.LM.writeBinaryResults(self.resultsDirectory, self.files)
+      except OSError as e:
+        logging.debug(f"Could not write binary results: {e}")
     shape = self.LM.lmOrig.shape
     print('Loaded ' + str(shape[2]) + ' subjects with ' + str(shape[0]) + ' landmark points.')
 
@@ -1176,13 +1585,13 @@ class GPAWidget(ScriptedLoadableModuleWidget):
     self.populateDistanceTable(self.files)
     print("Closest sample to mean:" + filename)
 
-    #Setup for scatter plots
+    #Setup for scatter plots from the saved PC scores
     shape = self.LM.lm.shape
-    self.LM.calcEigen()
+    if self.LM.scores is None:
+      self.LM.calcScores()
     self.scatterDataAll= np.zeros(shape=(shape[2],self.pcNumber))
-    for i in range(self.pcNumber):
-      data=gpa_lib.plotTanProj(self.LM.lm,self.LM.sortedEig,i,1)
-      self.scatterDataAll[:,i] = data[:,0]
+    scoreNumber = min(self.pcNumber, self.LM.scores.shape[1])
+    self.scatterDataAll[:,:scoreNumber] = self.LM.scores[:,:scoreNumber]
 
     # Set up layout
     self.assignLayoutDescription()
@@ -1211,8 +1620,15 @@ class GPAWidget(ScriptedLoadableModuleWidget):
     self.initializeOnLoad() #clean up module from previous runs
     logic = GPALogic()
 
+    # output folder, also holds the memory-mapped landmark data if requested
+    dateTimeStamp = datetime.now().strftime('%Y-%m-%d_%H_%M_%S')
+    self.outputFolder = os.path.join(self.outputDirectory, dateTimeStamp)
+    storageDirectory = None
+    if self.memoryMapCheckBox.checked:
+      storageDirectory = os.path.join(self.outputFolder, 'LandmarkStorage')
+
     # get landmarks
-    self.LM=LMData()
+    self.LM=LMData(storageDirectory)
     lmToExclude=self.excludeLMText.text
     if len(lmToExclude) != 0:
       self.LMExclusionList=lmToExclude.split(",")
@@ -1222,7 +1638,7 @@ class GPAWidget(ScriptedLoadableModuleWidget):
     else:
       self.LMExclusionList=[]
     try:
-      self.LM.lmOrig, self.landmarkTypeArray = logic.loadLandmarks(self.inputFilePaths, self.LMExclusionList, self.extension)
+      self.LM.lmOrig, self.landmarkTypeArray = logic.loadLandmarks(self.inputFilePaths, self.LMExclusionList, self.extension, storageDirectory=storageDirectory)
     except:
       logging.debug('Load landmark data failed: Could not create an array from landmark files')
       return
@@ -1231,13 +1647,29 @@ class GPAWidget(ScriptedLoadableModuleWidget):
 
     # Do GPA
     self.BoasOption=self.BoasOptionCheckBox.checked
-    self.LM.doGpa(self.BoasOption)
-    self.LM.calcEigen()
+    try:
+      self.gpaTolerance=float(self.gpaToleranceText.text)
+    except ValueError:
+      logging.debug('Invalid GPA tolerance, using default')
+      self.gpaTolerance=0.0001
+    self.gpaMaxIterations=self.gpaIterationsSpinBox.value
+    self.slidingCriterion=None
+    semiLandmarks=None
+    if self.slideSemiCheckBox.checked and len(self.landmarkTypeArray) > 0:
+      self.slidingCriterion=['procD', 'bendingEnergy'][self.slidingCriterionComboBox.currentIndex]
+      keepIndex=[j for j in range(shape[0]+len(self.LMExclusionList)) if j+1 not in self.LMExclusionList]
+      semiLandmarks=np.array([str(j+1) in self.landmarkTypeArray for j in keepIndex])
+    self.LM.doGpa(self.BoasOption, self.gpaTolerance, self.gpaMaxIterations, semiLandmarks=semiLandmarks,
+      slidingCriterion=self.slidingCriterion or 'procD')
+    if self.randomizedPCACheckBox.checked:
+      self.LM.calcEigen(self.randomizedPCASpinBox.value)
+    else:
+      self.LM.calcEigen()
     self.pcNumber=10
     self.updateList()
 
     #set scaling factor using mean of landmarks
-    self.rawMeanLandmarks = self.LM.lmOrig.mean(2)
+    self.rawMeanLandmarks = self.LM.lm.mean(2)
     logic = GPALogic()
     self.sampleSizeScaleFactor = logic.dist2(self.rawMeanLandmarks).max()
     print("Scale Factor: " + str(self.sampleSizeScaleFactor))
@@ -1273,10 +1705,8 @@ class GPAWidget(ScriptedLoadableModuleWidget):
     self.copyLandmarkNode.SetDisplayVisibility(0)
 
     # Set up output
-    dateTimeStamp = datetime.now().strftime('%Y-%m-%d_%H_%M_%S')
-    self.outputFolder = os.path.join(self.outputDirectory, dateTimeStamp)
     try:
-      os.makedirs(self.outputFolder)
+      os.makedirs(self.outputFolder, exist_ok=True)
       self.LM.writeOutData(self.outputFolder, self.files)
       self.writeAnalysisLogFile(self.LM_dir_name, self.outputFolder, self.files)
       self.openResultsButton.enabled = True
@@ -1289,12 +1719,8 @@ class GPAWidget(ScriptedLoadableModuleWidget):
     self.populateDistanceTable(self.files)
     print("Closest sample to mean:" + filename)
 
-    #Setup for scatter plots
-    shape = self.LM.lm.shape
-    self.scatterDataAll= np.zeros(shape=(shape[2],self.pcNumber))
-    for i in range(self.pcNumber):
-      data=gpa_lib.plotTanProj(self.LM.lm,self.LM.sortedEig,i,1)
-      self.scatterDataAll[:,i] = data[:,0]
+    #Setup for scatter plots from the PC scores computed with the PCA
+    self.scatterDataAll = np.array(self.LM.scores[:,:self.pcNumber])
 
     # Set up layout
     self.assignLayoutDescription()
@@ -1374,6 +1800,13 @@ class GPAWidget(ScriptedLoadableModuleWidget):
     logFile.write("eigenvectors=eigenvectors.csv" + "\n")
     logFile.write("OutputData=OutputData.csv" + "\n")
     logFile.write("pcScores=pcScores.csv" + "\n")
+    logFile.write("GPATolerance=" + str(self.gpaTolerance) + "\n")
+    logFile.write("GPAMaxIterations=" + str(self.gpaMaxIterations) + "\n")
+    logFile.write("GPAIterations=" + str(len(self.LM.gpaTrace)) + "\n")
+    logFile.write("gpaTrace=gpaTrace.csv" + "\n")
+    logFile.write("SlidingCriterion=" + str(self.slidingCriterion) + "\n")
+    logFile.write("PCAComponents=" + str(len(self.LM.val)) + "\n")
+    logFile.write("TotalVariance=" + str(self.LM.totalVariance) + "\n")
     landmarkType_list = ",".join(self.landmarkTypeArray)
     logFile.write("SemiLandmarks= " + landmarkType_list)
     logFile.close()
@@ -1481,7 +1914,7 @@ class GPAWidget(ScriptedLoadableModuleWidget):
     if self.NoneType.isChecked():
       self.unplotDistributions()
     elif self.CloudType.isChecked():
-      self.plotDistributionCloud()
+      self.plotDistributionCloud(self.cloudSubsampleSpinBox.value)
     else:
       self.plotDistributionGlyph(2*self.scaleSlider.value)
 
@@ -1496,37 +1929,36 @@ class GPAWidget(ScriptedLoadableModuleWidget):
     if modelNode:
       slicer.mrmlScene.RemoveNode(modelNode)
 
-  def plotDistributionCloud(self):
+  def plotDistributionCloud(self, maxSpecimens=0, glyphPointLimit=100000):
+    """
+    Plots the landmarks of all subjects, or of at most maxSpecimens randomly selected subjects per landmark.
+    Clouds with up to glyphPointLimit points get a sphere glyph per point, larger ones are rendered as points.
+    """
     self.unplotDistributions()
-    i,j,k=self.LM.lmOrig.shape
-    pt=[0,0,0]
     #set up vtk point array for each landmark point
-    points = vtk.vtkPoints()
-    points.SetNumberOfPoints(i*k)
-    indexes = vtk.vtkDoubleArray()
-    indexes.SetName('LM Index')
-    pointCounter = 0
-
-    for subject in range(0,k):
-      for landmark in range(0,i):
-        pt=self.LM.lmOrig[landmark,:,subject]
-        points.SetPoint(pointCounter,pt)
-        indexes.InsertNextValue(landmark+1)
-        pointCounter+=1
+    cloudPoints, cloudIndexes = self.LM.cloudPoints(maxSpecimens)
+    points = vtk_lib.numpyToVTKPoints(cloudPoints)
+    indexes = vtk_lib.numpyToVTKArray(cloudIndexes, 'LM Index')
 
     #add points to polydata
     polydata=vtk.vtkPolyData()
     polydata.SetPoints(points)
     polydata.GetPointData().SetScalars(indexes)
 
-    #set up glyph for visualizing point cloud
-    sphereSource = vtk.vtkSphereSource()
-    sphereSource.SetRadius(self.sampleSizeScaleFactor/300)
-    glyph = vtk.vtkGlyph3D()
-    glyph.SetSourceConnection(sphereSource.GetOutputPort())
-    glyph.SetInputData(polydata)
-    glyph.ScalingOff()
-    glyph.Update()
+    renderAsPoints = len(cloudPoints) > glyphPointLimit
+    if renderAsPoints:
+      polydata.SetVerts(vtk_lib.vertexCells(len(cloudPoints)))
+      cloudPolyData = polydata
+    else:
+      #set up glyph for visualizing point cloud
+      sphereSource = vtk.vtkSphereSource()
+      sphereSource.SetRadius(self.sampleSizeScaleFactor/300)
+      glyph = vtk.vtkGlyph3D()
+      glyph.SetSourceConnection(sphereSource.GetOutputPort())
+      glyph.SetInputData(polydata)
+      glyph.ScalingOff()
+      glyph.Update()
+      cloudPolyData = glyph.GetOutput()
 
     #display
     modelNode=slicer.mrmlScene.GetFirstNodeByName('Landmark Point Cloud')
@@ -1545,37 +1977,29 @@ class GPAWidget(ScriptedLoadableModuleWidget):
     modelDisplayNode.SetScalarVisibility(True)
     modelDisplayNode.SetActiveScalarName('LM Index')
     modelDisplayNode.SetAndObserveColorNodeID('vtkMRMLColorTableNodeLabels.txt')
+    if renderAsPoints:
+      modelDisplayNode.SetPointSize(4)
+      modelDisplayNode.SetRenderPointsAsSpheres(True)
 
-    modelNode.SetAndObservePolyData(glyph.GetOutput())
+    modelNode.SetAndObservePolyData(cloudPolyData)
 
   def plotDistributionGlyph(self, sliderScale):
     self.unplotDistributions()
     varianceMat = self.LM.calcLMVariation(self.sampleSizeScaleFactor, self.BoasOption)
     i,j,k=self.LM.lmOrig.shape
-    pt=[0,0,0]
     #set up vtk point array for each landmark point
-    points = vtk.vtkPoints()
-    points.SetNumberOfPoints(i)
-    scales = vtk.vtkDoubleArray()
-    scales.SetName("Scales")
-    index = vtk.vtkDoubleArray()
-    index.SetName("Index")
+    points = vtk_lib.numpyToVTKPoints(self.rawMeanLandmarks)
+    scales = vtk_lib.numpyToVTKArray(sliderScale*varianceMat[:,0:3].sum(axis=1)/3, "Scales")
+    index = vtk_lib.numpyToVTKArray(np.arange(1,i+1,dtype=float), "Index")
 
     #set up tensor array to scale ellipses
-    tensors = vtk.vtkDoubleArray()
-    tensors.SetNumberOfTuples(i)
-    tensors.SetNumberOfComponents(9)
-    tensors.SetName("Tensors")
+    diagonal = np.zeros((i,9))
+    diagonal[:,[0,4,8]] = sliderScale*varianceMat[:,0:3]
+    tensors = vtk_lib.numpyToVTKArray(diagonal, "Tensors")
 
     # get fiducial node for mean landmarks, make just labels visible
     self.meanLandmarkNode.SetDisplayVisibility(1)
     self.scaleMeanShapeSlider.value=0
-    for landmark in range(i):
-      pt=self.rawMeanLandmarks[landmark,:]
-      points.SetPoint(landmark,pt)
-      scales.InsertNextValue(sliderScale*(varianceMat[landmark,0]+varianceMat[landmark,1]+varianceMat[landmark,2])/3)
-      tensors.InsertTuple9(landmark,sliderScale*varianceMat[landmark,0],0,0,0,sliderScale*varianceMat[landmark,1],0,0,0,sliderScale*varianceMat[landmark,2])
-      index.InsertNextValue(landmark+1)
 
     polydata=vtk.vtkPolyData()
     polydata.SetPoints(points)
@@ -1682,6 +2106,10 @@ class GPAWidget(ScriptedLoadableModuleWidget):
       visibility = self.meanLandmarkNode.GetDisplayVisibility()
       self.cloneLandmarkNode.SetDisplayVisibility(visibility)
 
+      # precompute the PC warp of the model points, moving a slider then only combines the cached fields
+      self.warpBasePoints = np.array(slicer.util.arrayFromModelPoints(self.cloneModelNode))
+      self.warpFields = self.LM.calcPCDisplacementFields(self.rawMeanLandmarks, self.warpBasePoints, self.pcNumber, self.sampleSizeScaleFactor)
+
       #Clean up
       GPANodeCollection.RemoveItem(self.sourceLMNode)
       slicer.mrmlScene.RemoveNode(self.sourceLMNode)
@@ -1714,6 +2142,7 @@ class GPAWidget(ScriptedLoadableModuleWidget):
     self.slider2.populateComboBox(self.PCList)
     self.applyEnabled = True
     self.startRecordButton.enabled = True
+    self.exportExtremesButton.enabled = hasattr(self, 'cloneModelNode')
 
   def onApply(self):
     pc1=self.slider1.boxValue()
@@ -1748,10 +2177,17 @@ class GPAWidget(ScriptedLoadableModuleWidget):
       VTKTPS.SetTargetLandmarks( targetLMVTK )
       VTKTPS.SetBasisToR()  # for 3D transform
 
-      #Connect transform to model
+      #Connect transform to landmarks
       self.transformNode.SetAndObserveTransformToParent( VTKTPS )
       self.cloneLandmarkNode.SetAndObserveTransformNodeID(self.transformNode.GetID())
-      self.cloneModelNode.SetAndObserveTransformNodeID(self.transformNode.GetID())
+
+      #Warp the model points with the precomputed PC displacement fields
+      warpedPoints = slicer.util.arrayFromModelPoints(self.cloneModelNode)
+      warpedPoints[:] = self.warpBasePoints
+      for pc, scaleFactor in zip(pcSelected, scaleFactors):
+        if pc != 0 and scaleFactor != 0:
+          warpedPoints += scaleFactor*self.warpFields[pc-1]
+      slicer.util.arrayFromModelPointsModified(self.cloneModelNode)
 
     else:
       index = 0
@@ -1760,6 +2196,22 @@ class GPAWidget(ScriptedLoadableModuleWidget):
         index+=1
 
 
+  def onExportExtremes(self):
+    outputDirectory = qt.QFileDialog().getExistingDirectory()
+    if not outputDirectory:
+      return
+    from vtk.util import numpy_support
+    # the mean shape model, before any slider warping
+    meanPolyData = vtk.vtkPolyData()
+    meanPolyData.ShallowCopy(self.cloneModelNode.GetPolyData())
+    meanPoints = vtk.vtkPoints()
+    meanPoints.SetData(numpy_support.numpy_to_vtk(self.warpBasePoints, deep=True))
+    meanPolyData.SetPoints(meanPoints)
+    pcScaleList = [(pc, sd) for pc in range(1, self.pcNumber+1) for sd in [-2, 2]]
+    logic = GPALogic()
+    fileList = logic.exportPCWarpedModels(meanPolyData, self.rawMeanLandmarks, self.LM, pcScaleList, outputDirectory, snapshotSize=[800, 800])
+    print(f"Saved {len(fileList)} PC warped models to {outputDirectory}")
+
   def onStartRecording(self):
     #set up sequences for template model and PC TPS transform
     self.modelSequence=slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSequenceNode","GPAModelSequence")
@@ -1865,113 +2317,68 @@ class GPALogic(ScriptedLoadableModuleLogic):
     annotationLogic = slicer.modules.annotations.logic()
     annotationLogic.CreateSnapShot(name, description, type, 1, imageData)
 
-  def loadLandmarks(self, filePathList, lmToRemove, extension):
-    # initial data array
+  def landmarkCacheDirectory(self):
+    return os.path.join(slicer.app.cachePath, 'SlicerMorph', 'LandmarkCache')
+
+  def loadLandmarks(self, filePathList, lmToRemove, extension, useCache=True, storageDirectory=None):
+    """
+    Reads the landmark files (.mrk.json or .fcsv) and writes the coordinates into a
+    preallocated (landmarks x 3 x subjects) array. Returns the array and the list of semi-landmark numbers.
+    Files that have not changed since they were last parsed are read from the landmark cache.
+    If storageDirectory is given the array is memory-mapped from a file in that directory.
+    """
+    cacheDirectory = self.landmarkCacheDirectory() if useCache else None
     lmToRemove = [x - 1 for x in lmToRemove]
-    if 'json' in extension:
-      import pandas
-      tempTable = pandas.DataFrame.from_dict(pandas.read_json(filePathList[0])['markups'][0]['controlPoints'])
-      landmarkNumber = len(tempTable)
-      landmarkTypeArray=[]
-      errorString = ""
-      subjectErrorArray = []
-      landmarkErrorArray = []
-      for i in range(landmarkNumber):
-        if tempTable['description'][i] =='Semi':
-          landmarkTypeArray.append(str(i+1))
-      landmarks=np.zeros(shape=(landmarkNumber-len(lmToRemove),3,len(filePathList)))
-      for i in range(len(filePathList)):
-        try:
-          tmp1=pandas.DataFrame.from_dict(pandas.read_json(filePathList[i])['markups'][0]['controlPoints'])
-        except:
-          slicer.util.messageBox(f"Error: Load file {filePathList[i]} failed:.")
-          logging.debug(f"Error: Load file {filePathList[i]} failed:.")
-        if len(tmp1) == landmarkNumber:
-          lmArray = tmp1['position'].to_numpy()
-          landmarkIndex = 0
-          for j in range(landmarkNumber):
-            if j not in lmToRemove:
-              if tmp1['positionStatus'][j] == 'defined':
-                landmarks[landmarkIndex,:,i]=lmArray[j]
-                landmarkIndex += 1
-              else:
-                subjectFileName = os.path.basename(filePathList[i])
-                message = f"{subjectFileName}: Landmark {str(j+1)} \n"
-                errorString += message
-                if subjectFileName not in subjectErrorArray:
-                  subjectErrorArray.append(subjectFileName)
-                if j not in landmarkErrorArray:
-                  landmarkErrorArray.append(j)
-        else:
-          warning = f"Error: Load file {filePathList[i]} failed. There are {len(tmp1)} landmarks instead of the expected {landmarkNumber}."
-          slicer.util.messageBox(warning)
-          return
-      if (errorString != "") and not all(x in lmToRemove for x in landmarkErrorArray):
-        landmarkErrorArrayString = ', '.join(map(str, [x+1 for x in landmarkErrorArray]))
-        subjectErrorArrayString = ', '.join(subjectErrorArray)
-        warning = "Error: The following undefined landmarks were found: \n" + errorString +\
-                  "To resolve,  exclude the affected landmarks from all subjects using the 'Exclude landmarks' field: " +\
-                  landmarkErrorArrayString +"\n" +\
-                  "Alternatively,  remove the affected subjects from the landmark file selector: " + \
-                  subjectErrorArrayString
+    landmarks = None
+    landmarkTypeArray = []
+    errorString = ""
+    subjectErrorArray = []
+    landmarkErrorArray = []
+    for i, (result, error) in enumerate(lm_io.readLandmarkFiles(filePathList, cacheDirectory=cacheDirectory)):
+      if result is None:
+        warning = f"Error: Load file {filePathList[i]} failed: {error}"
         slicer.util.messageBox(warning)
+        logging.debug(warning)
         return
-    else:
-      landmarks, landmarkTypeArray = self.initDataArray(filePathList)
-      landmarkNumber = landmarks.shape[0]
-      for i in range(len(filePathList)):
-        tmp1=self.importLandMarks(filePathList[i])
-        if len(tmp1) == landmarkNumber:
-          landmarks[:,:,i] = tmp1
-        else:
-          warning = f"Error: Load file {filePathList[i]} failed. There are {len(tmp1)} landmarks instead of the expected {landmarkNumber}."
-          slicer.util.messageBox(warning)
-          return
-      landmarks = np.delete(landmarks, lmToRemove, axis=0)
+      positions, defined, labels, descriptions, coordinateSystem = result
+      if landmarks is None:
+        # the first file sets the landmark number and types
+        landmarkNumber = len(positions)
+        landmarkTypeArray = [str(j+1) for j in range(landmarkNumber) if descriptions[j] == 'Semi']
+        keepIndex = [j for j in range(landmarkNumber) if j not in lmToRemove]
+        landmarks = lm_io.allocateLandmarkArray((len(keepIndex),3,len(filePathList)), storageDirectory, 'lmOrig')
+      if len(positions) != landmarkNumber:
+        warning = f"Error: Load file {filePathList[i]} failed. There are {len(positions)} landmarks instead of the expected {landmarkNumber}."
+        slicer.util.messageBox(warning)
+        return
+      landmarks[:,:,i] = positions[keepIndex]
+      undefined = [j for j in keepIndex if not defined[j]]
+      if undefined:
+        subjectFileName = os.path.basename(filePathList[i])
+        for j in undefined:
+          errorString += f"{subjectFileName}: Landmark {str(j+1)} \n"
+          if j not in landmarkErrorArray:
+            landmarkErrorArray.append(j)
+        subjectErrorArray.append(subjectFileName)
+      if i % 100 == 0:
+        slicer.app.processEvents()
+    if (errorString != "") and not all(x in lmToRemove for x in landmarkErrorArray):
+      landmarkErrorArrayString = ', '.join(map(str, [x+1 for x in landmarkErrorArray]))
+      subjectErrorArrayString = ', '.join(subjectErrorArray)
+      warning = "Error: The following undefined landmarks were found: \n" + errorString +\
+                "To resolve,  exclude the affected landmarks from all subjects using the 'Exclude landmarks' field: " +\
+                landmarkErrorArrayString +"\n" +\
+                "Alternatively,  remove the affected subjects from the landmark file selector: " + \
+                subjectErrorArrayString
+      slicer.util.messageBox(warning)
+      return
     return landmarks, landmarkTypeArray
 
   def importLandMarks(self, filePath):
-    """Imports the landmarks from file. Does not import sample if a  landmark is -1000
-    Adjusts the resolution is log(nhrd) file is found returns kXd array of landmark data. k=# of landmarks d=dimension
-    """
-    # import data file
-    datafile=open(filePath)
-    data=[]
-    for row in datafile:
-      if not fnmatch.fnmatch(row[0],"#*"):
-        data.append(row.strip().split(','))
-    # Make Landmark array
-    dataArray=np.zeros(shape=(len(data),3))
-    j=0
-    sorter=[]
-    for i in data:
-      tmp=np.array(i)[1:4]
-      dataArray[j,0:3]=tmp
-
-      x=np.array(i).shape
-      j=j+1
-    slicer.app.processEvents()
-    return dataArray
-
-  def initDataArray(self, files):
-    """
-    returns an np array for the storage of the landmarks and an array of landmark types (Fixed, Semi)
-    """
-    dim=3
-    subjectNumber = len(files)
-    # import data file
-    datafile=open(files[0])
-    landmarkType = []
-    rowNumber=0
-    for row in datafile:
-      if not fnmatch.fnmatch(row[0],"#*"):
-        rowNumber+=1
-        tmp=(row.strip().split(','))
-        if tmp[12] == 'Semi':
-          landmarkType.append(str(rowNumber))
-    i = rowNumber
-    landmarks=np.zeros(shape=(rowNumber,dim,subjectNumber))
-    return landmarks, landmarkType
+    """Imports the landmarks from an fcsv file and returns kXd array of landmark data. k=# of landmarks d=dimension
+    """
+    positions, defined, labels, descriptions, coordinateSystem = lm_io.readFcsv(filePath)
+    return positions
 
   def dist(self, a):
     """
@@ -2002,7 +2409,6 @@ class GPALogic(ScriptedLoadableModuleLogic):
   def makeScatterPlotWithFactors(self, data, files, factors,title,xAxis,yAxis,pcNumber):
     #create two tables for the first two factors and then check for a third
     #check if there is a table node has been created
-    numPoints = len(data)
     uniqueFactors, factorCounts = np.unique(factors, return_counts=True)
     factorNumber = len(uniqueFactors)
 
@@ -2024,26 +2430,9 @@ class GPALogic(ScriptedLoadableModuleLogic):
       else:
         tableNode.RemoveAllColumns()    #clear previous data from columns
 
-      # Set up columns for X,Y, and labels
-      labels=tableNode.AddColumn()
-      labels.SetName('Subject ID')
-      tableNode.SetColumnType('Subject ID',vtk.VTK_STRING)
-
-      for i in range(pcNumber):
-        pc=tableNode.AddColumn()
-        colName="PC" + str(i+1)
-        pc.SetName(colName)
-        tableNode.SetColumnType(colName, vtk.VTK_FLOAT)
-
-      factorCounter=0
-      table = tableNode.GetTable()
-      table.SetNumberOfRows(factorCounts[factorIndex])
-      for i in range(numPoints):
-        if (factors[i] == factor):
-          table.SetValue(factorCounter, 0,files[i])
-          for j in range(pcNumber):
-            table.SetValue(factorCounter, j+1, data[i,j])
-          factorCounter+=1
+      # Set up columns for X,Y, and labels from the subjects of this factor
+      factorMask = factors == factor
+      self.fillScatterTable(tableNode, np.asarray(files)[factorMask], data[factorMask], pcNumber)
 
       plotSeriesNode=slicer.mrmlScene.GetFirstNodeByName("Series_PCA_" + factor + "_" + xAxis + "v" +yAxis)
       if plotSeriesNode is None:
@@ -2080,8 +2469,24 @@ class GPALogic(ScriptedLoadableModuleLogic):
     plotViewNode = plotWidget.mrmlPlotViewNode()
     plotViewNode.SetPlotChartNodeID(plotChartNode.GetID())
 
+  def fillScatterTable(self, tableNode, files, data, pcNumber):
+    """
+    Sets the table columns to the subject names and the first pcNumber columns of data. The PC columns are
+    added as whole float arrays instead of being filled cell by cell.
+    """
+    tableNode.RemoveAllColumns()
+    table = tableNode.GetTable()
+    labels = vtk.vtkStringArray()
+    labels.SetName('Subject ID')
+    labels.SetNumberOfValues(len(files))
+    for i, name in enumerate(files):
+      labels.SetValue(i, str(name))
+    table.AddColumn(labels)
+    for i in range(pcNumber):
+      table.AddColumn(vtk_lib.numpyToVTKArray(np.asarray(data[:,i], dtype=np.float32), "PC" + str(i+1)))
+    tableNode.Modified()
+
   def makeScatterPlot(self, data, files, title,xAxis,yAxis,pcNumber):
-    numPoints = len(data)
     #check if there is a table node has been created
     tableNode=slicer.mrmlScene.GetFirstNodeByName('PCA Scatter Plot Table')
     if tableNode is None:
@@ -2089,22 +2494,7 @@ class GPALogic(ScriptedLoadableModuleLogic):
       GPANodeCollection.AddItem(tableNode)
 
       #set up columns for X,Y, and labels
-      labels=tableNode.AddColumn()
-      labels.SetName('Subject ID')
-      tableNode.SetColumnType('Subject ID',vtk.VTK_STRING)
-
-      for i in range(pcNumber):
-        pc=tableNode.AddColumn()
-        colName="PC" + str(i+1)
-        pc.SetName(colName)
-        tableNode.SetColumnType(colName, vtk.VTK_FLOAT)
-
-      table = tableNode.GetTable()
-      table.SetNumberOfRows(numPoints)
-      for i in range(numPoints):
-        table.SetValue(i, 0,files[i])
-        for j in range(pcNumber):
-            table.SetValue(i, j+1, data[i,j])
+      self.fillScatterTable(tableNode, files, data, pcNumber)
 
     plotSeriesNode1=slicer.mrmlScene.GetFirstNodeByName("Series_PCA" + xAxis + "v" +yAxis)
     if plotSeriesNode1 is None:
@@ -2153,23 +2543,10 @@ class GPALogic(ScriptedLoadableModuleLogic):
       endpoints=self.calcEndpoints(LMObj,LM,pc,scaleFactor)
       i,j=LM.shape
 
-      # declare arrays for polydata
-      points = vtk.vtkPoints()
-      points.SetNumberOfPoints(i*2)
-      lines = vtk.vtkCellArray()
-      magnitude = vtk.vtkFloatArray()
-      magnitude.SetName('Magnitude');
-      magnitude.SetNumberOfComponents(1);
-      magnitude.SetNumberOfValues(i);
-
-      for x in range(i): #populate vtkPoints and vtkLines
-        points.SetPoint(x,LM[x,:])
-        points.SetPoint(x+i,endpoints[x,:])
-        line = vtk.vtkLine()
-        line.GetPointIds().SetId(0,x)
-        line.GetPointIds().SetId(1,x+i)
-        lines.InsertNextCell(line)
-        magnitude.InsertValue(x,abs(LM[x,0]-endpoints[x,0]) + abs(LM[x,1]-endpoints[x,1]) + abs(LM[x,2]-endpoints[x,2]))
+      # arrays for polydata, a line from each landmark to its endpoint
+      points = vtk_lib.numpyToVTKPoints(np.vstack((LM,endpoints)))
+      lines = vtk_lib.lineCells(np.arange(i), np.arange(i,2*i))
+      magnitude = vtk_lib.numpyToVTKArray(np.abs(LM-endpoints).sum(axis=1).astype(np.float32), 'Magnitude')
 
       polydata=vtk.vtkPolyData()
       polydata.SetPoints(points)
@@ -2248,6 +2625,68 @@ class GPALogic(ScriptedLoadableModuleLogic):
       lmData[i,:]=np.asarray(loc)
     return lmData
 
+  def exportPCWarpedModels(self, polyData, sourceLandmarks, LM, pcScaleList, outputDirectory, fileExtension='ply', snapshotSize=None):
+    """
+    Warps the mean shape model polyData along each (PC, SD) pair of pcScaleList in one pass and writes the
+    models to outputDirectory as PC<pc>_<sd>SD.<fileExtension>. If snapshotSize is given, an offscreen
+    snapshot of each model is saved next to it as a png file. No MRML nodes are created.
+    Returns the list of written model files.
+    """
+    from vtk.util import numpy_support
+    writers = {'ply': vtk.vtkPLYWriter, 'stl': vtk.vtkSTLWriter, 'vtk': vtk.vtkPolyDataWriter, 'vtp': vtk.vtkXMLPolyDataWriter}
+    points = numpy_support.vtk_to_numpy(polyData.GetPoints().GetData()).astype(float)
+    fields = LM.calcPCScoreDisplacementFields(sourceLandmarks, points, pcScaleList)
+    os.makedirs(outputDirectory, exist_ok=True)
+    if snapshotSize is not None:
+      renderer, renderWindow, mapper = self.offscreenRenderer(polyData, snapshotSize)
+    fileList = []
+    for (pc, sd), field in zip(pcScaleList, fields):
+      warpedPoints = vtk.vtkPoints()
+      warpedPoints.SetData(numpy_support.numpy_to_vtk(points+field, deep=True))
+      warpedPolyData = vtk.vtkPolyData()
+      warpedPolyData.ShallowCopy(polyData)
+      warpedPolyData.SetPoints(warpedPoints)
+      fileName = os.path.join(outputDirectory, f"PC{pc}_{sd:+g}SD")
+      writer = writers[fileExtension]()
+      writer.SetFileName(fileName + '.' + fileExtension)
+      writer.SetInputData(warpedPolyData)
+      writer.Write()
+      fileList.append(fileName + '.' + fileExtension)
+      if snapshotSize is not None:
+        mapper.SetInputData(warpedPolyData)
+        self.saveSnapshot(renderWindow, fileName + '.png')
+    if snapshotSize is not None:
+      renderWindow.Finalize()
+    return fileList
+
+  def offscreenRenderer(self, polyData, snapshotSize):
+    """
+    Sets up an offscreen render window with the camera fitted to polyData, so all snapshots share one view.
+    """
+    mapper = vtk.vtkPolyDataMapper()
+    mapper.SetInputData(polyData)
+    actor = vtk.vtkActor()
+    actor.SetMapper(mapper)
+    renderer = vtk.vtkRenderer()
+    renderer.AddActor(actor)
+    renderer.SetBackground(1, 1, 1)
+    renderer.ResetCamera()
+    renderWindow = vtk.vtkRenderWindow()
+    renderWindow.SetOffScreenRendering(1)
+    renderWindow.SetSize(snapshotSize[0], snapshotSize[1])
+    renderWindow.AddRenderer(renderer)
+    return renderer, renderWindow, mapper
+
+  def saveSnapshot(self, renderWindow, filePath):
+    renderWindow.Render()
+    windowToImage = vtk.vtkWindowToImageFilter()
+    windowToImage.SetInput(renderWindow)
+    windowToImage.Update()
+    writer = vtk.vtkPNGWriter()
+    writer.SetFileName(filePath)
+    writer.SetInputConnection(windowToImage.GetOutputPort())
+    writer.Write()
+
   def convertNumpyToVTK(self, A):
     x,y=A.shape
     points=vtk.vtkPoints()
@@ -2320,6 +2759,28 @@ class GPATest(ScriptedLoadableModuleTest):
     """
     self.setUp()
     self.test_GPA1()
+    self.test_GPABatch()
+    self.test_GPABatchBenchmark()
+    self.test_GPAKernels()
+    self.test_GPAConvergence()
+    self.test_GPAPCA()
+    self.test_GPARandomizedPCA()
+    self.test_GPABoasCoordinates()
+    self.test_GPALoadLandmarks()
+    self.test_GPALandmarkCache()
+    self.test_GPAMemoryMapped()
+    self.test_GPAWriteOutData()
+    self.test_GPAPCWarp()
+    self.test_GPAExportPCWarpedModels()
+    self.test_GPAVTKArrays()
+    self.test_GPACloudPoints()
+    self.test_GPAScores()
+    self.test_GPAResampling()
+    self.test_GPAIncremental()
+    self.test_GPASlidingSemiLandmarks()
+    self.test_GPASlidingBenchmark()
+    self.test_GPAPairwiseDistances()
+    self.test_GPAPairwiseDistancesBenchmark()
 
   def test_GPA1(self):
     """ Ideally you should have several levels of tests.  At the lowest level
@@ -2366,3 +2827,684 @@ class GPATest(ScriptedLoadableModuleTest):
     self.assertEqual(outputScalarRange[1], inputScalarRange[1])
 
     self.delayDisplay('Test passed')
+
+  def makeSyntheticLandmarks(self, landmarkNumber, subjectNumber, seed=0):
+    """ Returns a (landmarks x 3 x subjects) array of randomly rotated, scaled and translated
+    copies of a noisy base shape.
+    """
+    rng = np.random.default_rng(seed)
+    baseShape = rng.normal(size=(landmarkNumber,3))
+    landmarks = np.zeros((landmarkNumber,3,subjectNumber))
+    for subject in range(subjectNumber):
+      rotation, _ = np.linalg.qr(rng.normal(size=(3,3)))
+      shape = baseShape + 0.05*rng.normal(size=(landmarkNumber,3))
+      landmarks[:,:,subject] = rng.uniform(1,3)*np.dot(shape, rotation) + rng.normal(size=3)
+    return landmarks
+
+  def test_GPABatch(self):
+    """ The vectorized GPA must reproduce the per-specimen implementation.
+    """
+    self.delayDisplay("Starting the batch GPA test")
+    landmarks = self.makeSyntheticLandmarks(30, 40)
+    alignedLoop, meanLoop = gpa_lib.runGPA(landmarks.copy())
+    alignedBatch, meanBatch = gpa_lib.runGPABatch(landmarks.copy())
+    self.assertTrue(np.allclose(alignedLoop, alignedBatch))
+    self.assertTrue(np.allclose(meanLoop, meanBatch))
+
+    alignedLoop, meanLoop = gpa_lib.runGPANoScale(landmarks.copy())
+    alignedBatch, meanBatch = gpa_lib.runGPANoScaleBatch(landmarks.copy())
+    self.assertTrue(np.allclose(alignedLoop, alignedBatch))
+    self.assertTrue(np.allclose(meanLoop, meanBatch))
+    self.delayDisplay('Test passed')
+
+  def test_GPABatchBenchmark(self):
+    """ Compare run times of the per-specimen and the vectorized GPA.
+    """
+    import time
+    self.delayDisplay("Starting the batch GPA benchmark")
+    for subjectNumber in [100, 1000, 10000]:
+      landmarks = self.makeSyntheticLandmarks(50, subjectNumber)
+      startTime = time.time()
+      gpa_lib.runGPA(landmarks.copy())
+      loopTime = time.time() - startTime
+      startTime = time.time()
+      gpa_lib.runGPABatch(landmarks.copy())
+      batchTime = time.time() - startTime
+      logging.info(f'GPA of {subjectNumber} subjects: loop {loopTime:.3f}s, batch {batchTime:.3f}s')
+    self.delayDisplay('Benchmark complete')
+
+  def test_GPAKernels(self):
+    """ The vectorized gpa_lib helpers must match the per-specimen loops they replaced and run faster.
+    """
+    import time
+    self.delayDisplay("Starting the gpa_lib kernel test")
+
+    def makeTwoDimLoop(monsters):
+      i,j,k=monsters.shape
+      tmp=np.zeros((i*j,k))
+      for x in range(k):
+        tmp[:,x]=np.reshape(monsters[:,:,x],(i*j),order='F')
+      return tmp
+
+    def calcCovLoop(vec):
+      i,j=vec.shape
+      meanVec=np.zeros(i)
+      for x in range(j):
+        meanVec+=vec[:,x]/float(j)
+      covMatrix=np.zeros((i,i))
+      for x in range(j):
+        covMatrix+=np.outer(vec[:,x]-meanVec,vec[:,x]-meanVec)/float(j)
+      return meanVec, covMatrix
+
+    def procDistLoop(monsters,mshape):
+      procDists=np.zeros(monsters.shape[2])
+      for x in range(monsters.shape[2]):
+        procDists[x]=np.linalg.norm(monsters[:,:,x]-mshape,'fro')
+      return procDists
+
+    def flattenArrayLoop(dataArray):
+      i,j,k=dataArray.shape
+      tmp=np.zeros((i*j,k))
+      for x in range(k):
+        tmp[:,x]=np.reshape(dataArray[:,:,x],(i*j))
+      return tmp
+
+    LM = LMData()
+    for subjectNumber in [20, 2000]:
+      landmarks = self.makeSyntheticLandmarks(30, subjectNumber)
+      mshape = landmarks.mean(2)
+      twoDim = gpa_lib.makeTwoDim(landmarks)
+      meanVec, covMatrix = calcCovLoop(twoDim)
+      references = [
+        (lambda: gpa_lib.makeTwoDim(landmarks), lambda: makeTwoDimLoop(landmarks)),
+        (lambda: gpa_lib.calcMean(twoDim), lambda: meanVec),
+        (lambda: gpa_lib.calcCov(twoDim), lambda: covMatrix),
+        (lambda: gpa_lib.procDist(landmarks, mshape), lambda: procDistLoop(landmarks, mshape)),
+        (lambda: LM.flattenArray(landmarks), lambda: flattenArrayLoop(landmarks))]
+      for vectorized, loop in references:
+        self.assertTrue(np.allclose(vectorized(), loop()))
+      # micro-benchmark, the loops are only timed where they have no precomputed result
+      for name, vectorized, loop in [('makeTwoDim',) + references[0], ('procDist',) + references[3], ('flattenArray',) + references[4]]:
+        startTime = time.perf_counter()
+        vectorized()
+        vectorizedTime = time.perf_counter() - startTime
+        startTime = time.perf_counter()
+        loop()
+        loopTime = time.perf_counter() - startTime
+        logging.info(f'{name} of {subjectNumber} subjects: loop {loopTime*1000:.2f}ms, vectorized {vectorizedTime*1000:.2f}ms')
+    self.delayDisplay('Test passed')
+
+  def test_GPAConvergence(self):
+    """ The convergence trace should report each iteration and stop at the tolerance.
+    """
+    self.delayDisplay("Starting the GPA convergence test")
+    landmarks = self.makeSyntheticLandmarks(30, 40)
+    aligned, mean, trace = gpa_lib.runGPAConvergence(landmarks.copy(), tolerance=1e-10, maxIterations=100)
+    self.assertTrue(len(trace) < 100)
+    self.assertTrue(trace[-1]['meanShapeDelta'] <= 1e-10)
+    self.assertTrue(np.isclose(trace[-1]['procrustesSS'], gpa_lib.procrustesSS(aligned, mean)))
+
+    aligned, mean, trace = gpa_lib.runGPAConvergence(landmarks.copy(), tolerance=0, maxIterations=3)
+    self.assertEqual(len(trace), 3)
+
+    # with reflections disabled all rotations must be proper
+    landmarks[:,0,::2] *= -1
+    aligned, mean, trace = gpa_lib.runGPAConvergence(landmarks.copy(), reflection=False)
+    reference = gpa_lib.scaleShapes(gpa_lib.centerShapes(landmarks))
+    for subject in range(landmarks.shape[2]):
+      u,s,v = np.linalg.svd(np.dot(reference[:,:,subject].T, aligned[:,:,subject]))
+      self.assertTrue(np.linalg.det(np.dot(u,v)) > 0)
+    self.delayDisplay('Test passed')
+
+  def test_GPAPCA(self):
+    """ The SVD and covariance formulations of the PCA must agree with the covariance eigen decomposition.
+    """
+    self.delayDisplay("Starting the PCA test")
+    for subjectNumber in [20, 200]:
+      landmarks = self.makeSyntheticLandmarks(30, subjectNumber)
+      aligned, mean = gpa_lib.runGPABatch(landmarks)
+      twoDim = gpa_lib.makeTwoDim(aligned)
+      componentNumber = min(twoDim.shape)
+      referenceVal, referenceVec = sp.eigh(gpa_lib.calcCov(twoDim))
+      referenceVal = referenceVal[::-1][:componentNumber]
+      referenceVec = referenceVec[:, ::-1][:, :componentNumber]
+      for method in ['svd', 'cov']:
+        val, vec = gpa_lib.calcPCA(twoDim, method)
+        self.assertEqual(val.shape[0], componentNumber)
+        self.assertTrue(np.allclose(val, referenceVal, atol=1e-12))
+        # compare well separated components up to sign
+        for pc in range(5):
+          self.assertTrue(np.allclose(np.abs(np.dot(vec[:,pc], referenceVec[:,pc])), 1))
+        referenceScores = np.dot(twoDim.T, referenceVec[:,:5])
+        scores = np.dot(twoDim.T, vec[:,:5])
+        self.assertTrue(np.allclose(np.abs(scores), np.abs(referenceScores)))
+    self.delayDisplay('Test passed')
+
+  def test_GPARandomizedPCA(self):
+    """ The randomized PCA must match the leading components and total variance of the exact PCA.
+    """
+    self.delayDisplay("Starting the randomized PCA test")
+    # shape variation concentrated in a few modes plus isotropic noise
+    rng = np.random.default_rng(0)
+    modes = rng.normal(size=(600,5))
+    twoDim = np.dot(modes*[10,8,6,4,2], rng.normal(size=(5,100))) + 0.1*rng.normal(size=(600,100))
+    exactVal, exactVec = gpa_lib.calcPCA(twoDim)
+    val, vec, totalVariance, relativeError = gpa_lib.calcPCARandomized(twoDim, 5)
+    self.assertEqual(len(val), 5)
+    self.assertTrue(np.isclose(totalVariance, exactVal.sum()))
+    eigenvalueError = np.abs(val-exactVal[:5])/exactVal[:5]
+    logging.info(f'Randomized PCA relative eigenvalue error: {eigenvalueError.max():.2e}, residual estimate: {relativeError.max():.2e}')
+    self.assertTrue(eigenvalueError.max() < 1e-6)
+    self.assertTrue(np.all(eigenvalueError <= relativeError + 1e-12))
+    self.assertTrue(np.allclose(np.abs(np.sum(vec*exactVec[:,:5], axis=0)), 1))
+    self.delayDisplay('Test passed')
+
+  def test_GPABoasCoordinates(self):
+    """ Centroid sizes and Boas coordinates must match the original per-element computation.
+    """
+    self.delayDisplay("Starting the Boas coordinates test")
+    landmarks = self.makeSyntheticLandmarks(30, 40)
+    i,j,k = landmarks.shape
+    referenceSize = np.zeros(k)
+    for subjectNum in range(k):
+      referenceSize[subjectNum] = np.linalg.norm(landmarks[:,:,subjectNum]-landmarks[:,:,subjectNum].mean(axis=0))
+    referenceLM, referenceMean = gpa_lib.runGPA(landmarks.copy())
+    for lmNum in range(i):
+      for dimNum in range(j):
+        for subjectNum in range(k):
+          referenceLM[lmNum, dimNum, subjectNum] = referenceSize[subjectNum]*referenceLM[lmNum, dimNum, subjectNum]
+    referenceMean = referenceLM.mean(axis=2)
+
+    LM = LMData()
+    LM.lmOrig = landmarks.copy()
+    LM.doGpa(True)
+    self.assertTrue(np.allclose(LM.centriodSize, referenceSize))
+    self.assertTrue(np.allclose(LM.lm, referenceLM))
+    self.assertTrue(np.allclose(LM.mShape, referenceMean))
+    self.delayDisplay('Test passed')
+
+  def writeTestLandmarkFiles(self, directory, landmarks, extension):
+    """ Writes one landmark file per subject and returns the file paths.
+    """
+    import json
+    filePaths = []
+    for subject in range(landmarks.shape[2]):
+      filePath = os.path.join(directory, f'subject{subject}{extension}')
+      if extension == '.fcsv':
+        with open(filePath, 'w') as f:
+          f.write('# Markups fiducial file version = 4.11\n# CoordinateSystem = LPS\n')
+          f.write('# columns = id,x,y,z,ow,ox,oy,oz,vis,sel,lock,label,desc,associatedNodeID\n')
+          for point in range(landmarks.shape[0]):
+            x,y,z = landmarks[point,:,subject]
+            description = 'Semi' if point % 2 else ''
+            f.write(f'{point},{x},{y},{z},0,0,0,1,1,1,0,F-{point+1},{description},\n')
+      else:
+        controlPoints = []
+        for point in range(landmarks.shape[0]):
+          controlPoints.append({'label': f'F-{point+1}', 'description': 'Semi' if point % 2 else '',
+                                'position': list(landmarks[point,:,subject]), 'positionStatus': 'defined'})
+        with open(filePath, 'w') as f:
+          json.dump({'markups': [{'controlPoints': controlPoints}]}, f)
+      filePaths.append(filePath)
+    return filePaths
+
+  def test_GPALoadLandmarks(self):
+    """ Landmarks read from json and fcsv files must match the written coordinates.
+    """
+    import tempfile
+    self.delayDisplay("Starting the landmark loading test")
+    landmarks = self.makeSyntheticLandmarks(10, 5)
+    logic = GPALogic()
+    with tempfile.TemporaryDirectory() as directory:
+      for extension in ['.mrk.json', '.fcsv']:
+        filePaths = self.writeTestLandmarkFiles(directory, landmarks, extension)
+        loaded, landmarkTypes = logic.loadLandmarks(filePaths, [3], extension)
+        self.assertTrue(np.allclose(loaded, np.delete(landmarks, 2, axis=0)))
+        self.assertEqual(landmarkTypes, ['2', '4', '6', '8', '10'])
+    self.delayDisplay('Test passed')
+
+  def test_GPALandmarkCache(self):
+    """ Cached landmark files are reused until the file changes.
+    """
+    import tempfile
+    self.delayDisplay("Starting the landmark cache test")
+    landmarks = self.makeSyntheticLandmarks(10, 3)
+    with tempfile.TemporaryDirectory() as directory:
+      cacheDirectory = os.path.join(directory, 'cache')
+      filePaths = self.writeTestLandmarkFiles(directory, landmarks, '.fcsv')
+      for result, error in lm_io.readLandmarkFiles(filePaths, cacheDirectory=cacheDirectory):
+        self.assertIsNone(error)
+      self.assertEqual(len(os.listdir(cacheDirectory)), 3)
+      for (result, error), (poolResult, poolError) in zip(lm_io.readLandmarkFiles(filePaths),
+                                                          lm_io.readLandmarkFiles(filePaths, maxWorkers=2)):
+        self.assertTrue(np.array_equal(result[0], poolResult[0]))
+      entryPath = lm_io.cacheEntryPath(cacheDirectory, filePaths[0])
+      self.assertIsNotNone(lm_io.readCacheEntry(entryPath, filePaths[0], os.stat(filePaths[0])))
+
+      # a modified file must be parsed again
+      self.writeTestLandmarkFiles(directory, 2*landmarks, '.fcsv')
+      os.utime(filePaths[0], ns=(0, 0))
+      self.assertIsNone(lm_io.readCacheEntry(entryPath, filePaths[0], os.stat(filePaths[0])))
+      positions, defined, labels, descriptions, coordinateSystem = lm_io.readLandmarkFileCached(filePaths[0], cacheDirectory)
+      self.assertTrue(np.allclose(positions, 2*landmarks[:,:,0]))
+      self.assertEqual(labels[0], 'F-1')
+      self.assertEqual(descriptions[1], 'Semi')
+      self.assertEqual(lm_io.readLandmarkFileCached(filePaths[0], cacheDirectory)[4], 'LPS')
+
+      # pruning removes the least recently used entries first
+      for age, filePath in enumerate(filePaths):
+        os.utime(lm_io.cacheEntryPath(cacheDirectory, filePath), ns=(age, age))
+      entrySize = os.path.getsize(lm_io.cacheEntryPath(cacheDirectory, filePaths[2]))
+      lm_io.pruneCache(cacheDirectory, entrySize)
+      self.assertEqual(os.listdir(cacheDirectory), [os.path.basename(lm_io.cacheEntryPath(cacheDirectory, filePaths[2]))])
+    self.delayDisplay('Test passed')
+
+  def test_GPAMemoryMapped(self):
+    """ GPA and PCA on memory-mapped storage must match the in-memory results and leave lmOrig unchanged.
+    """
+    import tempfile
+    self.delayDisplay("Starting the memory-mapped LMData test")
+    for subjectNumber in [25, 150]:
+      landmarks = self.makeSyntheticLandmarks(30, subjectNumber)
+      reference = LMData()
+      reference.lmOrig = landmarks.copy()
+      reference.doGpa(False)
+      reference.calcEigen()
+      self.assertTrue(np.array_equal(reference.lmOrig, landmarks))
+      with tempfile.TemporaryDirectory() as directory:
+        LM = LMData(directory, chunkSize=10)
+        LM.lmOrig = LM.allocateArray('lmOrig', landmarks.shape)
+        LM.lmOrig[:] = landmarks
+        LM.doGpa(False)
+        LM.calcEigen()
+        self.assertTrue(isinstance(LM.lm, np.memmap))
+        self.assertTrue(np.array_equal(LM.lmOrig, landmarks))
+        self.assertTrue(np.allclose(LM.lm, reference.lm))
+        self.assertTrue(np.allclose(LM.mShape, reference.mShape))
+        self.assertTrue(np.allclose(LM.centriodSize, reference.centriodSize))
+        self.assertEqual(LM.vec.shape, reference.vec.shape)
+        self.assertTrue(np.allclose(LM.val, reference.val))
+        self.assertTrue(np.allclose(np.dot(LM.vec.T, LM.vec), np.identity(LM.vec.shape[1])))
+        self.assertTrue(np.allclose(np.abs(np.sum(LM.vec[:,:5]*reference.vec[:,:5], axis=0)), 1))
+        del LM
+    self.delayDisplay('Test passed')
+
+  def test_GPAWriteOutData(self):
+    """ Results written by writeOutData must load back unchanged from the csv files and the binary results.
+    """
+    import tempfile
+    self.delayDisplay("Starting the result export test")
+    landmarks = self.makeSyntheticLandmarks(12, 40)
+    files = ['specimen_' + str(index) for index in range(40)]
+    LM = LMData(chunkSize=7)
+    LM.lmOrig = landmarks
+    LM.doGpa(False)
+    LM.calcEigen()
+    with tempfile.TemporaryDirectory() as directory:
+      LM.writeOutData(directory, files)
+      outputData = np.loadtxt(os.path.join(directory, 'OutputData.csv'), delimiter=',', skiprows=1, usecols=range(1, 3+12*3))
+      self.assertTrue(np.allclose(outputData[:,0], LM.procdist.ravel()))
+      self.assertTrue(np.allclose(outputData[:,2:], np.transpose(LM.flattenArray(LM.lm))))
+      eigenValues = np.loadtxt(os.path.join(directory, 'eigenvalues.csv'), delimiter=',', usecols=1)
+      self.assertTrue(np.allclose(eigenValues, LM.val))
+      scores = np.loadtxt(os.path.join(directory, 'pcScores.csv'), delimiter=',', skiprows=1, usecols=range(1, LM.vec.shape[1]+1))
+      self.assertTrue(np.allclose(scores, np.dot(np.transpose(gpa_lib.makeTwoDim(LM.lm)), LM.vec)))
+      loaded = LMData()
+      self.assertTrue(loaded.initializeFromBinary(directory))
+      self.assertEqual(loaded.files, files)
+      self.assertTrue(np.allclose(loaded.lm, LM.lm))
+      self.assertTrue(np.allclose(loaded.mShape, LM.mShape))
+      self.assertTrue(np.allclose(loaded.vec, LM.vec))
+      self.assertTrue(np.allclose(loaded.val, LM.val))
+      self.assertTrue(np.allclose(loaded.procdist, LM.procdist))
+      self.assertTrue(np.allclose(loaded.centriodSize, LM.centriodSize))
+      self.assertTrue(np.allclose(loaded.scores, scores))
+      del loaded
+      # regenerated csv files make the binary results stale until they are written again
+      outputDataPath = os.path.join(directory, 'OutputData.csv')
+      with open(outputDataPath, 'a') as f:
+        f.write('\n')
+      self.assertFalse(LMData().initializeFromBinary(directory))
+      LM.writeBinaryResults(directory, files)
+      self.assertTrue(LMData().initializeFromBinary(directory))
+      fileStat = os.stat(outputDataPath)
+      os.utime(outputDataPath, ns=(fileStat.st_atime_ns, fileStat.st_mtime_ns + 10**9))
+      self.assertFalse(LMData().initializeFromBinary(directory))
+    self.delayDisplay('Test passed')
+
+  def test_GPAPCWarp(self):
+    """ The precomputed PC displacement fields must match a TPS transform built from ExpandAlongPCs.
+    """
+    self.delayDisplay("Starting the PC warp test")
+    LM = LMData()
+    LM.lmOrig = self.makeSyntheticLandmarks(15, 30)
+    LM.doGpa(False)
+    LM.calcEigen()
+    logic = GPALogic()
+    sampleScaleFactor = logic.dist2(LM.mShape).max()
+    rng = np.random.default_rng(1)
+    points = LM.mShape[rng.integers(0, 15, 200)] + rng.normal(scale=0.05, size=(200, 3))
+    fields = LM.calcPCDisplacementFields(LM.mShape, points, 3, sampleScaleFactor)
+    pcSelected = [1, 3]
+    scaleFactors = np.array([0.7, -1.2])
+    LM.ExpandAlongPCs(pcSelected, scaleFactors, sampleScaleFactor)
+    VTKTPS = vtk.vtkThinPlateSplineTransform()
+    VTKTPS.SetSourceLandmarks(logic.convertNumpyToVTK(LM.mShape))
+    VTKTPS.SetTargetLandmarks(logic.convertNumpyToVTK(LM.mShape + LM.shift))
+    VTKTPS.SetBasisToR()
+    expected = np.array([VTKTPS.TransformPoint(point) for point in points])
+    warped = points + scaleFactors[0]*fields[0] + scaleFactors[1]*fields[2]
+    self.assertTrue(np.allclose(warped, expected, atol=1e-5*np.abs(points).max()))
+    self.delayDisplay('Test passed')
+
+  def test_GPAExportPCWarpedModels(self):
+    """ Batch export of PC warped models must move the landmark positions to the PC extreme shapes.
+    """
+    import tempfile
+    from vtk.util import numpy_support
+    self.delayDisplay("Starting the PC warped model export test")
+    LM = LMData()
+    LM.lmOrig = self.makeSyntheticLandmarks(15, 30)
+    LM.doGpa(False)
+    LM.calcEigen()
+    # model with the mean landmarks as its first points
+    rng = np.random.default_rng(2)
+    modelPoints = np.vstack((LM.mShape, LM.mShape[rng.integers(0, 15, 50)] + rng.normal(scale=0.05, size=(50, 3))))
+    points = vtk.vtkPoints()
+    points.SetData(numpy_support.numpy_to_vtk(modelPoints, deep=True))
+    polyData = vtk.vtkPolyData()
+    polyData.SetPoints(points)
+    vertices = vtk.vtkCellArray()
+    for index in range(len(modelPoints)):
+      vertices.InsertNextCell(1, [index])
+    polyData.SetVerts(vertices)
+    pcScaleList = [(1, -2), (1, 2), (2, 2)]
+    logic = GPALogic()
+    with tempfile.TemporaryDirectory() as directory:
+      fileList = logic.exportPCWarpedModels(polyData, LM.mShape, LM, pcScaleList, directory, fileExtension='vtp')
+      self.assertEqual(len(fileList), 3)
+      for (pc, sd), filePath in zip(pcScaleList, fileList):
+        reader = vtk.vtkXMLPolyDataReader()
+        reader.SetFileName(filePath)
+        reader.Update()
+        warped = numpy_support.vtk_to_numpy(reader.GetOutput().GetPoints().GetData())
+        expected = LM.mShape + sd*np.sqrt(LM.val[pc-1])*LM.vec[:,pc-1].reshape(15,3,order='F')
+        self.assertTrue(np.allclose(warped[:15], expected, atol=1e-5))
+    self.delayDisplay('Test passed')
+
+  def test_GPAVTKArrays(self):
+    """ The bulk numpy to vtk conversions used for plotting must match element-wise construction.
+    """
+    self.delayDisplay("Starting the vtk array conversion test")
+    landmarks = self.makeSyntheticLandmarks(8, 5)
+    i,j,k = landmarks.shape
+    points = vtk_lib.numpyToVTKPoints(np.transpose(landmarks,(2,0,1)))
+    self.assertEqual(points.GetNumberOfPoints(), i*k)
+    for subject in range(k):
+      for landmark in range(i):
+        self.assertTrue(np.allclose(points.GetPoint(subject*i+landmark), landmarks[landmark,:,subject]))
+    indexes = vtk_lib.numpyToVTKArray(np.tile(np.arange(1,i+1,dtype=float),k), 'LM Index')
+    self.assertEqual(indexes.GetName(), 'LM Index')
+    self.assertEqual(indexes.GetValue(i+2), 3)
+    lines = vtk_lib.lineCells(np.arange(i), np.arange(i,2*i))
+    self.assertEqual(lines.GetNumberOfCells(), i)
+    polydata = vtk.vtkPolyData()
+    polydata.SetPoints(vtk_lib.numpyToVTKPoints(np.vstack((landmarks[:,:,0],landmarks[:,:,1]))))
+    polydata.SetLines(lines)
+    for x in range(i):
+      pointIds = polydata.GetCell(x).GetPointIds()
+      self.assertEqual((pointIds.GetId(0), pointIds.GetId(1)), (x, x+i))
+    self.delayDisplay('Test passed')
+
+  def test_GPACloudPoints(self):
+    """ The point cloud subsample must keep the requested number of distinct specimens per landmark.
+    """
+    self.delayDisplay("Starting the point cloud subsample test")
+    LM = LMData()
+    LM.lm = self.makeSyntheticLandmarks(6, 20)
+    points, indexes = LM.cloudPoints()
+    self.assertEqual(points.shape, (6*20, 3))
+    self.assertTrue(np.allclose(points[6*3+2], LM.lm[2,:,3]))
+    self.assertEqual(indexes[6*3+2], 3)
+    points, indexes = LM.cloudPoints(5)
+    self.assertEqual(points.shape, (6*5, 3))
+    for landmark in range(6):
+      landmarkPoints = points[indexes == landmark+1]
+      self.assertEqual(len(landmarkPoints), 5)
+      # each point is the landmark of a different specimen
+      distances = np.linalg.norm(landmarkPoints[:,:,np.newaxis]-LM.lm[landmark][np.newaxis], axis=1)
+      matches = np.argmin(distances, axis=1)
+      self.assertTrue(np.allclose(distances[np.arange(5), matches], 0))
+      self.assertEqual(len(set(matches)), 5)
+    self.delayDisplay('Test passed')
+
+  def test_GPAScores(self):
+    """ The PC scores cached by calcEigen must match the per PC tangent projection and the chunked computation.
+    """
+    self.delayDisplay("Starting the PC score test")
+    LM = LMData(chunkSize=7)
+    LM.lmOrig = self.makeSyntheticLandmarks(10, 40)
+    LM.doGpa(False)
+    LM.calcEigen()
+    self.assertEqual(LM.scores.shape, (40, LM.vec.shape[1]))
+    for pc in range(5):
+      data = gpa_lib.plotTanProj(LM.lm, LM.sortedEig, pc, 1)
+      self.assertTrue(np.allclose(LM.scores[:,pc], data[:,0]))
+    scores = LM.scores
+    self.assertTrue(np.allclose(LM.calcScores(), scores))
+    self.delayDisplay('Test passed')
+
+  def test_GPAResampling(self):
+    """ Bootstrap intervals must cover the full-sample mean shape, and the permutation test must separate shifted groups.
+    """
+    import tempfile
+    self.delayDisplay("Starting the resampling test")
+    landmarks = self.makeSyntheticLandmarks(10, 40)
+    groups = np.repeat(['a', 'b'], 20)
+    landmarks[0,0,20:] += 0.5
+    LM = LMData()
+    LM.lmOrig = landmarks
+    LM.doGpa(False)
+    LM.calcEigen()
+    with tempfile.TemporaryDirectory() as directory:
+      results = LM.bootstrap(20, directory, componentNumber=3, maxWorkers=2)
+      self.assertEqual(results['eigenValues'].shape, (20, 3))
+      lower, upper = results['meanShapeInterval']
+      self.assertTrue(np.all(lower <= LM.mShape + 1e-6) and np.all(LM.mShape <= upper + 1e-6))
+      # in process replicates give the same results as the pool
+      serialResults = LM.bootstrap(20, directory, componentNumber=3, maxWorkers=0)
+      self.assertTrue(np.allclose(serialResults['eigenValues'], results['eigenValues']))
+      self.assertTrue(os.path.isfile(os.path.join(directory, 'bootstrapEigenvectorSD.csv')))
+      observed, pValue = LM.permutationTest(groups, 50, directory, maxWorkers=2)
+      self.assertTrue(pValue < 0.05)
+      observed, pValue = LM.permutationTest(np.tile(['a', 'b'], 20), 50, directory, maxWorkers=0)
+      self.assertTrue(pValue > 0.05)
+      self.assertEqual(len([name for name in os.listdir(directory) if name.endswith('.npy')]), 0)
+    # memory-mapped coordinates stored under the output folder are used in place and kept
+    with tempfile.TemporaryDirectory() as directory:
+      LM = LMData(os.path.join(directory, 'LandmarkStorage'))
+      LM.lmOrig = LM.allocateArray('lmOrig', landmarks.shape)
+      LM.lmOrig[:] = landmarks
+      LM.doGpa(False)
+      LM.calcEigen()
+      observed, pValue = LM.permutationTest(groups, 20, directory, maxWorkers=0)
+      self.assertEqual(sorted(os.listdir(LM.storageDirectory)), ['lm.npy', 'lmOrig.npy'])
+      del LM
+    self.delayDisplay('Test passed')
+
+  def test_GPAIncremental(self):
+    """ Adding specimens must give the PCA of the combined coordinates and stay close to a full GPA.
+    """
+    self.delayDisplay("Starting the incremental GPA test")
+    landmarks = self.makeSyntheticLandmarks(12, 60)
+    for BoasOption in [False, True]:
+      LM = LMData()
+      LM.lmOrig = landmarks[:,:,:50].copy()
+      LM.doGpa(BoasOption)
+      LM.calcEigen()
+      LM.addSpecimens(landmarks[:,:,50:], BoasOption, refineIterations=2)
+      self.assertEqual(LM.lm.shape, (12, 3, 60))
+      self.assertTrue(np.array_equal(LM.lmOrig, landmarks))
+      self.assertEqual(len(LM.procdist), 60)
+      self.assertTrue(np.allclose(LM.mShape, LM.lm.mean(axis=2)))
+      # the updated PCA is the PCA of the combined aligned coordinates
+      twoDim = gpa_lib.makeTwoDim(LM.lm)
+      val, vec = gpa_lib.calcPCA(twoDim)
+      self.assertTrue(np.allclose(LM.val[:10], val[:10]))
+      self.assertTrue(np.allclose(np.abs(np.sum(LM.vec[:,:5]*vec[:,:5], axis=0)), 1))
+      self.assertTrue(np.isclose(LM.totalVariance, val.sum()))
+      self.assertTrue(np.allclose(LM.scores, np.dot(twoDim.T, LM.vec)))
+      # the consensus is close to a GPA of all specimens
+      reference = LMData()
+      reference.lmOrig = landmarks.copy()
+      reference.doGpa(BoasOption)
+      referenceMean = gpa_lib.alignShapes(LM.mShape, reference.mShape[:,:,np.newaxis])[:,:,0]
+      self.assertTrue(np.linalg.norm(LM.mShape-referenceMean) < 0.01*np.linalg.norm(referenceMean))
+
+    # without refinement the PCA is kept and the new subjects are projected onto it
+    LM = LMData()
+    LM.lmOrig = landmarks[:,:,:50].copy()
+    LM.doGpa(False)
+    LM.calcEigen()
+    val, vec = LM.val.copy(), LM.vec.copy()
+    for start in range(50, 60, 2):
+      LM.addSpecimens(landmarks[:,:,start:start+2])
+    self.assertTrue(np.array_equal(LM.val, val) and np.array_equal(LM.vec, vec))
+    self.assertTrue(np.array_equal(LM.lmOrig, landmarks))
+    self.assertTrue(np.allclose(LM.mShape, LM.lm.mean(axis=2)))
+    self.assertTrue(np.allclose(LM.scores, np.dot(gpa_lib.makeTwoDim(LM.lm).T, LM.vec)))
+    inMemory = np.array(LM.lm)
+
+    # memory-mapped coordinates grow in place, without leaving other files behind
+    import tempfile
+    with tempfile.TemporaryDirectory() as directory:
+      LM = LMData(directory)
+      LM.lmOrig = LM.allocateArray('lmOrig', (12, 3, 50))
+      LM.lmOrig[:] = landmarks[:,:,:50]
+      LM.doGpa(False)
+      LM.calcEigen()
+      for start in range(50, 60, 2):
+        LM.addSpecimens(landmarks[:,:,start:start+2])
+      self.assertTrue(isinstance(LM.lm, np.memmap))
+      self.assertTrue(np.array_equal(LM.lmOrig, landmarks))
+      self.assertTrue(np.allclose(LM.lm, inMemory))
+      self.assertEqual(sorted(os.listdir(directory)), ['lm.npy', 'lmOrig.npy'])
+      del LM
+    self.delayDisplay('Test passed')
+
+  def makeSphereLandmarks(self, landmarkNumber, semiNumber, subjectNumber, seed=0):
+    """ Returns landmarks on a noisy unit sphere, randomly scaled, and the boolean mask of the semi-landmarks,
+    which are additionally displaced along the sphere.
+    """
+    rng = np.random.default_rng(seed)
+    index = np.arange(landmarkNumber)+0.5
+    polar = np.arccos(1-2*index/landmarkNumber)
+    azimuth = np.pi*(1+5**0.5)*index
+    baseShape = np.column_stack((np.cos(azimuth)*np.sin(polar), np.sin(azimuth)*np.sin(polar), np.cos(polar)))
+    semiLandmarks = np.zeros(landmarkNumber, dtype=bool)
+    semiLandmarks[rng.choice(landmarkNumber, semiNumber, replace=False)] = True
+    landmarks = np.zeros((landmarkNumber,3,subjectNumber))
+    for subject in range(subjectNumber):
+      shape = baseShape + 0.01*rng.normal(size=baseShape.shape)
+      shape[semiLandmarks] += 0.05*rng.normal(size=(semiNumber,3))
+      shape[semiLandmarks] /= np.linalg.norm(shape[semiLandmarks], axis=1, keepdims=True)
+      landmarks[:,:,subject] = rng.uniform(1,3)*shape
+    return landmarks, semiLandmarks
+
+  def test_GPASlidingSemiLandmarks(self):
+    """ Sliding must reduce the Procrustes sum of squares while keeping the semi-landmarks on the surface.
+    """
+    self.delayDisplay("Starting the sliding semi-landmark test")
+    landmarks, semiLandmarks = self.makeSphereLandmarks(60, 40, 30)
+    original = landmarks.copy()
+    aligned, meanShape, trace = gpa_lib.runGPAConvergence(landmarks)
+    # an empty mask gives the plain GPA
+    noSlide, noSlideMean, noSlideTrace = gpa_lib.runGPAConvergence(landmarks, semiLandmarks=np.zeros(60, dtype=bool))
+    self.assertTrue(np.allclose(noSlide, aligned))
+    for slidingCriterion in ['procD', 'bendingEnergy']:
+      slid, slidMean, slidTrace = gpa_lib.runGPAConvergence(landmarks, semiLandmarks=semiLandmarks, slidingCriterion=slidingCriterion)
+      self.assertTrue(np.array_equal(landmarks, original))
+      self.assertTrue(slidTrace[-1]['procrustesSS'] < 0.2*trace[-1]['procrustesSS'])
+      # the slid points stay close to the sphere through the fixed landmarks
+      radius = np.linalg.norm(slid[~semiLandmarks], axis=1).mean(axis=0)
+      self.assertTrue(np.abs(np.linalg.norm(slid[semiLandmarks], axis=1)/radius-1).max() < 0.05)
+      self.assertTrue(np.allclose(np.sum(slid**2, axis=(0,1)), 1))
+    LM = LMData()
+    LM.lmOrig = landmarks.copy()
+    LM.doGpa(False, semiLandmarks=semiLandmarks)
+    self.assertTrue(np.allclose(LM.mShape, LM.lm.mean(axis=2)))
+    self.delayDisplay('Test passed')
+
+  def test_GPASlidingBenchmark(self):
+    """ Compare run times of GPA without sliding and with both sliding criteria.
+    """
+    import time
+    self.delayDisplay("Starting the sliding semi-landmark benchmark")
+    for landmarkNumber, semiNumber in [(60, 40), (2000, 1800)]:
+      landmarks, semiLandmarks = self.makeSphereLandmarks(landmarkNumber, semiNumber, 30)
+      times = []
+      for slidingCriterion in [None, 'procD', 'bendingEnergy']:
+        startTime = time.time()
+        gpa_lib.runGPAConvergence(landmarks, semiLandmarks=None if slidingCriterion is None else semiLandmarks,
+          slidingCriterion=slidingCriterion or 'procD')
+        times.append(time.time() - startTime)
+      logging.info(f'GPA of 30 subjects with {landmarkNumber} landmarks: no sliding {times[0]:.3f}s, '
+        f'Procrustes distance {times[1]:.3f}s, bending energy {times[2]:.3f}s')
+    self.delayDisplay('Benchmark complete')
+
+  def test_GPAPairwiseDistances(self):
+    """ The tiled distance matrix must match a dense computation and the nearest-neighbour query a full sort.
+    """
+    import tempfile
+    self.delayDisplay("Starting the pairwise Procrustes distance test")
+    LM = LMData()
+    LM.lmOrig = self.makeSyntheticLandmarks(20, 250)
+    LM.doGpa(False)
+    twoDim = gpa_lib.makeTwoDim(LM.lm)
+    reference = np.linalg.norm(twoDim[:,:,np.newaxis]-twoDim[:,np.newaxis,:], axis=0)
+    with tempfile.TemporaryDirectory() as storageDirectory:
+      distances = LM.calcPairwiseDistances(storageDirectory, blockSize=64, maxWorkers=4)
+      self.assertTrue(isinstance(distances, np.memmap))
+      self.assertTrue(np.allclose(distances, reference, atol=1e-10))
+      self.assertTrue(np.allclose(np.diag(distances), 0))
+      # the distance to the mean shape is one column of the full matrix when the mean is added as a subject
+      self.assertTrue(np.allclose(gpa_lib.pairwiseProcrustesDistances(np.dstack((LM.lm, LM.mShape)))[-1,:-1], LM.procdist.ravel()))
+      indices, neighborDistances = LM.nearestSpecimens([0, 17, 249], 4)
+      rows = reference[[0, 17, 249]]
+      for row, neighbors, neighborDistance in zip(rows, indices, neighborDistances):
+        self.assertTrue(np.array_equal(neighbors, np.argsort(row)[1:5]))
+        self.assertTrue(np.allclose(neighborDistance, np.sort(row)[1:5]))
+      del distances
+      LM.releasePairwiseDistances()
+      self.assertFalse(os.path.exists(os.path.join(storageDirectory, 'procrustesDistances.npy')))
+    # without a storage directory the matrix is mapped from a temporary file
+    self.assertTrue(isinstance(LM.calcPairwiseDistances(blockSize=64), np.memmap))
+    self.assertTrue(np.allclose(LM.pairwiseDistances, reference, atol=1e-10))
+    # added specimens are queried and returned as neighbours with a new matrix
+    LM.addSpecimens(self.makeSyntheticLandmarks(20, 5, seed=1))
+    self.assertTrue(LM.pairwiseDistances is None)
+    twoDim = gpa_lib.makeTwoDim(LM.lm)
+    reference = np.linalg.norm(twoDim[:,:,np.newaxis]-twoDim[:,np.newaxis,:], axis=0)
+    indices, neighborDistances = LM.nearestSpecimens([3, 252], 4)
+    self.assertEqual(LM.pairwiseDistances.shape, (255, 255))
+    for row, neighbors, neighborDistance in zip(reference[[3, 252]], indices, neighborDistances):
+      self.assertTrue(np.array_equal(neighbors, np.argsort(row)[1:5]))
+      self.assertTrue(np.allclose(neighborDistance, np.sort(row)[1:5]))
+    self.assertTrue(np.all(indices[1] >= 250))
+    # a new alignment releases the matrix as well
+    LM.lmOrig = self.makeSyntheticLandmarks(20, 30)
+    LM.doGpa(False)
+    self.assertTrue(LM.pairwiseDistances is None)
+    self.assertEqual(LM.nearestSpecimens([29], 3)[0].shape, (1, 3))
+    self.delayDisplay('Test passed')
+
+  def test_GPAPairwiseDistancesBenchmark(self):
+    """ Time the tiled pairwise Procrustes distances of 5000 subjects.
+    """
+    import time
+    self.delayDisplay("Starting the pairwise Procrustes distance benchmark")
+    landmarks = self.makeSyntheticLandmarks(50, 5000)
+    startTime = time.time()
+    gpa_lib.pairwiseProcrustesDistances(landmarks, lm_io.allocateTemporaryArray((5000, 5000)), blockSize=1000)
+    logging.info(f'Pairwise Procrustes distances of 5000 subjects: {time.time() - startTime:.3f}s')
+    self.delayDisplay('Benchmark complete')
@@ -5,29 +5,152 @@ import scipy.linalg as sp
 
 # PCA
 def makeTwoDim(monsters):
+    # one column per specimen holding x1..xi, y1..yi, z1..zi
     i,j,k=monsters.shape
-    tmp=np.zeros((i*j,k))
-    for x in range(k):
-        vec=np.reshape(monsters[:,:,x],(i*j),order='F')
-        tmp[:,x]=vec
-    return tmp
+    return np.reshape(monsters,(i*j,k),order='F').astype(float)
 
 def calcMean(vec):
-    i,j=vec.shape
-    meanVec=np.zeros(i)
-    for x in range(j):
-        meanVec+=vec[:,x]/float(j)
-    return meanVec
+    return vec.mean(axis=1)
 
 def calcCov(vec):
     i,j=vec.shape
-    meanVec=calcMean(vec)
-    covMatrix=np.zeros((i,i))
-    for x in range(j):
-        t1=((vec[:,x]-meanVec).T).reshape(i,1)
-        t2=(vec[:,x]-meanVec).reshape(1,i)
-        covMatrix+=np.dot(t1,t2)/float(j)
-    return covMatrix
+    centered=vec-calcMean(vec)[:,np.newaxis]
+    return np.dot(centered,centered.T)/float(j)
+
+def calcPCA(vec, method='auto'):
+  """
+  Principal components of the columns of vec (observations x subjects).
+  Returns the eigenvalues and eigenvectors of the covariance matrix of vec
+  in descending order, limited to min(observations, subjects) components.
+  method='svd' uses a thin SVD of the centered data, which never forms the
+  (observations x observations) covariance matrix, method='cov' runs eigh on
+  the covariance matrix. 'auto' picks the SVD when there are fewer subjects
+  than observations.
+  """
+  i,j=vec.shape
+  centered=vec-vec.mean(axis=1, keepdims=True)
+  if method=='auto':
+    method='svd' if j<i else 'cov'
+  if method=='svd':
+    u,s,v=np.linalg.svd(centered, full_matrices=False)
+    return s**2/float(j), u
+  covMatrix=np.dot(centered, centered.T)/float(j)
+  eigVal,eigVec=sp.eigh(covMatrix, subset_by_index=(i-min(i,j), i-1))
+  return eigVal[::-1], eigVec[:, ::-1]
+
+def calcPCAChunked(allLandmarkSets, chunkSize):
+  """
+  PCA of a (landmarks x 3 x specimens) stack, for example a memory-mapped
+  array, without building the (3p x n) data matrix. The eigenvectors use the
+  coordinate order of makeTwoDim. With fewer specimens than coordinates the
+  (n x n) Gram matrix is accumulated over blocks of landmarks, otherwise the
+  covariance is accumulated over blocks of chunkSize specimens. Like calcPCA,
+  min(coordinates, specimens) components are returned in both cases. The
+  components without variance get zero eigenvalues and orthonormal
+  eigenvectors orthogonal to the data.
+  """
+  i,j,k=allLandmarkSets.shape
+  mean=np.zeros((i,j))
+  for chunk in specimenChunks(k, chunkSize):
+    mean+=allLandmarkSets[:,:,chunk].sum(axis=2)
+  mean/=float(k)
+  if k<i*j:
+    landmarkChunks=specimenChunks(i, max(1, chunkSize*i//k))
+    gram=np.zeros((k,k))
+    for rows in landmarkChunks:
+      block=(allLandmarkSets[rows]-mean[rows][:,:,np.newaxis]).reshape(-1,k)
+      gram+=np.dot(block.T, block)
+    eigVal,eigVecGram=np.linalg.eigh(gram/float(k))
+    eigVal=eigVal[::-1]
+    eigVecGram=eigVecGram[:, ::-1]
+    keep=eigVal>eigVal[0]*1e-12
+    eigVal=eigVal[keep]
+    weights=eigVecGram[:,keep]/np.sqrt(k*eigVal)
+    eigVec=np.zeros((i*j, len(eigVal)))
+    for rows in landmarkChunks:
+      block=allLandmarkSets[rows]-mean[rows][:,:,np.newaxis]
+      for dim in range(j):
+        eigVec[dim*i+rows.start:dim*i+rows.stop]=np.dot(block[:,dim,:], weights)
+    return np.concatenate((eigVal, np.zeros(k-len(eigVal)))), completeBasis(eigVec, k)
+  meanVec=np.reshape(mean, i*j, order='F')
+  covMatrix=np.zeros((i*j,i*j))
+  for chunk in specimenChunks(k, chunkSize):
+    block=np.transpose(allLandmarkSets[:,:,chunk],(1,0,2)).reshape(i*j,-1)-meanVec[:,np.newaxis]
+    covMatrix+=np.dot(block, block.T)
+  eigVal,eigVec=sp.eigh(covMatrix/float(k))
+  return eigVal[::-1], eigVec[:, ::-1]
+
+def completeBasis(vectors, columnNumber, seed=0):
+  """
+  Extends the orthonormal columns of vectors to columnNumber orthonormal columns.
+  """
+  rows,columns=vectors.shape
+  if columns>=columnNumber:
+    return vectors
+  extra=np.random.default_rng(seed).normal(size=(rows, columnNumber-columns))
+  for iteration in range(2):
+    # project out the existing columns twice for numerical orthogonality
+    extra-=np.dot(vectors, np.dot(vectors.T, extra))
+    extra,r=np.linalg.qr(extra)
+  return np.column_stack((vectors, extra))
+
+def calcPCARandomized(vec, componentNumber, oversampling=10, powerIterations=4, seed=0):
+  """
+  Randomized truncated PCA of the columns of vec (observations x subjects)
+  following Halko, Martinsson and Tropp, 2011. Only the first componentNumber
+  eigenvalues and eigenvectors are computed.
+  Returns the eigenvalues, eigenvectors, the total variance of the data (so
+  that percent variance can be computed from the truncated spectrum) and the
+  relative residual ||C v - l v|| / l of each eigenpair. Each residual bounds the
+  relative distance of the eigenvalue to an exact eigenvalue of the covariance.
+  """
+  i,j=vec.shape
+  centered=vec-vec.mean(axis=1, keepdims=True)
+  totalVariance=(centered**2).sum()/float(j)
+  componentNumber=min(componentNumber, i, j)
+  sampleNumber=min(componentNumber+oversampling, i, j)
+  rng=np.random.default_rng(seed)
+  q,r=np.linalg.qr(np.dot(centered, rng.normal(size=(j, sampleNumber))))
+  for iteration in range(powerIterations):
+    q,r=np.linalg.qr(np.dot(centered.T, q))
+    q,r=np.linalg.qr(np.dot(centered, q))
+  u,s,v=np.linalg.svd(np.dot(q.T, centered), full_matrices=False)
+  eigVec=np.dot(q, u[:, :componentNumber])
+  eigVal=s[:componentNumber]**2/float(j)
+  covTimesVec=np.dot(centered, np.dot(centered.T, eigVec))/float(j)
+  residual=np.linalg.norm(covTimesVec-eigVec*eigVal, axis=0)
+  relativeError=residual/np.maximum(eigVal, np.finfo(float).tiny)
+  return eigVal, eigVec, totalVariance, relativeError
+
+def incrementalPCA(eigenValues, eigenVectors, mean, specimenNumber, newData, componentNumber=None, scores=None):
+  """
+  Updates a PCA of specimenNumber columns with the columns of newData without
+  revisiting the old data (sequential Karhunen-Loeve update with a moving mean,
+  Ross et al. 2008). mean is the mean column of the old data. Returns the
+  eigenvalues, eigenvectors and mean column of the combined data, limited to
+  componentNumber components. If scores (old subjects x PCs, as computed by
+  LMData.calcScores) are given they are rotated into the new basis, which is
+  exact when the old PCA kept all components.
+  """
+  n=specimenNumber
+  d,m=newData.shape
+  c=eigenVectors.shape[1]
+  if componentNumber is None:
+    componentNumber=min(c+m, d, n+m)
+  newMean=newData.mean(axis=1)
+  extended=np.column_stack((newData-newMean[:,np.newaxis], np.sqrt(n*m/float(n+m))*(newMean-mean)))
+  projection=np.dot(eigenVectors.T, extended)
+  q,r=np.linalg.qr(extended-np.dot(eigenVectors, projection))
+  middle=np.zeros((c+q.shape[1], c+m+1))
+  middle[:c,:c]=np.diag(np.sqrt(np.abs(eigenValues)*n))
+  middle[:c,c:]=projection
+  middle[c:,c:]=r
+  u,s,v=np.linalg.svd(middle, full_matrices=False)
+  u=u[:,:componentNumber]
+  vectors=np.dot(eigenVectors, u[:c])+np.dot(q, u[c:])
+  if scores is not None:
+    scores=np.dot(np.column_stack((scores, np.tile(np.dot(mean, q), (scores.shape[0], 1)))), u)
+  return s[:componentNumber]**2/float(n+m), vectors, (n*mean+m*newMean)/float(n+m), scores
 
 def sortEig(eVal, eVec):
     i,j=eVec.shape
@@ -107,13 +230,12 @@ def alignShape(refShape,shape):
 def meanShape(monsters):
     return monsters.mean(axis=2)
 
+def centroidSizes(monsters):
+  return np.linalg.norm(monsters-monsters.mean(axis=0, keepdims=True), axis=(0,1))
+
 def procDist(monsters,mshape):
     i,j,k=monsters.shape
-    procDists=np.zeros(k)
-    for x in range(k):
-        tmp=monsters[:,:,x]-mshape
-        procDists[x]=np.linalg.norm(tmp,'fro')
-    return procDists
+    return np.linalg.norm((monsters-mshape[:,:,np.newaxis]).reshape(i*j,k),axis=0)
 
 ################# GPA update
 def runGPA(allLandmarkSets):
@@ -174,3 +296,324 @@ def procrustesAlignNoScale(mean, allLandmarkSets):
 def applyCenter(landmarkSet):
   landmarkSet=centerShape(landmarkSet)
   return landmarkSet
+
+################# GPA vectorized
+# The functions below operate on the whole (landmarks x 3 x specimens) stack at
+# once instead of looping over specimens. They give the same results as
+# runGPA/runGPANoScale.
+def centerShapes(allLandmarkSets):
+  return allLandmarkSets-allLandmarkSets.mean(axis=0, keepdims=True)
+
+def scaleShapes(allLandmarkSets):
+  return allLandmarkSets/np.linalg.norm(allLandmarkSets, axis=(0,1), keepdims=True)
+
+def alignShapes(refShape, allLandmarkSets, reflection=True):
+  """
+  Align every shape in the stack to the reference shape, solely by rotation.
+  The 3x3 cross-covariance matrices of all specimens are decomposed with one
+  batched SVD. If reflection is False, improper rotations are corrected so
+  that every rotation matrix has a positive determinant.
+  """
+  crossCov=np.einsum('ij,ikn->njk', refShape, allLandmarkSets)
+  u,s,v=np.linalg.svd(crossCov)
+  if not reflection:
+    d=np.sign(np.linalg.det(np.matmul(np.transpose(v,(0,2,1)), np.transpose(u,(0,2,1)))))
+    d[d==0]=1
+    v[:,-1,:]*=d[:,np.newaxis]
+  rotationMatrices=np.matmul(np.transpose(v,(0,2,1)), np.transpose(u,(0,2,1)))
+  return np.einsum('ijn,njk->ikn', allLandmarkSets, rotationMatrices)
+
+def procrustesAlignBatch(mean, allLandmarkSets, reflection=True):
+  return alignShapes(scaleShape(mean), allLandmarkSets, reflection)
+
+def procrustesAlignNoScaleBatch(mean, allLandmarkSets, reflection=True):
+  return alignShapes(mean, allLandmarkSets, reflection)
+
+def procrustesSS(allLandmarkSets, mshape):
+  return ((allLandmarkSets-mshape[:,:,np.newaxis])**2).sum()
+
+def specimenChunks(specimenNumber, chunkSize=None):
+  """
+  Returns slices splitting the specimen axis into blocks of at most chunkSize specimens.
+  """
+  if chunkSize is None or chunkSize >= specimenNumber:
+    return [slice(0, specimenNumber)]
+  return [slice(start, min(start+chunkSize, specimenNumber)) for start in range(0, specimenNumber, chunkSize)]
+
+def runGPAConvergence(allLandmarkSets, scale=True, tolerance=0.0001, maxIterations=5, reflection=True, out=None, chunkSize=None, initialMean=None,
+                      semiLandmarks=None, slidingCriterion='procD'):
+  """
+  Iterate the Procrustes fit until the change in mean shape drops below the
+  tolerance or maxIterations is reached.
+  Returns the aligned landmarks, the mean shape and a list with one entry per
+  iteration holding the mean shape change, the total Procrustes sum of squares
+  and the wall time of the iteration in seconds.
+  The input is not modified. The aligned landmarks are written to out (for
+  example a memory-mapped array) if given, and the specimens are processed
+  in blocks of chunkSize so that only one block is held in memory at a time.
+  If initialMean is given, the first alignment is to that shape instead of
+  the first specimen, which warm-starts the fit from a previous consensus.
+  semiLandmarks is a boolean mask of the landmarks that slide along their
+  tangent planes before each alignment, minimizing the Procrustes distance
+  (slidingCriterion='procD') or the bending energy ('bendingEnergy') to the
+  current mean shape.
+  """
+  import time
+  i,j,k=allLandmarkSets.shape
+  chunks=specimenChunks(k, chunkSize)
+  if out is None:
+    out=np.empty((i,j,k))
+  align=procrustesAlignBatch if scale else procrustesAlignNoScaleBatch
+  sumOfSquares=0
+  for chunk in chunks:
+    if scale:
+      out[:,:,chunk]=scaleShapes(centerShapes(allLandmarkSets[:,:,chunk]))
+    else:
+      out[:,:,chunk]=centerShapes(allLandmarkSets[:,:,chunk])
+    sumOfSquares+=(out[:,:,chunk]**2).sum()
+
+  def alignAll(reference):
+    meanSum=np.zeros((i,j))
+    for chunk in chunks:
+      out[:,:,chunk]=align(reference,out[:,:,chunk],reflection)
+      meanSum+=out[:,:,chunk].sum(axis=2)
+    return meanSum/k
+
+  initialMeanShape=alignAll(np.array(out[:,:,0]) if initialMean is None else initialMean)
+  if scale:
+    initialMeanShape=scaleShape(initialMeanShape)
+
+  semiIndex=None
+  if semiLandmarks is not None and np.any(semiLandmarks):
+    semiIndex=np.flatnonzero(semiLandmarks)
+    neighbors=semiLandmarkNeighbors(initialMeanShape, semiIndex)
+
+  def slideAll(reference):
+    reference=scaleShape(reference) if scale else reference
+    bendingEnergy=bendingEnergyMatrix(reference) if slidingCriterion=='bendingEnergy' else None
+    slidSumOfSquares=0
+    for chunk in chunks:
+      shapes=np.array(out[:,:,chunk])
+      tangents=tangentBases(shapes, neighbors)
+      if bendingEnergy is None:
+        shapes=slideProcrustes(shapes, reference, semiIndex, tangents)
+      else:
+        shapes=slideBendingEnergy(shapes, bendingEnergy, semiIndex, tangents)
+      shapes=centerShapes(shapes)
+      if scale:
+        shapes=scaleShapes(shapes)
+      out[:,:,chunk]=shapes
+      slidSumOfSquares+=(shapes**2).sum()
+    return slidSumOfSquares
+
+  currentMeanShape=initialMeanShape
+  trace=[]
+  diff=1
+  tries=0
+  while diff>tolerance and tries<maxIterations:
+    startTime=time.time()
+    if semiIndex is not None:
+      sumOfSquares=slideAll(initialMeanShape)
+    currentMeanShape=alignAll(initialMeanShape)
+    diff=np.linalg.norm(initialMeanShape-currentMeanShape)
+    initialMeanShape=currentMeanShape
+    tries=tries+1
+    # rotations preserve the norm of each shape, so the Procrustes SS follows from the mean shape
+    trace.append({'iteration': tries,
+                  'meanShapeDelta': diff,
+                  'procrustesSS': sumOfSquares-k*(currentMeanShape**2).sum(),
+                  'time': time.time()-startTime})
+  return out, currentMeanShape, trace
+
+def runGPABatch(allLandmarkSets):
+  allLandmarkSets, currentMeanShape, trace = runGPAConvergence(allLandmarkSets, scale=True)
+  return allLandmarkSets, currentMeanShape
+
+def runGPANoScaleBatch(allLandmarkSets):
+  allLandmarkSets, currentMeanShape, trace = runGPAConvergence(allLandmarkSets, scale=False)
+  return allLandmarkSets, currentMeanShape
+
+################# TPS warp
+# Thin plate spline with the r basis used by vtkThinPlateSplineTransform.SetBasisToR().
+# For fixed source landmarks the warp is linear in the landmark displacements, so the
+# kernel system is factored once and the displacement of any point is a linear
+# combination of per-landmark fields.
+
+def tpsFactor(sourceLandmarks):
+  """
+  LU factorization of the TPS system [[K, P], [P^T, 0]] for the (n x 3) source landmarks.
+  """
+  n=sourceLandmarks.shape[0]
+  system=np.zeros((n+4, n+4))
+  system[:n,:n]=np.linalg.norm(sourceLandmarks[:,np.newaxis,:]-sourceLandmarks[np.newaxis,:,:], axis=2)
+  system[:n,n]=1
+  system[:n,n+1:]=sourceLandmarks
+  system[n:,:n]=system[:n,n:].T
+  return sp.lu_factor(system)
+
+def tpsDisplacementFields(sourceLandmarks, displacements, points, factor=None, chunkSize=10000):
+  """
+  Evaluates TPS warps at the (m x 3) points. displacements is (c x n x 3), one set of landmark
+  displacements per field. Returns the (c x m x 3) displacements of the points as float32.
+  """
+  n=sourceLandmarks.shape[0]
+  c=displacements.shape[0]
+  if factor is None:
+    factor=tpsFactor(sourceLandmarks)
+  rightSide=np.zeros((n+4, 3*c))
+  rightSide[:n]=np.transpose(displacements, (1, 2, 0)).reshape(n, 3*c)
+  coefficients=sp.lu_solve(factor, rightSide)
+  fields=np.zeros((points.shape[0], 3*c), dtype=np.float32)
+  for chunk in specimenChunks(points.shape[0], chunkSize):
+    chunkPoints=points[chunk]
+    kernel=np.linalg.norm(chunkPoints[:,np.newaxis,:]-sourceLandmarks[np.newaxis,:,:], axis=2)
+    fields[chunk]=kernel@coefficients[:n]+coefficients[n]+chunkPoints@coefficients[n+1:]
+  return np.ascontiguousarray(np.transpose(fields.reshape(-1, 3, c), (2, 0, 1)))
+
+################# Sliding semilandmarks
+# Semilandmarks slide along the tangent plane of the surface they sample. The
+# tangent planes are estimated per specimen from the semilandmark's nearest
+# neighbours, which are found once on the mean shape.
+
+def semiLandmarkNeighbors(shape, semiIndex, neighborNumber=8):
+  """
+  Returns a (semilandmarks x neighborNumber+1) array of landmark indices, each row holding the
+  semilandmark itself and its nearest landmarks in shape.
+  """
+  from scipy.spatial import cKDTree
+  neighborNumber=min(neighborNumber+1, shape.shape[0])
+  distances,indices=cKDTree(shape).query(shape[semiIndex], k=neighborNumber)
+  return indices.reshape(len(semiIndex), neighborNumber)
+
+def tangentBases(allLandmarkSets, neighbors):
+  """
+  Returns (specimens x semilandmarks x 3 x 2) orthonormal bases of the tangent planes, the two
+  principal directions of each semilandmark's neighbourhood in each specimen.
+  """
+  points=allLandmarkSets[neighbors]
+  points=points-points.mean(axis=1, keepdims=True)
+  scatter=np.einsum('sain,sajn->nsij', points, points)
+  eigenValues,eigenVectors=np.linalg.eigh(scatter)
+  return eigenVectors[...,1:]
+
+def slideProcrustes(allLandmarkSets, reference, semiIndex, tangents):
+  """
+  Moves each semilandmark along its tangent plane to the point closest to the reference landmark,
+  which minimizes the Procrustes distance to the reference.
+  """
+  difference=reference[semiIndex,:,np.newaxis]-allLandmarkSets[semiIndex]
+  coefficients=np.einsum('nsij,sin->nsj', tangents, difference)
+  slid=np.array(allLandmarkSets)
+  slid[semiIndex]+=np.einsum('nsij,nsj->sin', tangents, coefficients)
+  return slid
+
+def bendingEnergyMatrix(reference):
+  """
+  (landmarks x landmarks) bending energy matrix of the TPS interpolation from the reference shape.
+  The r kernel used in 3D is conditionally negative definite, so the block of the inverse is negated
+  to give a positive semidefinite matrix.
+  """
+  factor=tpsFactor(reference)
+  p=reference.shape[0]
+  identity=np.zeros((p+4, p))
+  identity[:p]=np.eye(p)
+  return -sp.lu_solve(factor, identity)[:p]
+
+def slideBendingEnergy(allLandmarkSets, bendingEnergy, semiIndex, tangents, tolerance=1e-4, maxIterations=500):
+  """
+  Moves the semilandmarks along their tangent planes to minimize the bending energy of the TPS from the
+  reference. The 2s x 2s normal equations are never formed: they are solved by Jacobi preconditioned
+  conjugate gradients run for all specimens at once, so each step is one (landmarks x landmarks) by
+  (landmarks x 3*specimens) matrix product with the bending energy matrix.
+  """
+  p,j,k=allLandmarkSets.shape
+
+  def energyGradient(displacements):
+    return np.einsum('nsij,sin->nsj', tangents, np.dot(bendingEnergy, displacements.reshape(p,j*k)).reshape(p,j,k)[semiIndex])
+
+  def normalProduct(coefficients):
+    displacements=np.zeros((p,j,k))
+    displacements[semiIndex]=np.einsum('nsij,nsj->sin', tangents, coefficients)
+    return energyGradient(displacements)
+
+  # the diagonal 2x2 blocks of the normal equations are the bending energy diagonal times the identity
+  preconditioner=1/np.maximum(np.diag(bendingEnergy)[semiIndex], np.finfo(float).tiny)[np.newaxis,:,np.newaxis]
+  coefficients=np.zeros((k,len(semiIndex),2))
+  residual=-energyGradient(allLandmarkSets)
+  preconditioned=preconditioner*residual
+  direction=preconditioned.copy()
+  residualNorm=(residual*preconditioned).sum(axis=(1,2))
+  initialNorm=residualNorm.copy()
+  for iteration in range(maxIterations):
+    if np.all(residualNorm<=tolerance**2*initialNorm):
+      break
+    product=normalProduct(direction)
+    curvature=(direction*product).sum(axis=(1,2))
+    step=np.divide(residualNorm, curvature, out=np.zeros(k), where=curvature>0)
+    coefficients+=step[:,np.newaxis,np.newaxis]*direction
+    residual-=step[:,np.newaxis,np.newaxis]*product
+    preconditioned=preconditioner*residual
+    newResidualNorm=(residual*preconditioned).sum(axis=(1,2))
+    direction=preconditioned+np.divide(newResidualNorm, residualNorm, out=np.zeros(k), where=residualNorm>0)[:,np.newaxis,np.newaxis]*direction
+    residualNorm=newResidualNorm
+  slid=np.array(allLandmarkSets)
+  slid[semiIndex]+=np.einsum('nsij,nsj->sin', tangents, coefficients)
+  return slid
+
+################# Pairwise distances
+# The (specimens x specimens) matrix of Procrustes distances between the aligned
+# specimens is computed in square tiles of blockSize specimens, each tile from one
+# matrix product, by a thread pool (numpy releases the GIL in the products). Tiles are
+# written straight to out, which can be memory-mapped, so the matrix never has to fit
+# in memory.
+
+def pairwiseProcrustesDistances(allLandmarkSets, out=None, blockSize=1000, maxWorkers=None):
+  """
+  Returns the (specimens x specimens) matrix of Procrustes distances between the aligned landmark sets,
+  written to out if given. Only the upper triangle of tiles is computed and mirrored.
+  """
+  from concurrent.futures import ThreadPoolExecutor
+  i,j,k=allLandmarkSets.shape
+  if out is None:
+    out=np.empty((k,k))
+  chunks=specimenChunks(k, blockSize)
+  # subtracting the mean shape keeps the squared norms small, which limits the cancellation in |a|^2+|b|^2-2ab
+  meanShape=sum(allLandmarkSets[:,:,chunk].sum(axis=2) for chunk in chunks)/k
+
+  def block(chunk):
+    return (allLandmarkSets[:,:,chunk]-meanShape[:,:,np.newaxis]).reshape(i*j, -1).T
+
+  def tile(rowIndex, columnIndex):
+    rows=block(chunks[rowIndex])
+    columns=rows if rowIndex==columnIndex else block(chunks[columnIndex])
+    squared=(rows**2).sum(axis=1)[:,np.newaxis]+(columns**2).sum(axis=1)[np.newaxis,:]-2*np.dot(rows, columns.T)
+    distances=np.sqrt(np.maximum(squared, 0))
+    if rowIndex==columnIndex:
+      np.fill_diagonal(distances, 0)
+    out[chunks[rowIndex], chunks[columnIndex]]=distances
+    out[chunks[columnIndex], chunks[rowIndex]]=distances.T
+
+  with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+    tiles=[executor.submit(tile, rowIndex, columnIndex) for rowIndex in range(len(chunks)) for columnIndex in range(rowIndex, len(chunks))]
+    for result in tiles:
+      result.result()
+  return out
+
+def nearestNeighbors(distances, specimenIndex, neighborNumber=5, blockSize=1000):
+  """
+  Returns the indices and distances of the neighborNumber nearest specimens, excluding the specimen itself,
+  for each specimen in specimenIndex, sorted by distance. The rows of the distance matrix are read a block
+  at a time.
+  """
+  specimenIndex=np.atleast_1d(specimenIndex)
+  neighborNumber=min(neighborNumber, distances.shape[0]-1)
+  indices=np.zeros((len(specimenIndex), neighborNumber), dtype=int)
+  neighborDistances=np.zeros((len(specimenIndex), neighborNumber))
+  for chunk in specimenChunks(len(specimenIndex), blockSize):
+    rows=np.array(distances[specimenIndex[chunk]])
+    rows[np.arange(rows.shape[0]), specimenIndex[chunk]]=np.inf
+    nearest=np.argpartition(rows, neighborNumber-1, axis=1)[:,:neighborNumber]
+    order=np.argsort(np.take_along_axis(rows, nearest, axis=1), axis=1)
+    indices[chunk]=np.take_along_axis(nearest, order, axis=1)
+    neighborDistances[chunk]=np.take_along_axis(rows, indices[chunk], axis=1)
+  return indices, neighborDistances
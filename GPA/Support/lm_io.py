@@ -0,0 +1,327 @@
+import os
+import io
+import json
+import hashlib
+import tempfile
+import threading
+import functools
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+# Fast readers for landmark files. They parse the files directly instead of
+# going through pandas or the MRML scene so they can be run from worker threads.
+
+def readMarkupsJson(filePath):
+  """
+  Reads the first markup of a .mrk.json file.
+  Returns an (n x 3) array of positions, a boolean array that is True for points
+  with a defined position, the lists of point labels and descriptions, and the
+  coordinate system ('LPS' or 'RAS') the positions are stored in.
+  """
+  with open(filePath) as f:
+    markup = json.load(f)['markups'][0]
+  controlPoints = markup['controlPoints']
+  landmarkNumber = len(controlPoints)
+  positions = np.zeros((landmarkNumber, 3))
+  defined = np.ones(landmarkNumber, dtype=bool)
+  labels = []
+  descriptions = []
+  for index, point in enumerate(controlPoints):
+    positions[index] = point.get('position', [0, 0, 0])
+    defined[index] = point.get('positionStatus', 'defined') == 'defined'
+    labels.append(point.get('label', ''))
+    descriptions.append(point.get('description', ''))
+  return positions, defined, labels, descriptions, markup.get('coordinateSystem', 'LPS')
+
+def readFcsv(filePath):
+  """
+  Reads a .fcsv file. Returns the same tuple as readMarkupsJson, all points of
+  an fcsv file are treated as defined.
+  """
+  rows = []
+  coordinateSystem = 'RAS'
+  with open(filePath) as f:
+    for row in f:
+      if not row.startswith('#'):
+        rows.append(row.strip().split(','))
+      elif 'CoordinateSystem' in row:
+        value = row.split('=')[-1].strip()
+        coordinateSystem = 'LPS' if value in ['LPS', '1'] else 'RAS'
+  positions = np.array([row[1:4] for row in rows], dtype=float).reshape(-1, 3)
+  defined = np.ones(len(rows), dtype=bool)
+  labels = [row[11] if len(row) > 11 else '' for row in rows]
+  descriptions = [row[12] if len(row) > 12 else '' for row in rows]
+  return positions, defined, labels, descriptions, coordinateSystem
+
+def readLandmarkFile(filePath):
+  if 'json' in os.path.splitext(filePath)[1]:
+    return readMarkupsJson(filePath)
+  return readFcsv(filePath)
+
+def allocateLandmarkArray(shape, storageDirectory=None, name='landmarks'):
+  """
+  Returns a zero-filled float array. If a storage directory is given the array
+  is a memory-mapped .npy file in that directory instead of living in memory.
+  The file is in Fortran order, so the coordinates of each subject (the last
+  axis) are contiguous and growLandmarkFile can append subjects to it.
+  """
+  if storageDirectory is None:
+    return np.zeros(shape)
+  os.makedirs(storageDirectory, exist_ok=True)
+  return np.lib.format.open_memmap(os.path.join(storageDirectory, name + '.npy'), mode='w+', dtype=float, shape=shape,
+                                   fortran_order=True)
+
+def allocateTemporaryArray(shape, directory=None):
+  """
+  Returns a zero-filled float array memory-mapped from an anonymous temporary
+  file in directory (the system temporary directory by default). The file is
+  deleted when the array is released.
+  """
+  with tempfile.TemporaryFile(dir=directory) as f:
+    # the memory map keeps its own handle to the file
+    return np.memmap(f, dtype=float, mode='w+', shape=shape)
+
+def growLandmarkFile(filePath, newData):
+  """
+  Appends the subjects of the (landmarks x 3 x m) newData to a .npy file in
+  Fortran order, as written by allocateLandmarkArray. Only the new subjects are
+  written, at the end of the file, and the shape in the header is updated.
+  Returns False without changing the file if it is not in Fortran order or the
+  header has no room for the new shape. The file must not be memory-mapped
+  while it grows.
+  """
+  with open(filePath, 'r+b') as f:
+    version = np.lib.format.read_magic(f)
+    if version == (1, 0):
+      shape, fortranOrder, dtype = np.lib.format.read_array_header_1_0(f)
+      writeHeader = np.lib.format.write_array_header_1_0
+    elif version == (2, 0):
+      shape, fortranOrder, dtype = np.lib.format.read_array_header_2_0(f)
+      writeHeader = np.lib.format.write_array_header_2_0
+    else:
+      return False
+    dataOffset = f.tell()
+    if not fortranOrder or len(shape) != 3 or shape[:2] != newData.shape[:2]:
+      return False
+    header = io.BytesIO()
+    writeHeader(header, {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': True,
+                         'shape': (shape[0], shape[1], shape[2] + newData.shape[2])})
+    if header.tell() != dataOffset:
+      return False
+    # write the data first, so the old header still describes the file if writing fails
+    f.seek(dataOffset + shape[0]*shape[1]*shape[2]*dtype.itemsize)
+    f.write(np.asarray(newData, dtype=dtype).tobytes(order='F'))
+    f.seek(0)
+    f.write(header.getvalue())
+  return True
+
+def appendSubjects(array, newData, axis=-1):
+  """
+  Returns an in-memory array of the subjects of array followed by those of
+  newData. The subjects are along axis, which must be the first or the last
+  axis, for example the last one of (landmarks x 3 x subjects) coordinates and
+  the first one of (subjects x PCs) scores. The result is a view of a buffer
+  with room for more subjects. Arrays returned by an earlier call are extended
+  inside their buffer, which doubles when it is full, so adding subjects
+  repeatedly copies the existing ones only O(log n) times.
+  """
+  array = np.asarray(array)
+  axis = axis % array.ndim
+  k = array.shape[axis]
+  m = newData.shape[axis]
+  def subjects(start, stop):
+    index = [slice(None)]*array.ndim
+    index[axis] = slice(start, stop)
+    return tuple(index)
+  buffer = array.base
+  contiguous = 'F_CONTIGUOUS' if axis else 'C_CONTIGUOUS'
+  if not (isinstance(buffer, np.ndarray) and buffer.base is None and buffer.ndim == array.ndim
+          and buffer.shape[:axis] + buffer.shape[axis+1:] == array.shape[:axis] + array.shape[axis+1:]
+          and buffer.shape[axis] >= k + m and buffer.flags[contiguous] and array.strides == buffer.strides
+          and array.__array_interface__['data'][0] == buffer.__array_interface__['data'][0]):
+    shape = list(array.shape)
+    shape[axis] = max(2*k, k + m)
+    buffer = np.empty(shape, dtype=np.result_type(array, newData), order='F' if axis else 'C')
+    buffer[subjects(0, k)] = array
+  buffer[subjects(k, k + m)] = newData
+  return buffer[subjects(0, k + m)]
+
+# Cache of parsed landmark files. Each file gets one .npz entry in the cache
+# directory, named by the hash of its absolute path. An entry is only used if
+# the size and modification time stored in it match the file on disk. Entries
+# are touched when they are used, and the least recently used ones are removed
+# when the directory grows beyond cacheSizeLimit bytes.
+
+cacheSizeLimit = 200*2**20
+
+def cacheEntryPath(cacheDirectory, filePath):
+  key = hashlib.sha1(os.path.abspath(filePath).encode('utf-8')).hexdigest()
+  return os.path.join(cacheDirectory, key + '.npz')
+
+def readCacheEntry(entryPath, filePath, fileStat):
+  try:
+    with np.load(entryPath) as entry:
+      if (str(entry['path']) == os.path.abspath(filePath) and int(entry['size']) == fileStat.st_size
+          and int(entry['mtime']) == fileStat.st_mtime_ns):
+        result = (entry['positions'], entry['defined'], entry['labels'].tolist(), entry['descriptions'].tolist(),
+                  str(entry['coordinateSystem']))
+      else:
+        return None
+  except (OSError, KeyError, ValueError):
+    return None
+  try:
+    # mark the entry as recently used for pruneCache
+    os.utime(entryPath)
+  except OSError:
+    pass
+  return result
+
+def writeCacheEntry(entryPath, filePath, fileStat, result):
+  positions, defined, labels, descriptions, coordinateSystem = result
+  os.makedirs(os.path.dirname(entryPath), exist_ok=True)
+  # write to a temporary file first so readers never see a partial entry
+  temporaryPath = f'{entryPath}.{os.getpid()}.{threading.get_ident()}.tmp'
+  with open(temporaryPath, 'wb') as f:
+    np.savez(f, path=os.path.abspath(filePath), size=fileStat.st_size, mtime=fileStat.st_mtime_ns,
+             positions=positions, defined=defined,
+             labels=np.array(labels, dtype=np.str_), descriptions=np.array(descriptions, dtype=np.str_),
+             coordinateSystem=coordinateSystem)
+  os.replace(temporaryPath, entryPath)
+
+def readLandmarkFileCached(filePath, cacheDirectory):
+  """
+  Returns the parsed landmark file from the cache, parsing and caching it if
+  the file is new or has changed since it was cached.
+  """
+  fileStat = os.stat(filePath)
+  entryPath = cacheEntryPath(cacheDirectory, filePath)
+  result = readCacheEntry(entryPath, filePath, fileStat)
+  if result is None:
+    result = readLandmarkFile(filePath)
+    try:
+      writeCacheEntry(entryPath, filePath, fileStat, result)
+    except OSError:
+      pass
+  return result
+
+def pruneCache(cacheDirectory, sizeLimit=None):
+  """
+  Removes the least recently used entries until the cache directory holds at
+  most sizeLimit bytes (cacheSizeLimit by default).
+  """
+  sizeLimit = cacheSizeLimit if sizeLimit is None else sizeLimit
+  entries = []
+  try:
+    with os.scandir(cacheDirectory) as directoryEntries:
+      for entry in directoryEntries:
+        if entry.name.endswith('.npz'):
+          entryStat = entry.stat()
+          entries.append((entryStat.st_mtime_ns, entryStat.st_size, entry.path))
+  except OSError:
+    return
+  totalSize = sum(size for _, size, _ in entries)
+  for _, size, entryPath in sorted(entries):
+    if totalSize <= sizeLimit:
+      break
+    try:
+      os.remove(entryPath)
+    except OSError:
+      pass
+    totalSize -= size
+
+def readLandmarkFileSafe(filePath, cacheDirectory=None):
+  """
+  Returns (result, None) on success or (None, error message) when the file cannot be parsed.
+  """
+  try:
+    if cacheDirectory:
+      return readLandmarkFileCached(filePath, cacheDirectory), None
+    return readLandmarkFile(filePath), None
+  except Exception as e:
+    return None, str(e)
+
+def readLandmarkFiles(filePathList, maxWorkers=0, cacheDirectory=None):
+  """
+  Parses the landmark files and yields (result, error) tuples from
+  readLandmarkFileSafe in the order of filePathList. If a cache directory is
+  given, unchanged files are read from the cache.
+  Parsing holds the GIL, so the files are read in this thread by default.
+  maxWorkers other than 0 reads them with a thread pool of that size (None for
+  the default size), which only helps when reading the files waits on slow
+  storage such as a network share. Files not yet read are cancelled when the
+  caller stops iterating early. The cache is pruned to cacheSizeLimit once all
+  files have been read.
+  """
+  reader = functools.partial(readLandmarkFileSafe, cacheDirectory=cacheDirectory)
+  if maxWorkers == 0:
+    for filePath in filePathList:
+      yield reader(filePath)
+  else:
+    executor = ThreadPoolExecutor(max_workers=maxWorkers)
+    try:
+      for result in executor.map(reader, filePathList):
+        yield result
+    finally:
+      executor.shutdown(wait=True, cancel_futures=True)
+  if cacheDirectory:
+    pruneCache(cacheDirectory)
+
+# Result tables. Numeric values are formatted a block of rows at a time with
+# np.savetxt and written straight to the file, without building object arrays
+# of strings for the whole table.
+
+def writeCsvTable(filePath, header, rowNames, blocks, fmt='%.17g'):
+  """
+  Writes a csv file with an optional header row and a first column of row
+  names. blocks is an iterable of 2D numeric arrays holding consecutive rows.
+  """
+  rowIndex = 0
+  with open(filePath, 'w') as f:
+    if header is not None:
+      f.write(','.join(header) + '\n')
+    for block in blocks:
+      text = io.StringIO()
+      np.savetxt(text, np.atleast_2d(block), fmt=fmt, delimiter=',')
+      lines = text.getvalue().splitlines()
+      names = rowNames[rowIndex:rowIndex+len(lines)]
+      f.write(''.join(name + ',' + line + '\n' for name, line in zip(names, lines)))
+      rowIndex += len(lines)
+
+def writeBinaryResults(directory, arrays):
+  """
+  Writes each array of the dictionary as an .npy file into the directory so it
+  can later be memory-mapped by readBinaryResults.
+  """
+  os.makedirs(directory, exist_ok=True)
+  for name, value in arrays.items():
+    np.save(os.path.join(directory, name + '.npy'), value)
+
+def fileStamps(directory, fileNames):
+  """
+  Returns the (files x 2) array of the size and modification time in
+  nanoseconds of each file in the directory, -1 for missing files. Stored with
+  the binary results, it tells whether the files changed since they were written.
+  """
+  stamps = np.full((len(fileNames), 2), -1, dtype=np.int64)
+  for index, fileName in enumerate(fileNames):
+    try:
+      fileStat = os.stat(os.path.join(directory, fileName))
+    except OSError:
+      continue
+    stamps[index] = fileStat.st_size, fileStat.st_mtime_ns
+  return stamps
+
+def readBinaryResults(directory, names, mmapMode='r'):
+  """
+  Returns a dictionary of the arrays stored with writeBinaryResults. Numeric
+  arrays are memory-mapped, so only the parts that are used are read from disk.
+  """
+  arrays = {}
+  for name in names:
+    filePath = os.path.join(directory, name + '.npy')
+    try:
+      arrays[name] = np.load(filePath, mmap_mode=mmapMode)
+    except ValueError:
+      # string arrays cannot be memory-mapped
+      arrays[name] = np.load(filePath)
+  return arrays
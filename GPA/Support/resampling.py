@@ -0,0 +1,137 @@
+import os
+import sys
+import shutil
+import logging
+import numpy as np
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from . import gpa_lib
+
+# Bootstrap and permutation replicates of GPA statistics. The aligned
+# coordinates are shared with the worker processes as a .npy file that every
+# worker memory-maps once, so only the replicate indices and the small
+# per-replicate results are passed between processes. Workers use the spawn
+# start method because forking the Slicer application process is not safe.
+
+_workerData = {}
+
+def workerExecutable():
+  """
+  Returns the Python interpreter started for spawned worker processes. Inside Slicer this is PythonSlicer,
+  because the Slicer application itself cannot be started as a Python interpreter, or None if it cannot be
+  found. Outside Slicer it is the running interpreter.
+  """
+  app = getattr(sys.modules.get('slicer'), 'app', None)
+  if app is None:
+    return sys.executable
+  executableName = 'PythonSlicer.exe' if os.name == 'nt' else 'PythonSlicer'
+  directories = [os.path.dirname(sys.executable)]
+  if getattr(app, 'slicerHome', None):
+    directories.append(os.path.join(app.slicerHome, 'bin'))
+  for directory in directories:
+    executable = os.path.join(directory, executableName)
+    if os.path.isfile(executable):
+      return executable
+  return shutil.which('PythonSlicer')
+
+def initializeWorker(landmarkPath, parameters):
+  _workerData.clear()
+  _workerData.update(parameters)
+  _workerData['landmarks'] = np.load(landmarkPath, mmap_mode='r')
+
+def alignSigns(vectors, referenceVectors):
+  """
+  Flips eigenvectors so each one points the same way as the corresponding reference eigenvector.
+  """
+  signs = np.sign(np.sum(vectors*referenceVectors, axis=0))
+  signs[signs == 0] = 1
+  return vectors*signs
+
+def bootstrapReplicate(seed):
+  """
+  Resamples the specimens with replacement, runs GPA warm-started from the full-sample mean shape and a PCA.
+  Returns the replicate mean shape, the leading eigenvalues and the sign-aligned eigenvectors.
+  """
+  landmarks = _workerData['landmarks']
+  k = landmarks.shape[2]
+  rng = np.random.default_rng(seed)
+  sample = np.array(landmarks[:,:,np.sort(rng.integers(0, k, k))])
+  aligned, meanShape, trace = gpa_lib.runGPAConvergence(sample, _workerData['scale'], _workerData['tolerance'],
+    _workerData['maxIterations'], out=sample, initialMean=_workerData['referenceMean'])
+  referenceVectors = _workerData['referenceVectors']
+  componentNumber = referenceVectors.shape[1]
+  eigenValues, eigenVectors = gpa_lib.calcPCA(gpa_lib.makeTwoDim(aligned))
+  eigenVectors = alignSigns(eigenVectors[:,:componentNumber], referenceVectors)
+  return meanShape, eigenValues[:componentNumber], eigenVectors
+
+def betweenGroupSS(landmarks, groups, groupIds):
+  """
+  Procrustes sum of squares between the group mean shapes and the grand mean, weighted by group size.
+  """
+  grandMean = landmarks.mean(axis=2)
+  statistic = 0
+  for groupId in groupIds:
+    members = groups == groupId
+    statistic += members.sum()*((landmarks[:,:,members].mean(axis=2)-grandMean)**2).sum()
+  return statistic
+
+def permutationReplicate(seed):
+  groups = _workerData['groups']
+  rng = np.random.default_rng(seed)
+  return betweenGroupSS(_workerData['landmarks'], rng.permutation(groups), np.unique(groups))
+
+def runReplicates(function, seeds, landmarkPath, parameters, maxWorkers=None):
+  """
+  Runs function for each replicate seed. The parameters dictionary is sent once to each worker.
+  maxWorkers=0 runs the replicates in this process, otherwise a spawn process pool with maxWorkers
+  processes (all cores by default) is used. The workers run the interpreter returned by workerExecutable,
+  the replicates run in this process if there is none.
+  """
+  executable = workerExecutable() if maxWorkers != 0 else None
+  if maxWorkers != 0 and executable is None:
+    logging.warning('PythonSlicer was not found, running the replicates in this process')
+  if executable is None:
+    initializeWorker(landmarkPath, parameters)
+    return [function(seed) for seed in seeds]
+  workerNumber = maxWorkers or os.cpu_count()
+  chunkSize = max(1, len(seeds)//(4*workerNumber))
+  context = multiprocessing.get_context('spawn')
+  context.set_executable(executable)
+  with ProcessPoolExecutor(max_workers=workerNumber, mp_context=context,
+                           initializer=initializeWorker, initargs=(landmarkPath, parameters)) as executor:
+    return list(executor.map(function, seeds, chunksize=chunkSize))
+
+def bootstrap(landmarkPath, referenceMean, referenceVectors, replicateNumber, scale=True, tolerance=0.0001, maxIterations=5,
+              alpha=0.05, seed=0, maxWorkers=None):
+  """
+  Bootstrap replicates of the GPA mean shape and PCA of the aligned coordinates stored in landmarkPath.
+  Returns a dictionary of the replicate arrays and their percentile confidence intervals at level 1-alpha.
+  """
+  seeds = np.random.SeedSequence(seed).generate_state(replicateNumber)
+  parameters = {'referenceMean': referenceMean, 'referenceVectors': referenceVectors, 'scale': scale,
+    'tolerance': tolerance, 'maxIterations': maxIterations}
+  results = runReplicates(bootstrapReplicate, seeds.tolist(), landmarkPath, parameters, maxWorkers)
+  meanShapes = np.stack([result[0] for result in results])
+  eigenValues = np.stack([result[1] for result in results])
+  eigenVectors = np.stack([result[2] for result in results])
+  percentiles = [100*alpha/2, 100*(1-alpha/2)]
+  return {
+    'meanShapes': meanShapes,
+    'eigenValues': eigenValues,
+    'meanShapeInterval': np.percentile(meanShapes, percentiles, axis=0),
+    'eigenValueInterval': np.percentile(eigenValues, percentiles, axis=0),
+    'eigenVectorInterval': np.percentile(eigenVectors, percentiles, axis=0),
+    'eigenVectorSD': eigenVectors.std(axis=0)}
+
+def permutationTest(landmarkPath, groups, replicateNumber, seed=0, maxWorkers=None):
+  """
+  Permutation test of the between-group Procrustes sum of squares of the aligned coordinates in landmarkPath.
+  Returns the observed statistic, the permutation p-value and the statistics of the replicates.
+  """
+  groups = np.asarray(groups)
+  observed = betweenGroupSS(np.load(landmarkPath, mmap_mode='r'), groups, np.unique(groups))
+  seeds = np.random.SeedSequence(seed).generate_state(replicateNumber)
+  statistics = np.array(runReplicates(permutationReplicate, seeds.tolist(), landmarkPath, {'groups': groups}, maxWorkers))
+  pValue = (np.sum(statistics >= observed)+1)/(replicateNumber+1)
+  return observed, pValue, statistics
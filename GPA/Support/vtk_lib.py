@@ -1,4 +1,5 @@
 from __main__ import vtk
+import numpy as np
 
 def resliceThroughTransform( sourceNode, transform, referenceNode, targetNode):
     """
@@ -81,6 +82,40 @@ def convertNumpyToVTK(A):
 #
     return points
 
+# Bulk conversion of numpy arrays. The vtk arrays share memory with the numpy
+# arrays (numpy_to_vtk keeps a reference to them), so no per-element Python calls are made.
+
+def numpyToVTKArray(A, name=None):
+    from vtk.util import numpy_support
+    array=numpy_support.numpy_to_vtk(np.ascontiguousarray(A))
+    if name is not None:
+        array.SetName(name)
+    return array
+
+def numpyToVTKPoints(A):
+    points=vtk.vtkPoints()
+    points.SetData(numpyToVTKArray(np.asarray(A, dtype=float).reshape(-1,3)))
+    return points
+
+def lineCells(startIds, endIds):
+    """Returns a vtkCellArray with one line from startIds[n] to endIds[n] for each n"""
+    from vtk.util import numpy_support
+    # vtkIdType is 64 bit while the default numpy integer is 32 bit on Windows with numpy<2
+    idType=numpy_support.get_numpy_array_type(vtk.VTK_ID_TYPE)
+    connectivity=np.column_stack((startIds, endIds)).ravel().astype(idType)
+    offsets=np.arange(0, len(connectivity)+1, 2, dtype=idType)
+    lines=vtk.vtkCellArray()
+    lines.SetData(numpy_support.numpy_to_vtkIdTypeArray(offsets, deep=True), numpy_support.numpy_to_vtkIdTypeArray(connectivity, deep=True))
+    return lines
+
+def vertexCells(numberOfPoints):
+    """Returns a vtkCellArray with one vertex cell per point"""
+    from vtk.util import numpy_support
+    idType=numpy_support.get_numpy_array_type(vtk.VTK_ID_TYPE)
+    vertices=vtk.vtkCellArray()
+    vertices.SetData(numpy_support.numpy_to_vtkIdTypeArray(np.arange(numberOfPoints+1, dtype=idType), deep=True), numpy_support.numpy_to_vtkIdTypeArray(np.arange(numberOfPoints, dtype=idType), deep=True))
+    return vertices
+
 
 # def test():
 #     mrml=slicer.mrmlScene